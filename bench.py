@@ -0,0 +1,981 @@
+"""
+Замеры производительности оверлея.
+
+    python bench.py hook-loop [--seconds 10] [--samples 200]
+
+hook-loop (только Windows): для каждого режима цикла сообщений
+(INPUT_HOOK_PUMP_MODE = "poll" / "blocking") поднимает поток хука ввода
+(мышь и клавиатура) так же, как main(), и меряет:
+  * загрузку CPU процессом в простое (нет ввода);
+  * задержку хук -> Qt-слот: от входа в обработчик хука до вызова
+    слота в GUI-потоке через QueuedConnection (как onMouseRightUp).
+Для задержки в систему подаются синтетические сдвиги мыши на ±1 px.
+
+    python bench.py hook-dispatch [--events 200000]
+
+hook-dispatch (любая ОС, QT_QPA_PLATFORM=offscreen): стоимость одного
+вызова on_mouse_event на синтетических событиях по типам (движение,
+движение во время протяжки, ЛКМ, ПКМ при включённых измерениях) — в
+сравнении со старым обработчиком (сравнение строк, isVisible() из потока
+хука, f-строка для logging.debug и invokeMethod на каждое ПКМ-событие).
+
+    python bench.py suite [--only paint,arrow] [--save-baseline FILE]
+                          [--baseline FILE] [--threshold 0.2]
+
+suite (любая ОС, QT_QPA_PLATFORM=offscreen): набор замеров с результатами
+в JSON. Все величины — время в микросекундах (меньше — лучше), медиана
+по повторам:
+  paint.*     — OverlayWindow.paintEvent на 10/100/1000/10000 отрезках:
+                immediate (всё заново), retained cold (сборка слоя),
+                retained warm (копия всего слоя), retained dirty (один
+                отрезок 64x64);
+  arrow       — один вызов draw_arrow;
+  dispatch.*  — on_mouse_event на синтетических событиях (на событие);
+  hotkeys.*   — автомат хоткеев HotkeyMatcher на событие клавиатуры:
+                обычная клавиша, хоткей, шаги последовательности '-,=',
+                модификатор;
+  geometry.*  — длины и азимуты 10000 отрезков: по одному через
+                _distance_in_pixels/_bearing_deg и пакетно SegmentStore;
+  grid.*      — detect_grid_spacing на синтетической миникарте 360/600 px
+                и дешёвые ступени MinimapWatcher (миниатюра, подпись сетки);
+  markers.*   — MarkerTracker: кадр синтетической последовательности в
+                среднем, разбор изменившегося кадра, пропуск того же кадра;
+  mask.*      — маска окна на 10/100/1000 коротких отрезках по окну
+                1600x900: area_pct — компонуемая доля экрана в процентах
+                (не время), пересборка и расширение маски, полная
+                перерисовка в пределах маски против всего окна, удаление
+                отрезка (починка слоя и маски по месту);
+  labels.*    — подписи: перерисовка с готовыми QStaticText против сборки
+                всех подписей заново, прямоугольник предпросмотра;
+  fan.*       — веер дальностей на 10/1000 целях: пересчёт таблицы при
+                сдвиге начала, запрос из кэша, обновление строк в панели;
+  session.*   — журнал сессии: SessionLog.log в GUI-потоке (на запись) и
+                проигрывание журнала на 100/1000 отрезках (применение,
+                отрисовка);
+  loupe.*     — лупа: привязка на снимке 49x49 синтетической миникарты,
+                вырез области из файла, кадр LoupeGrabber целиком (снимок,
+                привязка, QImage), отрисовка LoupeWidget;
+  startup.*   — холодный старт main.py в отдельном процессе до первого
+                кадра, панели и установленного ввода (--exit-after-startup):
+                с FAST_START и с --no-fast-start; создание OverlayWindow
+                без панели и с ней.
+--save-baseline сохраняет результаты, --baseline сравнивает с ними и
+помечает регрессии хуже порога (по умолчанию +20%); код выхода 1, если
+регрессии есть.
+
+    python bench.py grid-corpus DIR [--tolerance 0.02] [--synthesize N]
+
+grid-corpus (любая ОС): автокалибровка на корпусе сохранённых снимков
+миникарты — DIR с PNG и expected.json {"файл.png": шаг сетки в px}.
+--synthesize N сначала кладёт в DIR N синтетических снимков с ответами.
+
+    python bench.py markers DIR [--synthesize N] [--verbose]
+
+markers (любая ОС): слежение за метками на записанной последовательности
+снимков миникарты (main.py --record-minimap DIR) — время на кадр, сколько
+кадров пропущено как неизменившиеся, найденные метки.
+
+    python bench.py replay FILE [--repeat 5]
+
+replay (любая ОС): журнал сессии (main.py --session-log) как
+детерминированный вход — время применения записей и отрисовки оверлея.
+"""
+import argparse
+import json
+import math
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import numpy as np
+from PyQt5 import QtCore, QtGui, QtWidgets
+
+import main as ruler
+
+
+class _LatencyProbe(QtCore.QObject):
+    """Приёмник в GUI-потоке: фиксирует время прихода queued-вызова."""
+
+    def __init__(self):
+        super().__init__()
+        self.hook_times = []
+        self.slot_delays = []
+
+    def on_hook_event(self, event):
+        # Вызывается в потоке хука вместо main.on_mouse_event
+        if event.MessageName == "mouse move":
+            self.hook_times.append(time.perf_counter())
+            QtCore.QMetaObject.invokeMethod(self, "onHookEvent", QtCore.Qt.QueuedConnection)
+        return True
+
+    @QtCore.pyqtSlot()
+    def onHookEvent(self):
+        now = time.perf_counter()
+        if len(self.slot_delays) < len(self.hook_times):
+            self.slot_delays.append(now - self.hook_times[len(self.slot_delays)])
+
+
+def _wait(app, seconds):
+    """Крутим GUI-цикл заданное время (слоты должны исполняться)."""
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        app.processEvents(QtCore.QEventLoop.AllEvents, 10)
+        time.sleep(0.001)
+
+
+def bench_hook_loop(app, mode, seconds, samples):
+    import win32api
+    import win32con
+
+    ruler.import_windows_modules()
+    probe = _LatencyProbe()
+    ruler.INPUT_HOOK_PUMP_MODE = mode
+    ruler.INPUT_HOOK_RUNNING = True
+    ruler.on_mouse_event = probe.on_hook_event
+
+    thread = threading.Thread(target=ruler.install_input_hook, daemon=True)
+    thread.start()
+    _wait(app, 0.5)
+
+    # 1) Простой: CPU процесса за `seconds` без ввода
+    cpu0, wall0 = time.process_time(), time.perf_counter()
+    time.sleep(seconds)  # GUI-цикл в простое не крутим: меряем сам поток хука
+    cpu_idle = (time.process_time() - cpu0) / (time.perf_counter() - wall0) * 100
+
+    # 2) Задержка хук -> слот
+    step = 1
+    for _ in range(samples):
+        win32api.mouse_event(win32con.MOUSEEVENTF_MOVE, step, 0, 0, 0)
+        step = -step
+        _wait(app, 0.02)
+    _wait(app, 0.2)
+
+    ruler.uninstall_input_hook()
+    thread.join(timeout=5)
+
+    delays_us = sorted(d * 1e6 for d in probe.slot_delays)
+    result = {"mode": mode, "idle_cpu_percent": cpu_idle, "samples": len(delays_us)}
+    if delays_us:
+        result["latency_us_p50"] = statistics.median(delays_us)
+        result["latency_us_p95"] = delays_us[int(len(delays_us) * 0.95) - 1]
+        result["latency_us_max"] = delays_us[-1]
+    return result
+
+
+def _legacy_on_mouse_event(event):
+    """Обработчик хука до fast path — для сравнения в hook-dispatch."""
+    overlay = ruler.overlay
+    if event.MessageName == "mouse move":
+        return True
+    if not overlay or not overlay.is_measuring:
+        return True
+    ruler.logging.debug(f"Mouse event: {event.MessageName} at {event.Position}, is_measuring={overlay.is_measuring}")
+    if event.MessageName in ["mouse left down", "mouse left up", "mouse left drag"]:
+        return True
+    if event.MessageName in ["mouse right down", "mouse right up"]:
+        x, y = event.Position
+        if overlay.isVisible():
+            method = "onMouseRightDown" if event.MessageName == "mouse right down" else "onMouseRightUp"
+            QtCore.QMetaObject.invokeMethod(
+                overlay, method, QtCore.Qt.QueuedConnection,
+                QtCore.Q_ARG(int, x), QtCore.Q_ARG(int, y)
+            )
+            event.DontRouteToDefault = True
+            return False
+    return True
+
+
+def bench_hook_dispatch(app, events):
+    """Наносекунды на вызов обработчика хука для разных типов событий."""
+    overlay = ruler.OverlayWindow()
+    ruler.overlay = overlay
+    overlay.is_measuring = True
+    ring = ruler.input_ring
+
+    cases = [
+        ("move", "mouse move", False),
+        ("move (dragging)", "mouse move", True),
+        ("left down", "mouse left down", False),
+        ("right down/up", "mouse right down", False),
+    ]
+    results = {}
+    for label, name, dragging in cases:
+        batch = [ruler.SyntheticMouseEvent(name, i % 1920, i % 1080) for i in range(1000)]
+        for impl_name, handler in (("legacy", _legacy_on_mouse_event), ("fast", ruler.on_mouse_event)):
+            total = 0
+            for _ in range(events // len(batch)):
+                ruler._preview_tracking = dragging
+                t0 = time.perf_counter_ns()
+                for event in batch:
+                    handler(event)
+                total += time.perf_counter_ns() - t0
+                # Не даём кольцу и очереди Qt переполниться между пачками
+                ring.drain(lambda *record: None)
+                app.removePostedEvents(overlay)
+            results[(label, impl_name)] = total / (events // len(batch) * len(batch))
+
+    overlay.close()
+    return results
+
+
+def _measure(fn, number=1, repeat=5):
+    """Медиана по `repeat` повторам времени одного вызова fn, мкс."""
+    times = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        for _ in range(number):
+            fn()
+        times.append((time.perf_counter() - t0) / number * 1e6)
+    return statistics.median(times)
+
+
+def _random_segments(count, width, height, seed=0):
+    rng = random.Random(seed)
+    segments = []
+    for _ in range(count):
+        x1, y1 = rng.uniform(0, width), rng.uniform(0, height)
+        x2, y2 = rng.uniform(0, width), rng.uniform(0, height)
+        segments.append((x1, y1, x2, y2))
+    return segments
+
+
+def _make_overlay(segments):
+    overlay = ruler.OverlayWindow()
+    ruler.overlay = overlay
+    overlay.scale_factor = 2.0
+    overlay.is_calibrating = False
+    for segment in segments:
+        overlay.segments.add(*segment)
+    overlay.dropLinesCache()
+    return overlay
+
+
+def bench_paint(app, sizes=(10, 100, 1000, 10000)):
+    results = {}
+    retained = ruler.RETAINED_RENDERING
+    for n in sizes:
+        overlay = _make_overlay(_random_segments(n, 800, 600))
+        overlay.resize(800, 600)
+        # render() синхронно вызывает paintEvent с заданной областью (без
+        # дочерних виджетов — только сам оверлей), независимо от экспозиции окна
+        target = QtGui.QImage(overlay.size(), QtGui.QImage.Format_ARGB32_Premultiplied)
+        flags = QtWidgets.QWidget.RenderFlags(QtWidgets.QWidget.DrawWindowBackground)
+        full = QtGui.QRegion(overlay.rect())
+        dirty = QtGui.QRegion(380, 280, 64, 64)
+        repeat = 3 if n >= 10000 else 5
+
+        def paint(region):
+            target.fill(QtCore.Qt.transparent)
+            overlay.render(target, QtCore.QPoint(), region, flags)
+
+        def immediate():
+            paint(full)
+
+        def cold():
+            overlay._lines_layer = None
+            paint(full)
+
+        def warm():
+            paint(full)
+
+        def small():
+            paint(dirty)
+
+        ruler.RETAINED_RENDERING = False
+        results[f"paint.immediate.n{n}"] = _measure(immediate, repeat=repeat)
+        ruler.RETAINED_RENDERING = True
+        results[f"paint.retained_cold.n{n}"] = _measure(cold, repeat=repeat)
+        results[f"paint.retained_warm.n{n}"] = _measure(warm, number=10, repeat=repeat)
+        results[f"paint.retained_dirty.n{n}"] = _measure(small, number=10, repeat=repeat)
+        overlay.close()
+    ruler.RETAINED_RENDERING = retained
+    return results
+
+
+def bench_arrow(app):
+    overlay = _make_overlay([])
+    image = QtGui.QImage(800, 600, QtGui.QImage.Format_ARGB32_Premultiplied)
+    image.fill(QtCore.Qt.transparent)
+    painter = QtGui.QPainter(image)
+    painter.setRenderHint(QtGui.QPainter.Antialiasing)
+    segments = _random_segments(1000, 800, 600)
+
+    def arrows():
+        for x1, y1, x2, y2 in segments:
+            overlay.draw_arrow(painter, x1, y1, x2, y2)
+
+    per_call = _measure(arrows) / len(segments)
+    painter.end()
+    overlay.close()
+    return {"arrow": per_call}
+
+
+def bench_dispatch(app, events=200000):
+    results = bench_hook_dispatch(app, events)
+    return {
+        "dispatch." + label.replace(" ", "_").replace("(", "").replace(")", "").replace("/", "_"): ns / 1000.0
+        for (label, impl), ns in results.items() if impl == "fast"
+    }
+
+
+def bench_hotkeys(app, events=100000):
+    """Разбор нажатия в потоке хука: HotkeyMatcher.key_down/key_up на событие."""
+    matcher = ruler.HotkeyMatcher()
+    fired = []
+    matcher.compile({combo: (lambda: fired.append(1)) for combo in ruler.HOTKEYS})
+    vk = ruler.VK_CODES
+    now = time.perf_counter()
+    ctrl, shift = 0xA2, 0xA0
+
+    def plain():
+        for _ in range(events // 2):
+            matcher.key_down(vk["w"], now)
+            matcher.key_up(vk["w"])
+
+    def hotkey():
+        for _ in range(events // 2):
+            matcher.key_down(vk["c"], now)
+            matcher.key_up(vk["c"])
+
+    def sequence():
+        for _ in range(events // 2):
+            matcher.key_down(vk["-"], now)
+            matcher.key_down(vk["="], now)
+
+    def modifier():
+        for _ in range(events // 2):
+            matcher.key_down(ctrl, now)
+            matcher.key_up(ctrl)
+
+    def chord():
+        for _ in range(events // 4):
+            matcher.key_down(ctrl, now)
+            matcher.key_down(shift, now)
+            matcher.key_down(vk["q"], now)
+            matcher.key_up(ctrl)
+
+    results = {
+        "hotkeys.plain_key": _measure(plain) / events,
+        "hotkeys.hotkey": _measure(hotkey) / events,
+        "hotkeys.sequence_step": _measure(sequence) / events,
+        "hotkeys.modifier": _measure(modifier) / events,
+        "hotkeys.chord_event": _measure(chord) / events,
+    }
+    matcher.key_up(shift)
+    return results
+
+
+def bench_geometry(app, count=10000):
+    segments = _random_segments(count, 1920, 1080)
+    distance = ruler.OverlayWindow._distance_in_pixels
+    bearing = ruler.OverlayWindow._bearing_deg
+    scale = 2.0
+
+    def scalar():
+        for x1, y1, x2, y2 in segments:
+            distance(x1, y1, x2, y2) * scale
+            bearing(x1, y1, x2, y2)
+
+    store = ruler.SegmentStore()
+    for segment in segments:
+        store.add(*segment)
+
+    def batch():
+        store._computed = 0  # пересчитать всё, а не только новые строки
+        store.metrics(scale)
+
+    return {
+        f"geometry.scalar.n{count}": _measure(scalar),
+        f"geometry.batch.n{count}": _measure(batch, number=10),
+    }
+
+
+def bench_labels(app, sizes=(100, 1000)):
+    """
+    Подписи отрезков (LabelCache): полная перерисовка без слоя с готовыми
+    QStaticText против сборки всех подписей заново, и кадр предпросмотра,
+    когда курсор не изменил подпись.
+    """
+    results = {}
+    retained = ruler.RETAINED_RENDERING
+    ruler.RETAINED_RENDERING = False
+    for n in sizes:
+        overlay = _make_overlay(_random_segments(n, 800, 600))
+        overlay.resize(800, 600)
+        target = QtGui.QImage(overlay.size(), QtGui.QImage.Format_ARGB32_Premultiplied)
+        flags = QtWidgets.QWidget.RenderFlags(QtWidgets.QWidget.DrawWindowBackground)
+        full = QtGui.QRegion(overlay.rect())
+
+        def paint():
+            target.fill(QtCore.Qt.transparent)
+            overlay.render(target, QtCore.QPoint(), full, flags)
+
+        def cold():
+            overlay.labels.clear()
+            paint()
+
+        paint()
+        results[f"labels.paint_cached.n{n}"] = _measure(paint, repeat=3)
+        results[f"labels.paint_rebuilt.n{n}"] = _measure(cold, repeat=3)
+        overlay.close()
+
+    overlay = _make_overlay([])
+    overlay.resize(800, 600)
+    overlay.first_point = (100.0, 100.0)
+    overlay.preview_point = (400.0, 300.0)
+    overlay._preview_label()
+    results["labels.preview_rect"] = _measure(overlay._preview_rect, number=1000)
+    overlay.close()
+    ruler.RETAINED_RENDERING = retained
+    return results
+
+
+def bench_fan(app, sizes=(10, 1000)):
+    """
+    Веер дальностей: пакетный пересчёт таблицы при сдвиге начала, повторный
+    запрос без изменений (кэш) и обновление строк таблицы в панели.
+    """
+    results = {}
+    rng = random.Random(2)
+    for n in sizes:
+        overlay = _make_overlay([])
+        overlay.toggleFan()
+        overlay.fan.set_origin(800.0, 450.0)
+        for _ in range(n):
+            overlay.fan.add(rng.uniform(0, 1600), rng.uniform(0, 900))
+        shifts = iter(range(10 ** 9))
+
+        def moved():
+            overlay.fan.set_origin(800.0 + next(shifts) % 7, 450.0)
+            overlay.fan.table(overlay.scale_factor)
+
+        results[f"fan.table_moved.n{n}"] = _measure(moved, number=100)
+        results[f"fan.table_cached.n{n}"] = _measure(lambda: overlay.fan.table(overlay.scale_factor), number=1000)
+
+        def refresh():
+            overlay.fan.set_origin(800.0 + next(shifts) % 7, 450.0)
+            overlay._refreshFanTable(show=True)
+
+        results[f"fan.panel_refresh.n{n}"] = _measure(refresh, number=100)
+        overlay.close()
+    return results
+
+
+def bench_mask(app, sizes=(10, 100, 1000)):
+    """
+    Маска окна (REGION_MASK): доля экрана, которую приходится компоновать,
+    цена пересборки и инкрементального расширения маски, и полная
+    перерисовка окна в пределах маски против всего окна.
+    """
+    results = {}
+    rng = random.Random(1)
+    for n in sizes:
+        segments = []
+        for _ in range(n):
+            x1, y1 = rng.uniform(0, 1600), rng.uniform(0, 900)
+            angle, length = rng.uniform(0, 2 * 3.14159), rng.uniform(20, 150)
+            segments.append((x1, y1, x1 + length * math.cos(angle), y1 + length * math.sin(angle)))
+        overlay = _make_overlay(segments)
+        overlay.resize(1600, 900)
+        overlay._rebuildMask()
+        mask = QtGui.QRegion(overlay._mask_region)
+        target = QtGui.QImage(overlay.size(), QtGui.QImage.Format_ARGB32_Premultiplied)
+        flags = QtWidgets.QWidget.RenderFlags(QtWidgets.QWidget.DrawWindowBackground)
+        full = QtGui.QRegion(overlay.rect())
+        overlay._sync_lines_layer()
+
+        def render(region):
+            target.fill(QtCore.Qt.transparent)
+            overlay.render(target, QtCore.QPoint(), region, flags)
+
+        extra = QtCore.QRect(900, 500, 120, 40)
+
+        def add():
+            overlay._segments_region = base
+            overlay._addToMask(extra)
+
+        base = overlay._segments_region
+        results[f"mask.area_pct.n{n}"] = overlay.maskSummary()["area_pct"]
+        results[f"mask.rebuild.n{n}"] = _measure(overlay._rebuildMask, repeat=3)
+        results[f"mask.add.n{n}"] = _measure(add, number=20)
+        results[f"mask.repaint_full.n{n}"] = _measure(lambda: render(full), repeat=3)
+        results[f"mask.repaint_masked.n{n}"] = _measure(lambda: render(mask), repeat=3)
+        # Удаление отрезка: слой и маска чинятся только в его области
+        ids = overlay.segments.ids().tolist()
+        results[f"mask.delete.n{n}"] = _measure(lambda: overlay._removeSegmentFromLayer(ids.pop()),
+                                                number=max(1, n // 20), repeat=3)
+        overlay.close()
+    return results
+
+
+def _synthetic_minimap(size=360, spacing=36.0, seed=0, icons=True):
+    """
+    Картинка «под миникарту»: плавный рельеф (сумма низкочастотных волн),
+    дороги, значки, шум матрицы и полупрозрачные тёмные линии сетки с шагом
+    spacing (дробный шаг округляется до пикселя, как на реальном экране).
+    """
+    rng = np.random.default_rng(seed)
+    yy, xx = np.mgrid[0:size, 0:size].astype(np.float32)
+    base = np.array((96, 112, 72), dtype=np.float32)
+    image = np.broadcast_to(base, (size, size, 3)).copy()
+    for _ in range(6):
+        angle = rng.uniform(0, np.pi)
+        period = rng.uniform(60, 300)
+        phase = rng.uniform(0, 2 * np.pi)
+        wave = np.sin((xx * np.cos(angle) + yy * np.sin(angle)) * 2 * np.pi / period + phase)
+        image += wave[..., None] * rng.uniform(-18, 18, 3).astype(np.float32)
+    for _ in range(4):
+        x0, y0, x1, y1 = rng.uniform(0, size, 4)
+        t = np.linspace(0, 1, size * 2)
+        px = np.clip((x0 + (x1 - x0) * t).astype(int), 0, size - 2)
+        py = np.clip((y0 + (y1 - y0) * t).astype(int), 0, size - 2)
+        for dx in (0, 1):
+            image[py, px + dx] = (150, 140, 120)
+    for _ in range(8 if icons else 0):
+        x, y = rng.integers(0, size - 10, 2)
+        image[y:y + 8, x:x + 8] = rng.choice(((200, 40, 40), (40, 90, 220), (230, 230, 230)))
+    offset = rng.uniform(0, spacing)
+    lines = np.round(offset + spacing * np.arange(int(size / spacing) + 1)).astype(int)
+    lines = lines[lines < size]
+    image[:, lines] *= 0.55
+    image[lines, :] *= 0.55
+    image += rng.normal(0, 4, image.shape).astype(np.float32)
+    return np.clip(image, 0, 255).astype(np.uint8)
+
+
+def _rendered_minimap(size, spacing, dpi=1.0, seed=0):
+    """
+    Снимок «как с экрана»: _synthetic_minimap в логических px с подписями
+    квадратов (буквы сверху, цифры слева) и рамкой, как у миникарты в игре,
+    увеличенный в dpi раз со сглаживанием — при дробном масштабе Windows
+    линии сетки размываются на два пикселя. Шаг сетки на снимке — spacing.
+    """
+    logical = int(round(size / dpi))
+    image = ruler.array_to_qimage(_synthetic_minimap(logical, spacing / dpi, seed=seed)).copy()
+    painter = QtGui.QPainter(image)
+    font = QtGui.QFont("Sans")
+    font.setPixelSize(max(8, int(spacing / dpi / 4)))
+    painter.setFont(font)
+    painter.setPen(QtGui.QColor(235, 235, 225))
+    step = spacing / dpi
+    for i in range(int(logical / step)):
+        painter.drawText(QtCore.QPointF(i * step + step / 2 - 3, 10), chr(ord("A") + i % 26))
+        painter.drawText(QtCore.QPointF(2, i * step + step / 2 + 4), str(i + 1))
+    painter.setPen(QtGui.QPen(QtGui.QColor(20, 20, 20), 2))
+    painter.drawRect(1, 1, logical - 2, logical - 2)
+    painter.end()
+    if dpi != 1.0:
+        image = image.scaled(size, size, QtCore.Qt.IgnoreAspectRatio, QtCore.Qt.SmoothTransformation)
+    return image
+
+
+def bench_loupe(app):
+    """Лупа: всё, что делает поток лупы на кадр, и перерисовка самой лупы."""
+    results = {}
+    r = ruler.LOUPE_RADIUS
+    minimap = _synthetic_minimap(360)
+    crop = minimap[100 - r:100 + r + 1, 100 - r:100 + r + 1].copy()
+    luts = ruler._marker_luts()
+    results["loupe.snap"] = _measure(lambda: ruler.snap_point(crop, r, r, luts=luts), number=20)
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "minimap.png")
+        ruler.array_to_qimage(minimap).save(path)
+        grabber = ruler.ImageFileGrabber(path, origin=(0, 0))
+        region = (100 - r, 100 - r, 2 * r + 1, 2 * r + 1)
+        results["loupe.grab_region"] = _measure(lambda: grabber.grab_screen(region), number=100)
+        loupe_grabber = ruler.LoupeGrabber(grabber)
+        positions = [(100 + i % 7, 100 + i % 5) for i in range(35)]
+        frames = []
+
+        def feed():
+            for pos in positions:
+                frames.append(loupe_grabber.feed(pos))
+                loupe_grabber._previous = None  # каждый кадр — новый
+
+        results["loupe.frame"] = _measure(feed) / len(positions)
+
+    widget = ruler.LoupeWidget(None)
+    widget.setFrame(frames[-1])
+    target = QtGui.QImage(widget.size(), QtGui.QImage.Format_ARGB32_Premultiplied)
+    results["loupe.paint"] = _measure(lambda: widget.render(target), number=20)
+    return results
+
+
+def bench_grid(app, sizes=(360, 600)):
+    results = {}
+    for size in sizes:
+        minimap = _synthetic_minimap(size, spacing=size / 10.3)
+        results[f"grid.detect.{size}px"] = _measure(lambda: ruler.detect_grid_spacing(minimap), number=5)
+        # Дешёвые ступени MinimapWatcher, которыми обходится большинство снимков
+        results[f"grid.watch_thumbnail.{size}px"] = _measure(
+            lambda: ruler.MinimapWatcher._thumbnail(minimap), number=100
+        )
+        results[f"grid.watch_signature.{size}px"] = _measure(
+            lambda: ruler.MinimapWatcher._grid_signature(minimap), number=20
+        )
+    return results
+
+
+def run_grid_corpus(args):
+    """
+    Проверка автокалибровки на корпусе: каталог с PNG-снимками миникарты и
+    expected.json {"файл.png": шаг сетки в px}. Ошибка больше --tolerance
+    (доля шага) или «сетка не найдена» — провал; код выхода 1.
+    """
+    expected_path = os.path.join(args.corpus, "expected.json")
+    if args.synthesize:
+        os.makedirs(args.corpus, exist_ok=True)
+        rng = random.Random(args.seed)
+        expected = {}
+        for i in range(args.synthesize):
+            size = rng.choice((300, 360, 450, 600))
+            dpi = rng.choice((1.0, 1.25, 1.5))
+            spacing = size / rng.uniform(6, 12)
+            name = f"synthetic_{i:03d}_{size}px_{int(dpi * 100)}dpi.png"
+            _rendered_minimap(size, spacing, dpi, seed=args.seed + i).save(os.path.join(args.corpus, name))
+            expected[name] = round(spacing, 3)
+        with open(expected_path, "w", encoding="utf-8") as f:
+            json.dump(expected, f, indent=2)
+
+    with open(expected_path, encoding="utf-8") as f:
+        expected = json.load(f)
+    failures = 0
+    print(f"{'image':<36}{'expected':>10}{'found':>10}{'error':>8}{'conf':>6}{'ms':>8}")
+    for name, spacing in sorted(expected.items()):
+        pixels = ruler.ImageFileGrabber(os.path.join(args.corpus, name)).grab(None)
+        start = time.perf_counter()
+        found, confidence = ruler.detect_grid_spacing(pixels)
+        ms = (time.perf_counter() - start) * 1000
+        error = abs(found - spacing) / spacing if found else float("inf")
+        ok = error <= args.tolerance
+        failures += not ok
+        found_text = f"{found:.2f}" if found else "-"
+        print(f"{name:<36}{spacing:>10.2f}{found_text:>10}{error:>8.1%}{confidence:>6.2f}{ms:>8.2f}"
+              + ("" if ok else "  FAIL"))
+    print(f"{len(expected) - failures}/{len(expected)} within {args.tolerance:.0%}")
+    return 1 if failures else 0
+
+
+def _synthetic_marker_frames(count, size=360, seed=0, repeat_every=3):
+    """
+    Последовательность снимков миникарты с движущимися метками: своя белая
+    стрелка, неподвижный жёлтый пинг и красные противники. Каждый
+    repeat_every-й кадр повторяет предыдущий (захват чаще, чем меняется игра).
+    """
+    rng = np.random.default_rng(seed)
+    base = _synthetic_minimap(size, spacing=size / 10.0, seed=seed, icons=False)
+    colors = {kind: color for kind, (color, _) in ruler.MARKER_COLORS.items()}
+    player = rng.uniform(size * 0.3, size * 0.7, 2)
+    ping = rng.uniform(20, size - 20, 2)
+    enemies = rng.uniform(20, size - 20, (3, 2))
+    frames = []
+    for i in range(count):
+        if frames and repeat_every and i % repeat_every == 0:
+            frames.append(frames[-1])
+            continue
+        player = np.clip(player + rng.normal(0, 1.5, 2), 20, size - 20)
+        enemies = np.clip(enemies + rng.normal(0, 2.0, enemies.shape), 20, size - 20)
+        frame = base.copy()
+        x, y = player.astype(int)
+        for row in range(9):  # стрелка-треугольник остриём вверх
+            half = row // 2
+            frame[y - 4 + row, x - half:x + half + 1] = colors["player"]
+        x, y = ping.astype(int)
+        frame[y - 3:y + 4, x - 3:x + 4] = colors["ping"]
+        for x, y in enemies.astype(int):
+            frame[y - 2:y + 3, x - 2:x + 3] = colors["enemy"]
+        frames.append(frame)
+    return frames
+
+
+def _replay_markers(frames):
+    """Прогоняет кадры через MarkerTracker.feed: (трекер, результаты, время на кадр в мкс)."""
+    tracker = ruler.MarkerTracker(None, (0, 0, 0, 0))
+    found = []
+    start = time.perf_counter()
+    for pixels in frames:
+        found.append(tracker.feed(pixels))
+    per_frame = (time.perf_counter() - start) / len(frames) * 1e6
+    tracker._pool.shutdown()
+    return tracker, found, per_frame
+
+
+def bench_markers(app, size=360):
+    frames = _synthetic_marker_frames(60, size)
+    tracker, _, per_frame = _replay_markers(frames)
+    same = ruler.MarkerTracker(None, (0, 0, 0, 0))
+    same.feed(frames[0].copy())
+    result = {
+        f"markers.sequence.{size}px": per_frame,
+        f"markers.process.{size}px": statistics.median(tracker.process_ms) * 1000,
+        f"markers.same_frame.{size}px": _measure(lambda: same.feed(frames[0]), number=100),
+    }
+    same._pool.shutdown()
+    return result
+
+
+def run_markers(args):
+    """
+    Слежение за метками на записанной последовательности снимков миникарты
+    (main.py --record-minimap DIR): время на кадр, доля пропущенных кадров и
+    найденные метки по кадрам.
+    """
+    if args.synthesize:
+        os.makedirs(args.frames, exist_ok=True)
+        for i, pixels in enumerate(_synthetic_marker_frames(args.synthesize, seed=args.seed)):
+            ruler.array_to_qimage(pixels).save(os.path.join(args.frames, f"frame_{i:06d}.png"))
+    names = sorted(name for name in os.listdir(args.frames) if name.lower().endswith(".png"))
+    frames = []
+    for name in names:
+        grabber = ruler.ImageFileGrabber(os.path.join(args.frames, name))
+        frames.append(grabber.grab(None))
+    tracker, found, per_frame = _replay_markers(frames)
+    if args.verbose:
+        for name, frame in zip(names, found):
+            if frame is not None:
+                player = "-" if frame.player is None else f"{frame.player[0]:.0f},{frame.player[1]:.0f}"
+                targets = ", ".join(f"{kind} {x:.0f},{y:.0f}" for kind, x, y in frame.targets)
+                print(f"{name}: player {player}; {targets}")
+    print(", ".join(f"{k}={v}" for k, v in tracker.stats.items()))
+    if tracker.process_ms:
+        ordered = sorted(tracker.process_ms)
+        print(f"process p50 {ordered[len(ordered) // 2]:.2f} ms, max {ordered[-1]:.2f} ms;"
+              f" {per_frame:.0f} us per frame over {len(frames)} frames")
+    return 0
+
+
+def _synthetic_session(count, width=1600, height=900, seed=0):
+    """Журнал сессии: заголовок, масштаб и `count` отрезков, каждый десятый — удалён."""
+    records = [{"t": 0.0, "kind": "session", "version": 1, "screen": [width, height], "scale": 2.0}]
+    for i, (x1, y1, x2, y2) in enumerate(_random_segments(count, width, height, seed)):
+        records.append({"t": i * 0.5, "kind": "segment", "id": i, "x1": x1, "y1": y1, "x2": x2, "y2": y2})
+        if i % 10 == 9:
+            records.append({"t": i * 0.5 + 0.1, "kind": "segment_deleted", "id": i - 5})
+    return records
+
+
+def _replay(records, repeat=3):
+    """Медианы (применение записей, отрисовка) проигрывания журнала, мкс."""
+    overlay = ruler.OverlayWindow()
+    header = records[0] if records and records[0]["kind"] == "session" else {}
+    overlay.resize(*header.get("screen", (1600, 900)))
+
+    def apply():
+        overlay.segments.clear()
+        ruler.replay_session(overlay, records)
+
+    applied = _measure(apply, repeat=repeat)
+    rendered = _measure(lambda: ruler.render_overlay(overlay), repeat=repeat)
+    overlay.close()
+    return applied, rendered
+
+
+def bench_session(app, sizes=(100, 1000)):
+    """
+    Журнал сессии: цена SessionLog.log в GUI-потоке (на запись, поток записи
+    пишет во временный файл) и проигрывание журнала без окна.
+    """
+    results = {}
+    log = ruler.SessionLog()
+    with tempfile.TemporaryDirectory() as tmp:
+        log.open(os.path.join(tmp, "session.jsonl"), screen=[1600, 900])
+
+        def record():
+            for i in range(1000):
+                log.log("segment", id=i, x1=1.0, y1=2.0, x2=3.0, y2=4.0, px=2.83, m=5.66, bearing=45.0)
+
+        results["session.log"] = _measure(record) / 1000
+        log.close()
+    for n in sizes:
+        applied, rendered = _replay(_synthetic_session(n))
+        results[f"session.replay_apply.n{n}"] = applied
+        results[f"session.replay_render.n{n}"] = rendered
+    return results
+
+
+def bench_startup(app, repeat=3):
+    """
+    Холодный старт: процесс main.py целиком (импорт, QApplication, окно, ввод)
+    до выхода по --exit-after-startup, и создание окна с панелью и без неё.
+    """
+    results = {}
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "main.py")
+    env = dict(os.environ, QT_QPA_PLATFORM="offscreen")
+    with tempfile.TemporaryDirectory() as tmp:
+        base = [sys.executable, script, "--input-backend", "synthetic", "--synthetic-drags", "0",
+                "--no-session-log", "--exit-after-startup", "--scale-factor", "2",
+                "--calibration-file", os.path.join(tmp, "calibration.json")]
+        for label, extra in (("fast", []), ("sequential", ["--no-fast-start"])):
+            results[f"startup.process_{label}"] = _measure(
+                lambda: subprocess.run(base + extra, env=env, cwd=tmp, check=True,
+                                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL),
+                repeat=repeat,
+            )
+
+    fast_start = ruler.FAST_START
+    for label, fast in (("deferred_panel", True), ("with_panel", False)):
+        ruler.FAST_START = fast
+        overlays = []
+
+        def create():
+            overlays.append(ruler.OverlayWindow())
+
+        results[f"startup.overlay_{label}"] = _measure(create)
+        for overlay in overlays:
+            overlay.close()
+    ruler.FAST_START = fast_start
+    return results
+
+
+def run_replay(args):
+    """Проигрывание сохранённого журнала сессии как воспроизводимого входа замера."""
+    records = ruler.load_session_log(args.session)
+    applied, rendered = _replay(records, repeat=args.repeat)
+    kinds = {}
+    for record in records:
+        kinds[record["kind"]] = kinds.get(record["kind"], 0) + 1
+    print(", ".join(f"{k}={v}" for k, v in kinds.items()))
+    print(f"apply {applied:.0f} us, render {rendered:.0f} us (median of {args.repeat})")
+    return 0
+
+
+SUITE = {
+    "paint": bench_paint,
+    "arrow": bench_arrow,
+    "dispatch": bench_dispatch,
+    "hotkeys": bench_hotkeys,
+    "geometry": bench_geometry,
+    "grid": bench_grid,
+    "markers": bench_markers,
+    "mask": bench_mask,
+    "labels": bench_labels,
+    "fan": bench_fan,
+    "session": bench_session,
+    "loupe": bench_loupe,
+    "startup": bench_startup,
+}
+
+
+def compare(results, baseline, threshold):
+    """Печатает сравнение с базой; возвращает список регрессий."""
+    regressions = []
+    print(f"{'case':<32}{'baseline, us':>14}{'now, us':>12}{'change':>9}")
+    for name, value in results.items():
+        base = baseline.get(name)
+        if base is None:
+            print(f"{name:<32}{'-':>14}{value:>12.2f}{'new':>9}")
+            continue
+        change = (value - base) / base if base else 0.0
+        flag = "  REGRESSION" if change > threshold else ""
+        print(f"{name:<32}{base:>14.2f}{value:>12.2f}{change:>+9.0%}{flag}")
+        if flag:
+            regressions.append(name)
+    return regressions
+
+
+def run_suite(app, args):
+    cases = args.only.split(",") if args.only else list(SUITE)
+    results = {}
+    for case in cases:
+        results.update(SUITE[case](app))
+
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)["results"]
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print(f"{len(regressions)} regression(s) over +{args.threshold:.0%}: {', '.join(regressions)}")
+    else:
+        regressions = []
+        for name, value in results.items():
+            print(f"{name:<32}{value:>12.2f} us")
+
+    if args.save_baseline:
+        with open(args.save_baseline, "w", encoding="utf-8") as f:
+            json.dump({
+                "platform": platform.platform(),
+                "python": platform.python_version(),
+                "qt_platform": QtGui.QGuiApplication.platformName(),
+                "results": results,
+            }, f, indent=2)
+        print(f"Baseline saved to {args.save_baseline}")
+    return 1 if regressions else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest="case", required=True)
+    hook = sub.add_parser("hook-loop", help="CPU в простое и задержка хук -> слот (Windows)")
+    hook.add_argument("--seconds", type=float, default=10.0)
+    hook.add_argument("--samples", type=int, default=200)
+    dispatch = sub.add_parser("hook-dispatch", help="стоимость вызова on_mouse_event на событие")
+    dispatch.add_argument("--events", type=int, default=200000)
+    suite = sub.add_parser("suite", help="paint / arrow / dispatch / geometry / grid с JSON-базой")
+    suite.add_argument("--only", metavar="CASES", help=f"через запятую из: {', '.join(SUITE)}")
+    suite.add_argument("--save-baseline", metavar="FILE")
+    suite.add_argument("--baseline", metavar="FILE", help="сравнить с сохранённой базой")
+    suite.add_argument("--threshold", type=float, default=0.2,
+                       help="допустимое ухудшение относительно базы (0.2 = +20%%)")
+    corpus = sub.add_parser("grid-corpus", help="автокалибровка на корпусе снимков миникарты")
+    corpus.add_argument("corpus", metavar="DIR", help="PNG-снимки и expected.json")
+    corpus.add_argument("--tolerance", type=float, default=0.02,
+                        help="допустимая ошибка шага сетки (0.02 = 2%%)")
+    corpus.add_argument("--synthesize", type=int, default=0, metavar="N",
+                        help="сначала сгенерировать в DIR N синтетических снимков")
+    corpus.add_argument("--seed", type=int, default=0)
+    markers = sub.add_parser("markers", help="слежение за метками на записанной последовательности снимков")
+    markers.add_argument("frames", metavar="DIR", help="PNG-кадры миникарты по порядку имён")
+    markers.add_argument("--synthesize", type=int, default=0, metavar="N",
+                         help="сначала сгенерировать в DIR N синтетических кадров")
+    markers.add_argument("--seed", type=int, default=0)
+    markers.add_argument("--verbose", action="store_true", help="печатать найденные метки по кадрам")
+    replay = sub.add_parser("replay", help="проигрывание журнала сессии (main.py --session-log)")
+    replay.add_argument("session", metavar="FILE", help="журнал сессии JSONL")
+    replay.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    if args.case != "hook-loop":
+        os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+    app = QtWidgets.QApplication(sys.argv[:1])
+
+    if args.case == "hook-loop":
+        if sys.platform != "win32":
+            sys.exit("hook-loop: нужен Windows (pyWinhook + pythoncom).")
+        for mode in ("poll", "blocking"):
+            r = bench_hook_loop(app, mode, args.seconds, args.samples)
+            line = f"{r['mode']:>8}: idle CPU {r['idle_cpu_percent']:6.2f}%"
+            if r["samples"]:
+                line += (
+                    f", hook->slot p50 {r['latency_us_p50']:.0f} us,"
+                    f" p95 {r['latency_us_p95']:.0f} us, max {r['latency_us_max']:.0f} us"
+                    f" (n={r['samples']})"
+                )
+            print(line)
+
+    elif args.case == "hook-dispatch":
+        results = bench_hook_dispatch(app, args.events)
+        print(f"{'event':<18}{'legacy, ns':>12}{'fast, ns':>12}")
+        for label in dict.fromkeys(label for label, _ in results):
+            print(f"{label:<18}{results[(label, 'legacy')]:>12.0f}{results[(label, 'fast')]:>12.0f}")
+
+    elif args.case == "suite":
+        sys.exit(run_suite(app, args))
+
+    elif args.case == "grid-corpus":
+        sys.exit(run_grid_corpus(args))
+
+    elif args.case == "markers":
+        sys.exit(run_markers(args))
+
+    elif args.case == "replay":
+        sys.exit(run_replay(args))
+
+
+if __name__ == "__main__":
+    main()
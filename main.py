@@ -3,13 +3,46 @@ import math
 import threading
 import logging
 import time
+_PROCESS_T0 = time.perf_counter()  # начало загрузки модуля (отсчёт --profile-startup)
+import json
+import random
+import argparse
+import os
+from array import array
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
-import pythoncom
-import pyWinhook as pwh
-import keyboard
-
+import numpy as np
 from PyQt5 import QtCore, QtGui, QtWidgets
 
+# Модули Windows (pywin32, pyWinhook) грузятся лениво, в
+# import_windows_modules(): при FAST_START — в фоновом потоке, параллельно
+# с созданием окна. Пока не загружены (и всегда не на Windows) — None.
+pythoncom = pwh = win32api = win32con = win32gui = win32ui = None
+_windows_import_lock = threading.Lock()
+
+
+def import_windows_modules():
+    """Загружает модули Windows один раз; False — их нет (Linux CI, бенчмарки)."""
+    global pythoncom, pwh, win32api, win32con, win32gui, win32ui
+    with _windows_import_lock:
+        if pwh is not None:
+            return True
+        try:
+            import pythoncom as _pythoncom
+            import pyWinhook as _pwh
+            import win32api as _win32api
+            import win32con as _win32con
+            import win32gui as _win32gui
+            import win32ui as _win32ui
+        except ImportError:
+            return False
+        win32api, win32con, win32gui, win32ui = _win32api, _win32con, _win32gui, _win32ui
+        pythoncom = _pythoncom
+        pwh = _pwh  # последним: по нему проверяется, что загружено всё
+        return True
+
+
 ###############################################################################
 # ЛОГИРОВАНИЕ
 ###############################################################################
@@ -26,162 +59,2760 @@ logging.basicConfig(
 ###############################################################################
 overlay = None
 
-# Хук мыши и поток
+# Активный бэкенд ввода (см. InputBackend) и поток его фоновой установки (FAST_START)
+input_backend = None
+_input_startup_thread = None
+
+# Источник снимков экрана для автокалибровки (см. ScreenGrabber)
+screen_grabber = None
+
+# Хук ввода (мышь и клавиатура в одном потоке)
 hm = None
-hook_mouse_thread = None
-MOUSE_HOOK_RUNNING = True  # флаг, по которому остановим поток
+hook_input_thread = None
+INPUT_HOOK_RUNNING = True  # флаг, по которому остановим поток
+HOOK_THREAD_ID = None      # Win32-идентификатор потока хука (для WM_QUIT)
 
-# Идентификаторы горячих клавиш
-TOGGLE_HOTKEY_ID = None       # '=' — вкл/выкл измерений
-CALIBRATE_HOTKEY_ID = None    # 'c' — калибровка заново
-EXIT_HOTKEY_ID = None         # 'ctrl+shift+q' — закрыть оверлей
-CLEAR_LINES_HOTKEY_ID = None  # '-,=' — очистить линии (сначала '-', потом '=')
+# Режим цикла сообщений в потоке хука:
+#   "blocking" — GetMessage-цикл (pythoncom.PumpMessages): 0% CPU в простое,
+#                поток просыпается сразу по событию, выход — по WM_QUIT;
+#   "poll"     — старый цикл PumpWaitingMessages + sleep(0.0001).
+INPUT_HOOK_PUMP_MODE = "blocking"
+
+# Быстрый старт: модули ввода грузятся и хоткеи ставятся в фоне параллельно
+# с созданием окна, а панель (стили, кнопки) строится после первого кадра.
+# False — всё по очереди в GUI-потоке, как раньше.
+FAST_START = True
 
 # Порог расстояния в пикселях, чтобы определить: это был drag или просто клик
 MIN_DRAG_DISTANCE = 10
 
+# Быстрые кнопки калибровки (м): типичные размеры квадрата сетки миникарты
+CALIBRATION_PRESETS = (100, 200, 250, 300, 500)
+INFO_PANEL_WIDTH = 350
+INFO_PANEL_HEIGHT = 160
+
+# Каталог настроек и сохранённые калибровки (см. CalibrationStore)
+CONFIG_DIR = os.path.join(os.path.expanduser("~"), ".wt_ruler")
+CALIBRATION_STORE_PATH = os.path.join(CONFIG_DIR, "calibration.json")
+# Профили масштаба миникарты; переключаются хоткеем 'ctrl+shift+p'
+CALIBRATION_PROFILES = ("default", "zoom 1", "zoom 2", "zoom 3")
+# Журнал сессии (JSONL, см. SessionLog): по файлу на запуск
+SESSION_LOG_DIR = os.path.join(CONFIG_DIR, "sessions")
+SESSION_LOG_MAX_PENDING = 10000    # записей в очереди, дальше старые отбрасываются
+SESSION_LOG_BATCH = 256            # столько записей будят поток записи раньше срока
+SESSION_LOG_FLUSH_INTERVAL = 1.0   # с между сбросами на диск
+SESSION_LOG_KEEP = 20              # журналов в SESSION_LOG_DIR, старые удаляются при старте
+
+# Автокалибровка по сетке миникарты (хоткей 'ctrl+shift+g', см. detect_grid_spacing)
+MINIMAP_REGION = None       # (x, y, w, h) в физических px; None — квадрат в правом нижнем углу
+MINIMAP_FRACTION = 0.3      # сторона квадрата по умолчанию — доля высоты экрана
+GRID_SQUARE_METERS = 200    # размер квадрата сетки на текущей карте, м
+MIN_GRID_SPACING = 12       # px; более частых линий сетка не даёт
+MIN_GRID_CONFIDENCE = 0.3   # ниже — «сетка не найдена»
+
+# Фоновое слежение за зумом миникарты (см. MinimapWatcher, --watch-minimap)
+MINIMAP_WATCH = False
+MINIMAP_WATCH_HZ = 1.0               # снимков в секунду (не чаще)
+MINIMAP_WATCH_BUDGET = 0.005         # доля одного ядра CPU, не больше
+MINIMAP_THUMB_DIFF = 2.0             # средняя разница миниатюр (0..255), ниже — «тот же кадр»
+MINIMAP_PROFILE_CORRELATION = 0.9    # корреляция спектров профилей линий, выше — «та же сетка»
+MINIMAP_SPACING_TOLERANCE = 0.02     # относительное изменение шага, ниже — шум
+
+# Слежение за метками на миникарте (хоткей 'ctrl+shift+t', см. MarkerTracker).
+# Цвета значков: класс -> (RGB, допуск по каждому каналу). "player" — своя
+# стрелка, от неё меряются дальность и азимут до меток остальных классов.
+MARKER_COLORS = {
+    "player": ((255, 255, 255), 30),   # своя стрелка — белая
+    "ping": ((255, 200, 0), 45),       # метка на карте — жёлтая
+    "enemy": ((230, 40, 40), 45),      # засвеченный противник — красный
+}
+MARKER_MIN_PIXELS = 6       # меньше — шум, а не значок
+MARKER_MAX_PIXELS = 400     # больше — заливка/рельеф, а не значок
+MARKER_TRACK_HZ = 10.0      # снимков миникарты в секунду
+MARKER_WORKERS = 2          # потоков разбора снимка
+MARKER_RECORD_DIR = None    # куда писать изменившиеся снимки (--record-minimap)
+
+# Отрисовка отрезков:
+#   True  — retained: готовые отрезки растеризуются один раз в кэш-слой (QPixmap),
+#           новые дорисовываются поверх, перерисовываются только грязные прямоугольники;
+#   False — immediate: каждый paintEvent заново рисует все отрезки.
+RETAINED_RENDERING = True
+ARROW_SIZE = 10
+
+# Маска окна: видимая (и компонуемая) часть полноэкранного оверлея —
+# только панель, прямоугольники отрезков с подписями, линии слежения и
+# область предпросмотра. False — всё окно, как раньше.
+REGION_MASK = True
+MASK_DRAG_SLACK = 64  # px запаса при расширении маски под предпросмотр
+# Платформы Qt без масок окон: маска считается (для замеров), но не ставится
+MASKLESS_PLATFORMS = ("offscreen", "minimal")
+
+# Живой предпросмотр отрезка во время протяжки ПКМ. Движения мыши хук
+# не пересылает по одному: он лишь запоминает последнюю позицию в
+# _latest_move, а GUI-таймер забирает её не чаще раза за кадр дисплея.
+LIVE_PREVIEW = True
+_preview_tracking = False  # True между ПКМ down и up (пишет поток хука)
+_latest_move = None        # последняя позиция курсора во время протяжки
+
+# Выбор отрезка под курсором (подсветка, Delete — удалить, протяжка ПКМ от
+# конца отрезка — перетащить этот конец). Пока включены измерения, хук
+# запоминает позицию и вне протяжек (_hover_tracking публикует GUI-поток).
+HOVER_SELECT = True
+_hover_tracking = False
+HOVER_RADIUS = 8            # px от курсора до отрезка
+ENDPOINT_GRAB_RADIUS = 10   # px от курсора до конца отрезка
+SEGMENT_GRID_CELL = 64      # размер ячейки пространственного индекса, px
+
+# Веер дальностей (хоткей 'ctrl+shift+f'): одно начало, много целей; таблица
+# в панели из FAN_TABLE_ROWS заранее созданных строк (ближние цели)
+FAN_TABLE_ROWS = 10
+FAN_ROW_HEIGHT = 18  # px
+
+# Лупа (хоткей 'ctrl+shift+m', --loupe): во время протяжки ПКМ — увеличенный
+# снимок малой области у курсора; концы отрезков привязываются к центру
+# метки или пересечению линий сетки, найденным в этом снимке
+LOUPE_RADIUS = 24            # px экрана от курсора до края снимка (снимок 49x49)
+LOUPE_ZOOM = 5               # увеличение
+LOUPE_HZ = 30.0              # снимков в секунду, не чаще
+LOUPE_OFFSET = 24            # px от курсора до лупы
+LOUPE_SNAP_RADIUS = 8        # px; дальше от курсора не привязываем
+LOUPE_SNAP_MAX_AGE = 0.25    # с; более старый кадр лупы для привязки не годится
+LOUPE_IDLE_INTERVAL = 0.1    # с между снимками, пока курсор стоит (кадр не успевает устареть)
+LOUPE_LINE_CONTRAST = 3.0    # во сколько раз линия сетки сильнее медианы профиля
+
+###############################################################################
+# КОЛЬЦЕВОЙ БУФЕР ВВОДА (поток хука -> GUI-поток)
+###############################################################################
+# Типы записей в кольце
+EV_RMB_DOWN = 1
+EV_RMB_UP = 2
+EV_TOGGLE = 3
+EV_CALIBRATE = 4
+EV_CLOSE = 5
+EV_CLEAR = 6
+EV_DELETE = 7
+EV_LATENCY = 8
+EV_PROFILE = 9
+EV_AUTOCAL = 10
+EV_TRACK = 11
+EV_ROUTE = 12
+EV_UNDO = 13
+EV_FAN = 14
+EV_LOUPE = 15
+
+INPUT_RING_CAPACITY = 256  # степень двойки
+
+
+class InputRing:
+    """
+    Кольцевой буфер фиксированных записей (kind, x, y, t_ns): писатели —
+    поток хука и бэкенды ввода, читатель — один (GUI-поток).
+
+    Память выделяется один раз. Писатели меняют только _head и счётчики
+    под коротким замком _push_lock (писателей может быть больше одного, и
+    их чтение-изменение-запись _head иначе перемешались бы); читатель
+    меняет только _tail и замка не берёт — присваивание int под GIL атомарно.
+    Запись сначала заполняется и лишь потом публикуется сдвигом _head.
+    Если кольцо полно, запись отбрасывается: растут dropped и
+    (один раз на эпизод переполнения) overflows.
+    """
+
+    def __init__(self, capacity=INPUT_RING_CAPACITY):
+        if capacity & (capacity - 1):
+            raise ValueError("capacity must be a power of two")
+        self._mask = capacity - 1
+        self._kind = array('b', bytes(capacity))
+        self._x = array('i', [0]) * capacity
+        self._y = array('i', [0]) * capacity
+        self._t = array('q', [0]) * capacity
+        self._head = 0
+        self._tail = 0
+        self._wake_pending = False
+        self._overflowing = False
+        self._push_lock = threading.Lock()
+
+        # Счётчики
+        self.pushed = 0
+        self.dropped = 0
+        self.overflows = 0
+        self.batches = 0
+
+    def push(self, kind, x=0, y=0):
+        """Писатель: добавить запись. False — кольцо полно, запись потеряна."""
+        with self._push_lock:
+            head = self._head
+            if head - self._tail > self._mask:
+                self.dropped += 1
+                if not self._overflowing:
+                    self._overflowing = True
+                    self.overflows += 1
+                return False
+            i = head & self._mask
+            self._kind[i] = kind
+            self._x[i] = x
+            self._y[i] = y
+            self._t[i] = time.perf_counter_ns()
+            self._head = head + 1
+            self._overflowing = False
+            self.pushed += 1
+            return True
+
+    def request_wake(self):
+        """Писатель: True, если GUI-поток ещё не разбужен и будить должен вызывающий."""
+        if self._wake_pending:
+            return False
+        self._wake_pending = True
+        return True
+
+    def drain(self, handler):
+        """
+        Читатель: отдать handler(kind, x, y, t_ns) все опубликованные записи.
+        _tail сдвигается до вызова handler, поэтому вложенный drain (например,
+        из модального диалога внутри обработчика) не обработает запись дважды.
+        """
+        self._wake_pending = False
+        self.batches += 1
+        count = 0
+        while True:
+            tail = self._tail
+            if tail >= self._head:
+                break
+            i = tail & self._mask
+            kind, x, y, t_ns = self._kind[i], self._x[i], self._y[i], self._t[i]
+            self._tail = tail + 1
+            handler(kind, x, y, t_ns)
+            count += 1
+        return count
+
+    def stats(self):
+        return {
+            "pushed": self.pushed,
+            "dropped": self.dropped,
+            "overflows": self.overflows,
+            "batches": self.batches,
+            "pending": self._head - self._tail,
+        }
+
+
+input_ring = InputRing()
+
+
+def post_input(kind, x=0, y=0):
+    """
+    Кладёт событие в кольцо. GUI-поток будится одним queued-вызовом
+    drainInput на всю пачку, а не отдельным invokeMethod на каждое событие.
+    """
+    # Пока окна нет (быстрый старт), запись ждёт в кольце первого drainInput
+    if input_ring.push(kind, x, y) and overlay is not None and input_ring.request_wake():
+        QtCore.QMetaObject.invokeMethod(overlay, "drainInput", QtCore.Qt.QueuedConnection)
+
+###############################################################################
+# ИНСТРУМЕНТАЦИЯ ЗАДЕРЖЕК (ввод -> пиксели)
+###############################################################################
+class LatencyProbe:
+    """
+    Замер пути ПКМ up -> отрезок на экране по этапам (perf_counter_ns):
+      queue    — хук положил запись в кольцо -> GUI-поток начал её обработку;
+      handle   — onMouseRightUp: от начала обработки до вызова update();
+      to_paint — update() -> начало paintEvent;
+      paint    — сам paintEvent (до сброса backing store на экран);
+      total    — хук -> конец paintEvent.
+    По каждому этапу хранится скользящее окно последних `window` замеров,
+    из которого считаются p50/p95/p99 и гистограмма. Выключенный замер
+    стоит одной проверки `enabled` в каждой точке.
+    """
+    STAGES = ("queue", "handle", "to_paint", "paint", "total")
+
+    def __init__(self, window=2048):
+        self.enabled = False
+        self.window = window
+        self.reset()
+
+    def reset(self):
+        self._samples = {stage: deque(maxlen=self.window) for stage in self.STAGES}
+        self._events = deque(maxlen=self.window)  # полные цепочки меток для Chrome trace
+        self._current = None  # метки текущего ПКМ up, ждущего отрисовки
+        self._t0 = time.perf_counter_ns()
+
+    def set_enabled(self, enabled):
+        if enabled and not self.enabled:
+            self.reset()
+        self.enabled = enabled
+
+    # --- точки замера (вызывать только при enabled) ---
+    def begin(self, t_hook_ns):
+        """GUI-поток взял из кольца ПКМ up, записанный хуком в t_hook_ns."""
+        self._current = {"hook": t_hook_ns, "slot": time.perf_counter_ns()}
+
+    def mark_update(self):
+        """Обработчик запросил перерисовку нового отрезка."""
+        if self._current is not None:
+            self._current["update"] = time.perf_counter_ns()
+
+    def end_input(self):
+        """Обработка события закончена; если перерисовка не нужна — цепочка отбрасывается."""
+        if self._current is not None and "update" not in self._current:
+            self._current = None
+
+    def paint_started(self):
+        if self._current is not None and "update" in self._current:
+            self._current["paint"] = time.perf_counter_ns()
+
+    def paint_finished(self):
+        marks = self._current
+        if marks is None or "paint" not in marks:
+            return
+        marks["done"] = time.perf_counter_ns()
+        self._current = None
+        samples = self._samples
+        samples["queue"].append(marks["slot"] - marks["hook"])
+        samples["handle"].append(marks["update"] - marks["slot"])
+        samples["to_paint"].append(marks["paint"] - marks["update"])
+        samples["paint"].append(marks["done"] - marks["paint"])
+        samples["total"].append(marks["done"] - marks["hook"])
+        self._events.append(marks)
+
+    # --- отчёты ---
+    def summary(self):
+        """{этап: {"count", "p50_us", "p95_us", "p99_us", "max_us"}}."""
+        result = {}
+        for stage, values in self._samples.items():
+            if not values:
+                result[stage] = {"count": 0}
+                continue
+            us = np.fromiter(values, dtype=np.float64, count=len(values)) / 1000.0
+            p50, p95, p99 = np.percentile(us, (50, 95, 99))
+            result[stage] = {
+                "count": len(values),
+                "p50_us": round(float(p50), 1),
+                "p95_us": round(float(p95), 1),
+                "p99_us": round(float(p99), 1),
+                "max_us": round(float(us.max()), 1),
+            }
+        return result
+
+    def histogram(self, stage):
+        """Гистограмма этапа по корзинам-степеням двойки: {"<=N us": count}."""
+        values = self._samples[stage]
+        if not values:
+            return {}
+        us = np.fromiter(values, dtype=np.float64, count=len(values)) / 1000.0
+        edges = 2.0 ** np.arange(0, int(np.ceil(np.log2(max(us.max(), 1.0)))) + 2)
+        counts = np.bincount(np.searchsorted(edges, us), minlength=len(edges))
+        return {f"<={int(edge)} us": int(n) for edge, n in zip(edges, counts) if n}
+
+    def export_json(self, path):
+        data = {
+            "summary": self.summary(),
+            "histograms": {stage: self.histogram(stage) for stage in self.STAGES},
+        }
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False, indent=2)
+
+    def export_chrome_trace(self, path):
+        """Формат Chrome trace (chrome://tracing, Perfetto): этап = событие "X"."""
+        spans = (("queue", "hook", "slot", 1), ("handle", "slot", "update", 2),
+                 ("to_paint", "update", "paint", 2), ("paint", "paint", "done", 2))
+        events = [
+            {"name": "thread_name", "ph": "M", "pid": 1, "tid": 1, "args": {"name": "input"}},
+            {"name": "thread_name", "ph": "M", "pid": 1, "tid": 2, "args": {"name": "gui"}},
+        ]
+        for marks in self._events:
+            for name, start, end, tid in spans:
+                events.append({
+                    "name": name, "ph": "X", "pid": 1, "tid": tid,
+                    "ts": (marks[start] - self._t0) / 1000.0,
+                    "dur": (marks[end] - marks[start]) / 1000.0,
+                })
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+
+    def export(self, prefix):
+        """Пишет <prefix>.json (сводка + гистограммы) и <prefix>.trace.json."""
+        self.export_json(prefix + ".json")
+        self.export_chrome_trace(prefix + ".trace.json")
+        logging.info(f"Latency report written to {prefix}.json and {prefix}.trace.json")
+
+
+latency_probe = LatencyProbe()
+
+
+class StartupProfile:
+    """
+    Фазы холодного старта (--profile-startup): время от начала загрузки
+    модуля (_PROCESS_T0) до начала и конца каждой фазы и поток, в котором
+    она шла. Старт считается законченным, когда пройдены все вехи
+    MILESTONES: первый кадр окна, готовая панель и установленный ввод —
+    тогда отчёт уходит в лог (и, при quit_when_done, приложение закрывается).
+    """
+    MILESTONES = ("first_frame", "panel", "input")
+
+    def __init__(self):
+        self.enabled = False
+        self.quit_when_done = False
+        self._phases = []    # (фаза, поток, начало с, конец с)
+        self._reached = {}   # веха -> с от _PROCESS_T0
+        self._lock = threading.Lock()
+        self._reported = False
+
+    def begin(self):
+        return time.perf_counter()
+
+    def end(self, phase, started, finished=None):
+        if not self.enabled:
+            return
+        finished = time.perf_counter() if finished is None else finished
+        with self._lock:
+            self._phases.append((phase, threading.current_thread().name,
+                                 started - _PROCESS_T0, finished - _PROCESS_T0))
+
+    def reach(self, milestone):
+        """Веха пройдена (из любого потока); на последней — отчёт."""
+        if not self.enabled:
+            return
+        with self._lock:
+            self._reached.setdefault(milestone, time.perf_counter() - _PROCESS_T0)
+            done = not self._reported and all(m in self._reached for m in self.MILESTONES)
+            if done:
+                self._reported = True
+        if done:
+            logging.info("Startup profile:\n" + self.report())
+            if self.quit_when_done:
+                # Через close() окна: closeEvent снимает ввод и останавливает
+                # фоновые потоки. Голый quit() оставлял их живыми до выхода
+                # интерпретатора — иногда это падало при разборе Qt-объектов
+                QtCore.QMetaObject.invokeMethod(overlay, "close", QtCore.Qt.QueuedConnection)
+
+    def report(self):
+        with self._lock:
+            phases = sorted(self._phases, key=lambda p: p[2])
+            reached = sorted(self._reached.items(), key=lambda item: item[1])
+        lines = [f"{'phase':<24}{'thread':<16}{'start, ms':>10}{'time, ms':>10}"]
+        for phase, thread, start, end in phases:
+            lines.append(f"{phase:<24}{thread:<16}{start * 1000:>10.1f}{(end - start) * 1000:>10.1f}")
+        lines.extend(f"{'-> ' + milestone:<40}{t * 1000:>10.1f}" for milestone, t in reached)
+        return "\n".join(lines)
+
+
+startup_profile = StartupProfile()
+LATENCY_EXPORT_PREFIX = "latency"  # путь без расширения; меняется --latency-export
+
 ###############################################################################
-# ГЛОБАЛЬНЫЙ ХУК МЫШИ (pyWinhook)
+# ГЛОБАЛЬНЫЙ ХУК ВВОДА (pyWinhook: мышь и клавиатура)
 ###############################################################################
+# Сообщения Windows для мыши (event.Message у pyWinhook)
+WM_MOUSEMOVE = 0x0200
+WM_LBUTTONDOWN = 0x0201
+WM_LBUTTONUP = 0x0202
+WM_RBUTTONDOWN = 0x0204
+WM_RBUTTONUP = 0x0205
+
+# Имена сообщений pyWinhook -> код (для синтетических событий и записей)
+MOUSE_MESSAGE_IDS = {
+    "mouse move": WM_MOUSEMOVE,
+    "mouse left down": WM_LBUTTONDOWN,
+    "mouse left up": WM_LBUTTONUP,
+    "mouse right down": WM_RBUTTONDOWN,
+    "mouse right up": WM_RBUTTONUP,
+}
+
+# Решение хука по коду кнопочного сообщения: тип записи для кольца ввода;
+# всего, чего нет в таблице (ЛКМ, колесо...), — HOOK_PASS, пропустить
+HOOK_PASS = 0
+HOOK_ACTIONS = {
+    WM_RBUTTONDOWN: EV_RMB_DOWN,
+    WM_RBUTTONUP: EV_RMB_UP,
+}
+
+# Снимок состояния оверлея для потоков ввода. Публикует GUI-поток
+# (OverlayWindow._publishHookState), хук только читает — без обращений к Qt.
+_overlay_visible = False  # окно показано
+_hook_armed = False       # окно показано и включены измерения: ПКМ наша
+# Окно ещё создаётся (FAST_START): хоткеи уже копятся в кольце ввода и
+# будут разобраны, как только окно покажется
+_overlay_starting = False
+# В панели открыта строка ввода длины калибровки: хоткеи без модификаторов
+# ('=', 'c', '-,=', Delete) молчат, чтобы набор числа их не вызывал
+_text_entry_open = False
+
+# Трассировка событий в хуке. Строки для logging.debug формируются,
+# только если она включена (уровень DEBUG при старте или --trace-hook).
+HOOK_TRACE = False
+
+
 def on_mouse_event(event):
     """
     Глобальный перехватчик событий мыши.
     Возвращаем False и выставляем event.DontRouteToDefault=True,
     если нужно заблокировать событие для других приложений (включая игру).
+
+    Вызывается на каждое событие мыши в системе, поэтому решение
+    принимается по целому коду сообщения (HOOK_ACTIONS) и снимку
+    _hook_armed, без сравнения строк и без обращений к Qt.
     """
-    global overlay
+    global _preview_tracking, _latest_move
 
-    # Пропускаем "mouse move", чтобы не спамить лог по 1000 раз в секунду:
-    if event.MessageName == "mouse move":
+    msg = event.Message
+    # "mouse move" — самое частое событие — проверяем первым одним сравнением;
+    # не логируем и не пересылаем (1000 раз в секунду), во время протяжки ПКМ
+    # только запоминаем позицию для предпросмотра.
+    if msg == WM_MOUSEMOVE:
+        if _preview_tracking or _hover_tracking:
+            _latest_move = event.Position
         return True
 
-    # Если оверлей не создан или измерение неактивно — всё пропускаем в игру + PyQt
-    if not overlay or not overlay.is_measuring:
+    action = HOOK_ACTIONS.get(msg, HOOK_PASS)
+    if action == HOOK_PASS:
+        # ЛКМ, колесо и прочее идут в игру
         return True
 
-    logging.debug(f"Mouse event: {event.MessageName} at {event.Position}, is_measuring={overlay.is_measuring}")
-
-    # --- ЛКМ пропускаем (не блокируем), чтобы она шла в игру ---
-    if event.MessageName in ["mouse left down", "mouse left up", "mouse left drag"]:
+    # Если оверлей скрыт или измерение неактивно — ПКМ пропускаем в игру
+    if not _hook_armed:
         return True
 
     # --- Рисование отрезков ПКМ ---
-    if event.MessageName in ["mouse right down", "mouse right up"]:
-        x, y = event.Position
-
-        if overlay.isVisible():
-            # Вызываем методы по аналогии с onMouseLeftDown / onMouseLeftUp, но для ПКМ
-            method = "onMouseRightDown" if event.MessageName == "mouse right down" else "onMouseRightUp"
-            QtCore.QMetaObject.invokeMethod(
-                overlay,
-                method,
-                QtCore.Qt.QueuedConnection,
-                QtCore.Q_ARG(int, x),
-                QtCore.Q_ARG(int, y)
-            )
-            # Блокируем дальше, чтобы ПКМ не шла в игру
-            event.DontRouteToDefault = True
-            return False
+    x, y = event.Position
+    if HOOK_TRACE:
+        logging.debug(f"Mouse event: {event.MessageName} at {event.Position}")
+
+    # onMouseRightDown / onMouseRightUp вызовет GUI-поток при разборе кольца
+    if LIVE_PREVIEW:
+        _preview_tracking = action == EV_RMB_DOWN
+    post_input(action, x, y)
+    # Блокируем дальше, чтобы ПКМ не шла в игру (даже если кольцо
+    # переполнено и событие потеряно — решение принимается здесь)
+    event.DontRouteToDefault = True
+    return False
 
+
+def on_key_event(event):
+    """
+    Глобальный перехватчик клавиатуры — в том же потоке хука, что и мышь.
+    Нажатие разбирает скомпилированный автомат хоткеев (hotkey_matcher);
+    клавиши всегда идут дальше в игру, как и у прежних хоткеев keyboard.
+    """
+    msg = event.Message
+    if msg == WM_KEYDOWN or msg == WM_SYSKEYDOWN:
+        hotkey_matcher.key_down(event.KeyID, time.perf_counter())
+    else:
+        hotkey_matcher.key_up(event.KeyID)
     return True
 
 
-def install_mouse_hook():
-    """Устанавливаем глобальный хук мыши в отдельном потоке."""
-    logging.debug("Installing global mouse hook...")
+def _async_key_down(vk):
+    """Клавиша зажата на самом деле (старший бит GetAsyncKeyState)."""
+    return bool(win32api.GetAsyncKeyState(vk) & 0x8000)
+
+
+def install_input_hook():
+    """
+    Поток хука ввода: ставит хуки мыши и клавиатуры и крутит цикл сообщений.
+    Каждое системное событие проходит одну Python-цепочку в одном потоке.
+    """
+    logging.debug(f"Installing global input hook (pump mode: {INPUT_HOOK_PUMP_MODE})...")
     pythoncom.CoInitialize()
 
-    global hm
+    global hm, HOOK_THREAD_ID
     hm = pwh.HookManager()
     hm.MouseAll = on_mouse_event
+    hm.KeyAll = on_key_event
+    hotkey_matcher.key_is_down = _async_key_down
     hm.HookMouse()
+    hm.HookKeyboard()
+    # SetWindowsHookEx уже создал очередь сообщений потока,
+    # так что PostThreadMessage из uninstall_input_hook() до неё дойдёт.
+    HOOK_THREAD_ID = win32api.GetCurrentThreadId()
 
     try:
-        # Основной цикл обработки сообщений
-        while MOUSE_HOOK_RUNNING:
-            pythoncom.PumpWaitingMessages()
-            time.sleep(0.0001)
+        if INPUT_HOOK_PUMP_MODE == "blocking":
+            # Низкоуровневый хук вызывается, пока поток ждёт в GetMessage,
+            # поэтому в простое поток спит в ядре и не тратит CPU.
+            # Если uninstall_input_hook() успел раньше — WM_QUIT уже в очереди
+            # или флаг сброшен, и цикл не запускаем.
+            if INPUT_HOOK_RUNNING:
+                pythoncom.PumpMessages()
+        else:
+            # Основной цикл обработки сообщений
+            while INPUT_HOOK_RUNNING:
+                pythoncom.PumpWaitingMessages()
+                time.sleep(0.0001)
     except Exception as e:
-        logging.exception("Exception in mouse hook thread!")
+        logging.exception("Exception in input hook thread!")
     finally:
-        logging.debug("Exiting mouse hook thread (finally).")
+        # Снимаем хуки из того же потока, который их ставил
+        if hm is not None:
+            hm.UnhookKeyboard()
+            hm.UnhookMouse()
+            hm = None
+        HOOK_THREAD_ID = None
+        pythoncom.CoUninitialize()
+        logging.debug("Exiting input hook thread (finally).")
 
 
-def uninstall_mouse_hook():
-    """Снимаем глобальный хук мыши и останавливаем поток."""
-    logging.debug("Uninstalling global mouse hook...")
-    global hm, MOUSE_HOOK_RUNNING
-    MOUSE_HOOK_RUNNING = False
-    if hm is not None:
-        hm.UnhookMouse()
-        hm = None
+def uninstall_input_hook():
+    """Снимаем глобальные хуки мыши и клавиатуры и останавливаем поток."""
+    logging.debug("Uninstalling global input hook...")
+    global INPUT_HOOK_RUNNING
+    INPUT_HOOK_RUNNING = False
+    # Будим блокирующий цикл: PumpMessages() завершается по WM_QUIT,
+    # а хуки снимаются в finally потока хука.
+    thread_id = HOOK_THREAD_ID
+    if thread_id is not None:
+        try:
+            win32api.PostThreadMessage(thread_id, win32con.WM_QUIT, 0, 0)
+        except Exception:
+            logging.exception("Не удалось отправить WM_QUIT потоку хука:")
 
 ###############################################################################
 # ГЛОБАЛЬНЫЕ ХОТКЕИ
 ###############################################################################
+def _plain_hotkeys_live():
+    """Хоткеи без модификаторов: как все, плюс пауза на время ввода текста."""
+    return (_overlay_visible or _overlay_starting) and not _text_entry_open
+
+
 def toggle_measurement():
     """Функция, вызываемая при нажатии '=' — вкл/выкл режима измерений."""
-    global overlay
-    if overlay and overlay.isVisible():
+    if _plain_hotkeys_live():
         logging.debug("Hotkey '=' pressed. Toggling measurement...")
-        QtCore.QMetaObject.invokeMethod(
-            overlay,
-            "toggleMeasurement",
-            QtCore.Qt.QueuedConnection
-        )
+        post_input(EV_TOGGLE)
 
 
 def start_calibration():
     """Функция хоткея 'c' — начать калибровку заново."""
-    global overlay
-    if overlay and overlay.isVisible():
+    if _plain_hotkeys_live():
         logging.debug("Hotkey 'c' pressed. Starting new calibration.")
-        QtCore.QMetaObject.invokeMethod(
-            overlay,
-            "startCalibration",
-            QtCore.Qt.QueuedConnection
-        )
+        post_input(EV_CALIBRATE)
 
 
 def close_overlay():
     """Функция хоткея 'ctrl+shift+q' — закрыть оверлей."""
-    global overlay
-    if overlay and overlay.isVisible():
+    if _overlay_visible or _overlay_starting:
         logging.debug("Hotkey 'ctrl+shift+q' pressed. Closing overlay.")
-        QtCore.QMetaObject.invokeMethod(
-            overlay,
-            "close",
-            QtCore.Qt.QueuedConnection
-        )
+        post_input(EV_CLOSE)
+
+
+def delete_segment_shortcut():
+    """Функция хоткея 'delete' — удалить отрезок под курсором."""
+    if _plain_hotkeys_live():
+        logging.debug("Hotkey 'delete' pressed. Deleting hovered segment...")
+        post_input(EV_DELETE)
+
+
+def toggle_latency_probe():
+    """Функция хоткея 'ctrl+shift+l' — вкл/выкл замер задержек."""
+    if _overlay_visible or _overlay_starting:
+        logging.debug("Hotkey 'ctrl+shift+l' pressed. Toggling latency probe...")
+        post_input(EV_LATENCY)
+
+
+def next_profile_shortcut():
+    """Функция хоткея 'ctrl+shift+p' — следующий профиль калибровки."""
+    if _overlay_visible or _overlay_starting:
+        logging.debug("Hotkey 'ctrl+shift+p' pressed. Switching calibration profile...")
+        post_input(EV_PROFILE)
+
+
+def auto_calibrate_shortcut():
+    """Функция хоткея 'ctrl+shift+g' — автокалибровка по сетке миникарты."""
+    if _overlay_visible or _overlay_starting:
+        logging.debug("Hotkey 'ctrl+shift+g' pressed. Starting auto-calibration...")
+        post_input(EV_AUTOCAL)
+
+
+def toggle_tracking_shortcut():
+    """Функция хоткея 'ctrl+shift+t' — вкл/выкл слежение за метками миникарты."""
+    if _overlay_visible or _overlay_starting:
+        logging.debug("Hotkey 'ctrl+shift+t' pressed. Toggling marker tracking...")
+        post_input(EV_TRACK)
+
+
+def toggle_route_shortcut():
+    """Функция хоткея 'ctrl+shift+r' — вкл/выкл режим маршрута."""
+    if _overlay_visible or _overlay_starting:
+        logging.debug("Hotkey 'ctrl+shift+r' pressed. Toggling route mode...")
+        post_input(EV_ROUTE)
+
+
+def undo_leg_shortcut():
+    """Функция хоткея 'ctrl+shift+z' — отменить последнее колено маршрута."""
+    if _overlay_visible or _overlay_starting:
+        logging.debug("Hotkey 'ctrl+shift+z' pressed. Undoing route leg...")
+        post_input(EV_UNDO)
+
+
+def toggle_fan_shortcut():
+    """Функция хоткея 'ctrl+shift+f' — вкл/выкл веер дальностей."""
+    if _overlay_visible or _overlay_starting:
+        logging.debug("Hotkey 'ctrl+shift+f' pressed. Toggling range fan...")
+        post_input(EV_FAN)
+
+
+def toggle_loupe_shortcut():
+    """Функция хоткея 'ctrl+shift+m' — вкл/выкл лупу с привязкой концов."""
+    if _overlay_visible or _overlay_starting:
+        logging.debug("Hotkey 'ctrl+shift+m' pressed. Toggling loupe...")
+        post_input(EV_LOUPE)
 
 
 def clear_lines_shortcut():
     """Функция, вызываемая при последовательном нажатии '-', затем '='."""
-    global overlay
-    if overlay and overlay.isVisible():
+    if _plain_hotkeys_live():
         logging.debug("Hotkey '-,=' pressed. Clearing lines...")
-        QtCore.QMetaObject.invokeMethod(
-            overlay,
-            "clearLines",
-            QtCore.Qt.QueuedConnection
+        post_input(EV_CLEAR)
+
+
+# Все глобальные хоткеи: комбинация -> функция. Синтаксис прежний, как у
+# библиотеки keyboard: '+' — одновременно, ',' — шаги последовательности.
+HOTKEYS = {
+    '=': toggle_measurement,             # вкл/выкл измерений
+    'c': start_calibration,              # начать калибровку заново
+    'ctrl+shift+q': close_overlay,       # закрыть окно
+    '-,=': clear_lines_shortcut,         # сначала минус, потом равно => очистить все линии
+    'delete': delete_segment_shortcut,   # удалить отрезок под курсором
+    'ctrl+shift+l': toggle_latency_probe,  # замер задержек ввод -> экран
+    'ctrl+shift+p': next_profile_shortcut,  # следующий профиль калибровки
+    'ctrl+shift+g': auto_calibrate_shortcut,  # автокалибровка по сетке миникарты
+    'ctrl+shift+t': toggle_tracking_shortcut,  # слежение за метками на миникарте
+    'ctrl+shift+r': toggle_route_shortcut,  # режим маршрута (ломаной)
+    'ctrl+shift+z': undo_leg_shortcut,      # отменить последнее колено маршрута
+    'ctrl+shift+f': toggle_fan_shortcut,    # веер дальностей от одной точки
+    'ctrl+shift+m': toggle_loupe_shortcut,  # лупа и привязка концов к меткам и сетке
+}
+
+# Сообщения Windows для клавиатуры (event.Message у pyWinhook)
+WM_KEYDOWN = 0x0100
+WM_KEYUP = 0x0101
+WM_SYSKEYDOWN = 0x0104  # с зажатым Alt
+WM_SYSKEYUP = 0x0105
+
+# Коды виртуальных клавиш (event.KeyID) для имён из HOTKEYS. Коды букв и
+# OEM-клавиш привязаны к месту клавиши, поэтому хоткеи работают и в русской
+# раскладке.
+VK_CODES = {
+    "=": 0xBB, "-": 0xBD, "delete": 0x2E, "insert": 0x2D, "home": 0x24, "end": 0x23,
+    "esc": 0x1B, "enter": 0x0D, "space": 0x20, "tab": 0x09, "backspace": 0x08,
+}
+VK_CODES.update({c: ord(c.upper()) for c in "abcdefghijklmnopqrstuvwxyz0123456789"})
+VK_CODES.update({f"f{i}": 0x6F + i for i in range(1, 13)})
+
+# Модификаторы: имя -> бит маски; код клавиши (общий, левый, правый) -> бит
+MOD_CTRL = 1
+MOD_SHIFT = 2
+MOD_ALT = 4
+MODIFIER_NAMES = {"ctrl": MOD_CTRL, "shift": MOD_SHIFT, "alt": MOD_ALT}
+MODIFIER_VK = {
+    0x11: MOD_CTRL, 0xA2: MOD_CTRL, 0xA3: MOD_CTRL,
+    0x10: MOD_SHIFT, 0xA0: MOD_SHIFT, 0xA1: MOD_SHIFT,
+    0x12: MOD_ALT, 0xA4: MOD_ALT, 0xA5: MOD_ALT,
+}
+
+# Сколько секунд ждать следующего шага последовательности ('-,=')
+HOTKEY_SEQUENCE_TIMEOUT = 1.0
+
+
+class HotkeyMatcher:
+    """
+    Хоткеи, скомпилированные в конечный автомат над кодами клавиш.
+    Шаг — (маска модификаторов, код клавиши); модификаторы должны совпасть
+    точно, как у keyboard ('=' не сработает с зажатым Ctrl). Состояние
+    автомата — пройденная часть последовательности; переходы и срабатывания
+    лежат в словарях по (состояние, шаг), так что нажатие — два-три поиска
+    в словаре без строк. Одиночные хоткеи срабатывают в любом состоянии
+    (как у keyboard: '-,=' и '=' срабатывают оба).
+
+    key_down/key_up зовёт только поток хука; compile() может прийти из
+    другого потока — таблицы подменяются целиком одним присваиванием.
+
+    Отпускание модификатора может потеряться (Alt+Tab, блокировка экрана,
+    хук снят на время) — тогда _mods залипает и точные хоткеи молчат.
+    Поэтому при нажатии основной клавиши с зажатыми модификаторами они
+    сверяются с реальным состоянием через key_is_down(vk) (поток хука ставит
+    GetAsyncKeyState); без него, как у синтетического ввода, верим событиям.
+    """
+
+    def __init__(self, timeout=HOTKEY_SEQUENCE_TIMEOUT, key_is_down=None):
+        self.timeout = timeout
+        self.key_is_down = key_is_down
+        self._tables = ({}, {})  # (срабатывания, переходы)
+        self._state = 0          # 0 — начало, иначе узел последовательности
+        self._state_time = 0.0
+        self._held = set()       # зажатые модификаторы (коды клавиш)
+        self._mods = 0
+
+    @staticmethod
+    def parse(combo):
+        """'ctrl+shift+q' -> [(MOD_CTRL | MOD_SHIFT, VK 'Q')], '-,=' -> два шага."""
+        steps = []
+        for step in combo.split(","):
+            mods, vk = 0, None
+            for name in step.strip().lower().split("+"):
+                if name in MODIFIER_NAMES:
+                    mods |= MODIFIER_NAMES[name]
+                elif name in VK_CODES and vk is None:
+                    vk = VK_CODES[name]
+                else:
+                    raise ValueError(f"Неизвестная клавиша '{name}' в хоткее '{combo}'")
+            if vk is None:
+                raise ValueError(f"В шаге хоткея '{combo}' нет основной клавиши")
+            steps.append((mods, vk))
+        return steps
+
+    def compile(self, hotkeys):
+        """Собирает автомат из словаря комбинация -> функция (пустой — снять все)."""
+        fire, transitions = {}, {}
+        for combo, callback in hotkeys.items():
+            steps = self.parse(combo)
+            state = 0
+            for step in steps[:-1]:
+                state = transitions.setdefault((state, step), len(transitions) + 1)
+            fire[(state, steps[-1])] = callback
+        self._tables = (fire, transitions)
+        self._state = 0
+
+    def key_down(self, vk, now):
+        bit = MODIFIER_VK.get(vk)
+        if bit is not None:
+            if vk not in self._held:
+                self._held.add(vk)
+                self._mods |= bit
+            return
+        if self._held and self.key_is_down is not None:
+            for held in [held for held in self._held if not self.key_is_down(held)]:
+                self.key_up(held)
+        fire, transitions = self._tables
+        step = (self._mods, vk)
+        state = self._state
+        if state and now - self._state_time > self.timeout:
+            state = 0
+        if state:
+            callback = fire.get((state, step))
+            if callback is not None:
+                self._call(callback)
+        callback = fire.get((0, step))
+        if callback is not None:
+            self._call(callback)
+        # Неверный шаг сбрасывает последовательность, но может начать новую
+        self._state = transitions.get((state, step)) or transitions.get((0, step), 0)
+        self._state_time = now
+
+    def key_up(self, vk):
+        if vk in self._held:
+            self._held.discard(vk)
+            self._mods = 0
+            for held in self._held:
+                self._mods |= MODIFIER_VK[held]
+
+    @staticmethod
+    def _call(callback):
+        try:
+            callback()
+        except Exception:
+            logging.exception("Ошибка в обработчике хоткея:")
+
+
+hotkey_matcher = HotkeyMatcher()
+
+
+def install_hotkeys():
+    """Регистрируем все хоткеи из HOTKEYS в автомате потока хука."""
+    logging.debug(f"Installing global hotkeys: {', '.join(HOTKEYS)} ...")
+    hotkey_matcher.compile(HOTKEYS)
+
+
+def uninstall_hotkeys():
+    """Снимаем зарегистрированные хоткеи."""
+    hotkey_matcher.compile({})
+
+###############################################################################
+# БЭКЕНДЫ ВВОДА
+###############################################################################
+class InputBackend:
+    """
+    Источник глобального ввода для оверлея.
+    События мыши бэкенд передаёт в on_mouse_event(event) — объект с полями
+    как у pyWinhook (MessageName, Position, DontRouteToDefault), хоткеи —
+    вызовом функций из HOTKEYS. Так оверлей не зависит от того, откуда ввод.
+    """
+    name = "base"
+
+    def install(self):
+        raise NotImplementedError
+
+    def uninstall(self):
+        raise NotImplementedError
+
+
+class WindowsInputBackend(InputBackend):
+    """Настоящий ввод: один поток pyWinhook с хуками мыши и клавиатуры."""
+    name = "windows"
+
+    def __init__(self, record_path=None):
+        # Если задан путь — пишем RMB-события и хоткеи для последующего replay
+        self.record_path = record_path
+        self._recorder = InputRecorder() if record_path else None
+
+    def install(self):
+        """Может вызываться и не из GUI-потока (FAST_START): Qt здесь не трогаем."""
+        global hook_input_thread, INPUT_HOOK_RUNNING
+        if not import_windows_modules():
+            raise RuntimeError("Бэкенд 'windows' требует pywin32 и pyWinhook.")
+        if self._recorder is not None:
+            self._recorder.wrap()
+
+        # Глобальные хоткеи: автомат, который разбирает поток хука
+        install_hotkeys()
+
+        # Запуск отдельного потока с хуками мыши и клавиатуры
+        INPUT_HOOK_RUNNING = True
+        hook_input_thread = threading.Thread(target=install_input_hook, name="input-hook", daemon=True)
+        hook_input_thread.start()
+        logging.debug("Input hook thread started.")
+
+    def uninstall(self):
+        global hook_input_thread
+        uninstall_hotkeys()
+        uninstall_input_hook()
+        if hook_input_thread is not None and hook_input_thread.is_alive():
+            hook_input_thread.join()
+        hook_input_thread = None
+
+        if self._recorder is not None:
+            self._recorder.unwrap()
+            self._recorder.save(self.record_path)
+
+
+class InputRecorder:
+    """
+    Записывает RMB-события и хоткеи, проходящие через on_mouse_event / HOTKEYS,
+    в формате, который читает load_input_recording().
+    """
+
+    def __init__(self):
+        self.records = []
+        self._t0 = None
+        self._orig_mouse = None
+        self._orig_hotkeys = None
+
+    def _stamp(self):
+        now = time.perf_counter()
+        if self._t0 is None:
+            self._t0 = now
+        return round(now - self._t0, 6)
+
+    def wrap(self):
+        global on_mouse_event
+        self._orig_mouse = orig_mouse = on_mouse_event
+        self._orig_hotkeys = dict(HOTKEYS)
+
+        def recording_mouse_event(event):
+            if event.MessageName in ("mouse right down", "mouse right up"):
+                x, y = event.Position
+                self.records.append({"t": self._stamp(), "type": "mouse",
+                                     "name": event.MessageName, "x": x, "y": y})
+            return orig_mouse(event)
+
+        def recording_hotkey(combo, callback):
+            def wrapper():
+                self.records.append({"t": self._stamp(), "type": "hotkey", "keys": combo})
+                callback()
+            return wrapper
+
+        on_mouse_event = recording_mouse_event
+        for combo, callback in self._orig_hotkeys.items():
+            HOTKEYS[combo] = recording_hotkey(combo, callback)
+
+    def unwrap(self):
+        global on_mouse_event
+        on_mouse_event = self._orig_mouse
+        HOTKEYS.update(self._orig_hotkeys)
+
+    def save(self, path):
+        save_input_recording(path, self.records)
+        logging.info(f"Recorded {len(self.records)} input events to {path}")
+
+
+class SyntheticMouseEvent:
+    """Минимальный аналог pyWinhook.MouseEvent для синтетического ввода."""
+    __slots__ = ("Message", "MessageName", "Position", "DontRouteToDefault")
+
+    def __init__(self, message_name, x, y):
+        self.Message = MOUSE_MESSAGE_IDS.get(message_name, 0)
+        self.MessageName = message_name
+        self.Position = (x, y)
+        self.DontRouteToDefault = False
+
+
+class _GuiBarrier(QtCore.QObject):
+    """Позволяет потоку ввода дождаться, пока GUI-поток разберёт очередь вызовов."""
+
+    def __init__(self):
+        super().__init__()
+        self.passed = threading.Event()
+
+    @QtCore.pyqtSlot()
+    def release(self):
+        self.passed.set()
+
+    def wait(self, timeout=1.0):
+        self.passed.clear()
+        QtCore.QMetaObject.invokeMethod(self, "release", QtCore.Qt.QueuedConnection)
+        return self.passed.wait(timeout)
+
+
+class SyntheticInputBackend(InputBackend):
+    """
+    Детерминированный ввод без Windows: проигрывает поток записей
+    (см. load_input_recording / generate_input_stream) из отдельного потока,
+    как это делал бы поток хука. Для бенчмарков и CI с QT_QPA_PLATFORM=offscreen.
+
+    rate_hz: None — соблюдать метки "t" из записей, 0 — без пауз,
+             >0 — равномерно rate_hz событий в секунду.
+    """
+    name = "synthetic"
+
+    def __init__(self, records, rate_hz=None, loops=1, quit_when_done=False):
+        self.records = list(records)
+        self.rate_hz = rate_hz
+        self.loops = loops
+        self.quit_when_done = quit_when_done
+
+        self.events_sent = 0
+        self.events_blocked = 0
+        self.elapsed = 0.0
+
+        self._stop = threading.Event()
+        self._thread = None
+        self._barrier = None
+
+    def install(self):
+        self._stop.clear()
+        self._barrier = _GuiBarrier()
+        self._thread = threading.Thread(target=self._run, name="synthetic-input", daemon=True)
+        self._thread.start()
+        logging.debug(f"Synthetic input started: {len(self.records)} records x {self.loops}.")
+
+    def uninstall(self):
+        self._stop.set()
+        if self._thread is not None and self._thread.is_alive() \
+                and self._thread is not threading.current_thread():
+            self._thread.join()
+        self._thread = None
+
+    def _run(self):
+        start = time.perf_counter()
+        n = 0
+        try:
+            for loop in range(self.loops):
+                loop_start = time.perf_counter()
+                for i, record in enumerate(self.records):
+                    if self._stop.is_set():
+                        return
+                    if self.rate_hz is None:
+                        due = loop_start + record.get("t", 0.0)
+                    elif self.rate_hz > 0:
+                        due = start + n / self.rate_hz
+                    else:
+                        due = None
+                    if due is not None:
+                        delay = due - time.perf_counter()
+                        if delay > 0 and self._stop.wait(delay):
+                            return
+                    self._dispatch(record)
+                    n += 1
+        except Exception:
+            logging.exception("Ошибка в потоке синтетического ввода:")
+        finally:
+            self.elapsed = time.perf_counter() - start
+            rate = self.events_sent / self.elapsed if self.elapsed > 0 else 0.0
+            logging.info(
+                f"Synthetic input finished: {self.events_sent} events "
+                f"({self.events_blocked} blocked) in {self.elapsed:.3f} s, {rate:.0f} ev/s"
+            )
+            if self.quit_when_done and not self._stop.is_set():
+                # Как и --exit-after-startup — через closeEvent окна, чтобы
+                # ввод и фоновые потоки остановились до выхода интерпретатора
+                QtCore.QMetaObject.invokeMethod(overlay, "close", QtCore.Qt.QueuedConnection)
+
+    def _dispatch(self, record):
+        if record["type"] == "mouse":
+            event = SyntheticMouseEvent(record["name"], record["x"], record["y"])
+            if not on_mouse_event(event):
+                self.events_blocked += 1
+        elif record["type"] == "hotkey":
+            HOTKEYS[record["keys"]]()
+            if self.rate_hz == 0:
+                # Без пауз следующие события обогнали бы queued-вызов хоткея
+                # (например, '=' ещё не включил измерения) — ждём GUI-поток.
+                self._barrier.wait()
+        self.events_sent += 1
+
+
+def load_input_recording(path):
+    """Читает запись ввода: JSONL, по объекту на строку ({"t", "type", ...})."""
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def save_input_recording(path, records):
+    with open(path, "w", encoding="utf-8") as f:
+        for record in records:
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+
+def generate_input_stream(drags=100, seed=0, width=1920, height=1080, interval=0.05, clear_every=0,
+                          moves_per_drag=0):
+    """
+    Генерирует воспроизводимый поток: '=' (включить измерения), затем `drags`
+    протяжек ПКМ (down/up) длиннее MIN_DRAG_DISTANCE; каждые `clear_every`
+    протяжек — очистка '-,='. Между down и up — `moves_per_drag` движений
+    мыши по прямой. Метки "t" идут с шагом `interval` секунд.
+    """
+    rng = random.Random(seed)
+    records = [{"t": 0.0, "type": "hotkey", "keys": "="}]
+    t = interval
+    for i in range(drags):
+        x1, y1 = rng.randrange(width), rng.randrange(height)
+        while True:
+            x2, y2 = rng.randrange(width), rng.randrange(height)
+            if math.hypot(x2 - x1, y2 - y1) >= MIN_DRAG_DISTANCE:
+                break
+        records.append({"t": round(t, 6), "type": "mouse", "name": "mouse right down", "x": x1, "y": y1})
+        t += interval
+        for k in range(1, moves_per_drag + 1):
+            f = k / (moves_per_drag + 1)
+            records.append({"t": round(t, 6), "type": "mouse", "name": "mouse move",
+                            "x": round(x1 + (x2 - x1) * f), "y": round(y1 + (y2 - y1) * f)})
+            t += interval / (moves_per_drag + 1)
+        records.append({"t": round(t, 6), "type": "mouse", "name": "mouse right up", "x": x2, "y": y2})
+        t += interval
+        if clear_every and (i + 1) % clear_every == 0:
+            records.append({"t": round(t, 6), "type": "hotkey", "keys": "-,="})
+            t += interval
+    return records
+
+
+def create_input_backend(args):
+    """Создаёт бэкенд ввода по аргументам командной строки."""
+    if args.input_backend == "windows":
+        return WindowsInputBackend(record_path=args.record_input)
+
+    if args.replay_input:
+        records = load_input_recording(args.replay_input)
+    else:
+        screen = QtWidgets.QApplication.primaryScreen().size()
+        records = generate_input_stream(
+            drags=args.synthetic_drags,
+            seed=args.synthetic_seed,
+            width=screen.width(),
+            height=screen.height(),
+            moves_per_drag=args.synthetic_moves,
         )
+    return SyntheticInputBackend(
+        records,
+        rate_hz=args.synthetic_rate,
+        loops=args.synthetic_loops,
+        quit_when_done=args.exit_after_replay,
+    )
+
+###############################################################################
+# ХРАНИЛИЩЕ ОТРЕЗКОВ
+###############################################################################
+class SegmentGrid:
+    """
+    Пространственный индекс: равномерная сетка, ячейка -> множество id
+    отрезков. Отрезок попадает только в ячейки, через которые проходит
+    (в каждой строке сетки — по x-диапазону его куска), а не во все ячейки
+    своего bbox, так что длинные диагонали не засоряют индекс.
+    Добавление и удаление — инкрементальные.
+    """
+
+    def __init__(self, cell=SEGMENT_GRID_CELL):
+        self.cell = cell
+        self._cells = {}  # (cx, cy) -> set(id)
+        self._keys = {}   # id -> список ячеек
+
+    def _cells_for(self, x1, y1, x2, y2):
+        c = self.cell
+        if y1 > y2:
+            x1, y1, x2, y2 = x2, y2, x1, y1
+        keys = []
+        for cy in range(int(y1 // c), int(y2 // c) + 1):
+            if y2 == y1:
+                xa, xb = x1, x2
+            else:
+                # Кусок отрезка внутри полосы [cy*c, (cy+1)*c]
+                ya = max(y1, cy * c)
+                yb = min(y2, (cy + 1) * c)
+                xa = x1 + (x2 - x1) * (ya - y1) / (y2 - y1)
+                xb = x1 + (x2 - x1) * (yb - y1) / (y2 - y1)
+            for cx in range(int(min(xa, xb) // c), int(max(xa, xb) // c) + 1):
+                keys.append((cx, cy))
+        return keys
+
+    def insert(self, seg_id, x1, y1, x2, y2):
+        keys = self._cells_for(x1, y1, x2, y2)
+        self._keys[seg_id] = keys
+        for key in keys:
+            bucket = self._cells.get(key)
+            if bucket is None:
+                self._cells[key] = {seg_id}
+            else:
+                bucket.add(seg_id)
+
+    def remove(self, seg_id):
+        for key in self._keys.pop(seg_id, ()):
+            bucket = self._cells[key]
+            bucket.discard(seg_id)
+            if not bucket:
+                del self._cells[key]
+
+    def clear(self):
+        self._cells.clear()
+        self._keys.clear()
 
+    def query(self, x0, y0, x1, y1):
+        """id отрезков, проходящих через ячейки прямоугольника [x0, x1] x [y0, y1]."""
+        c = self.cell
+        found = set()
+        for cy in range(int(y0 // c), int(y1 // c) + 1):
+            for cx in range(int(x0 // c), int(x1 // c) + 1):
+                bucket = self._cells.get((cx, cy))
+                if bucket:
+                    found |= bucket
+        return found
 
-def install_keyboard_hotkey():
+
+class SegmentStore:
     """
-    Регистрируем все необходимые хоткеи.
+    Отрезки в упакованных массивах numpy: концы в пикселях (N x 4, float64)
+    и стабильные id. Длины и азимуты не хранятся в метрах — они считаются
+    пакетно по текущему масштабу, поэтому после перекалибровки все подписи
+    сразу верны без перерисовки отрезков пользователем.
+
+    Удаление — перестановкой последней строки на место удаляемой (O(1));
+    id отрезков при этом не меняются.
     """
-    global TOGGLE_HOTKEY_ID, CALIBRATE_HOTKEY_ID, EXIT_HOTKEY_ID, CLEAR_LINES_HOTKEY_ID
-    logging.debug("Installing global hotkeys: '=', 'c', 'ctrl+shift+q', '-,=' ...")
 
-    # 1) '=' — вкл/выкл измерений
-    TOGGLE_HOTKEY_ID = keyboard.add_hotkey('=', toggle_measurement)
-    # 2) 'c' — начать калибровку заново
-    CALIBRATE_HOTKEY_ID = keyboard.add_hotkey('c', start_calibration)
-    # 3) 'ctrl+shift+q' — закрыть окно
-    EXIT_HOTKEY_ID = keyboard.add_hotkey('ctrl+shift+q', close_overlay)
-    # 4) '-,=' — сначала минус, потом равно => очистить все линии
-    CLEAR_LINES_HOTKEY_ID = keyboard.add_hotkey('-,=', clear_lines_shortcut)
+    def __init__(self, capacity=64):
+        self._pts = np.empty((capacity, 4), dtype=np.float64)
+        self._ids = np.empty(capacity, dtype=np.int64)
+        # Кэш геометрии в пикселях: строки [0, _computed) посчитаны
+        self._len_px = np.empty(capacity, dtype=np.float64)
+        self._bearing = np.empty(capacity, dtype=np.float64)
+        self._computed = 0
+        self._count = 0
+        self._row_of = {}
+        self._next_id = 0
+        self.grid = SegmentGrid()
+
+    def __len__(self):
+        return self._count
+
+    def _grow(self):
+        capacity = len(self._pts) * 2
+        for name in ("_pts", "_ids", "_len_px", "_bearing"):
+            old = getattr(self, name)
+            new = np.empty((capacity,) + old.shape[1:], dtype=old.dtype)
+            new[:self._count] = old[:self._count]
+            setattr(self, name, new)
+
+    def add(self, x1, y1, x2, y2):
+        """Добавляет отрезок и возвращает его id."""
+        if self._count == len(self._pts):
+            self._grow()
+        row = self._count
+        seg_id = self._next_id
+        self._next_id += 1
+        self._pts[row] = (x1, y1, x2, y2)
+        self._ids[row] = seg_id
+        self._row_of[seg_id] = row
+        self._count += 1
+        self.grid.insert(seg_id, x1, y1, x2, y2)
+        return seg_id
+
+    def remove(self, seg_id):
+        """Удаляет отрезок по id."""
+        row = self._row_of.pop(seg_id)
+        self.grid.remove(seg_id)
+        last = self._count - 1
+        if row != last:
+            moved_id = int(self._ids[last])
+            self._pts[row] = self._pts[last]
+            self._ids[row] = moved_id
+            self._len_px[row] = self._len_px[last]
+            self._bearing[row] = self._bearing[last]
+            self._row_of[moved_id] = row
+            if last >= self._computed:
+                # Переехавшая строка ещё не посчитана
+                self._computed = min(self._computed, row)
+        self._count = last
+        self._computed = min(self._computed, last)
+
+    def clear(self):
+        self._count = 0
+        self._computed = 0
+        self._row_of.clear()
+        self.grid.clear()
+
+    def move_endpoint(self, seg_id, which, x, y):
+        """Переносит конец отрезка: which=0 — начало (x1, y1), 1 — конец (x2, y2)."""
+        row = self._row_of[seg_id]
+        self._pts[row, 2 * which:2 * which + 2] = (x, y)
+        self._computed = min(self._computed, row)
+        self.grid.remove(seg_id)
+        self.grid.insert(seg_id, *self._pts[row].tolist())
+
+    def _candidates(self, x, y, radius):
+        """Строки отрезков из ячеек вокруг точки (или None)."""
+        ids = self.grid.query(x - radius, y - radius, x + radius, y + radius)
+        if not ids:
+            return None
+        return np.fromiter((self._row_of[i] for i in ids), dtype=np.intp, count=len(ids))
+
+    def nearest(self, x, y, radius):
+        """
+        Ближайший к точке отрезок не дальше radius px: (id, расстояние) или None.
+        Расстояния до кандидатов из индекса считаются одним пакетом.
+        """
+        rows = self._candidates(x, y, radius)
+        if rows is None:
+            return None
+        p = self._pts[rows]
+        ax, ay = p[:, 0], p[:, 1]
+        dx, dy = p[:, 2] - ax, p[:, 3] - ay
+        len2 = dx * dx + dy * dy
+        t = np.clip(((x - ax) * dx + (y - ay) * dy) / np.where(len2 > 0, len2, 1.0), 0.0, 1.0)
+        dist = np.hypot(ax + t * dx - x, ay + t * dy - y)
+        k = int(np.argmin(dist))
+        if dist[k] > radius:
+            return None
+        return int(self._ids[rows[k]]), float(dist[k])
+
+    def nearest_endpoint(self, x, y, radius):
+        """Ближайший к точке конец отрезка: (id, which) или None."""
+        rows = self._candidates(x, y, radius)
+        if rows is None:
+            return None
+        p = self._pts[rows]
+        d = np.hypot(p[:, 0::2] - x, p[:, 1::2] - y)  # N x 2: начало, конец
+        k = int(np.argmin(d))
+        row, which = divmod(k, 2)
+        if d[row, which] > radius:
+            return None
+        return int(self._ids[rows[row]]), which
+
+    def scale_within(self, x0, y0, x1, y1, factor, center=None):
+        """
+        Масштабирует в factor раз относительно center (по умолчанию — центра
+        прямоугольника) отрезки, целиком лежащие в прямоугольнике (нарисованные
+        по миникарте при смене её зума). Длины пересчитываются умножением,
+        азимуты не меняются. Возвращает id.
+        """
+        p = self._pts[:self._count]
+        inside = ((p[:, 0::2] >= x0) & (p[:, 0::2] <= x1) & (p[:, 1::2] >= y0) & (p[:, 1::2] <= y1)).all(axis=1)
+        rows = np.flatnonzero(inside)
+        if not len(rows):
+            return []
+        if center is None:
+            center = ((x0 + x1) / 2, (y0 + y1) / 2)
+        center = np.array(tuple(center) * 2)
+        p[rows] = center + (p[rows] - center) * factor
+        computed = rows[rows < self._computed]
+        self._len_px[computed] *= factor
+        ids = self._ids[rows].tolist()
+        for seg_id, row in zip(ids, rows):
+            self.grid.remove(seg_id)
+            self.grid.insert(seg_id, *p[row].tolist())
+        return ids
+
+    def __contains__(self, seg_id):
+        return seg_id in self._row_of
+
+    def row(self, seg_id):
+        return self._row_of[seg_id]
+
+    def ids(self):
+        """id по строкам (view, не изменять)."""
+        return self._ids[:self._count]
+
+    def endpoints(self):
+        """Концы (x1, y1, x2, y2) по строкам (view, не изменять)."""
+        return self._pts[:self._count]
+
+    def segment(self, seg_id):
+        """(x1, y1, x2, y2) одного отрезка."""
+        return tuple(self._pts[self._row_of[seg_id]].tolist())
+
+    def _compute(self):
+        """Досчитывает длины и азимуты ещё не посчитанных строк одним пакетом."""
+        start, end = self._computed, self._count
+        if start >= end:
+            return
+        p = self._pts[start:end]
+        dx = p[:, 2] - p[:, 0]
+        dy = p[:, 3] - p[:, 1]
+        np.hypot(dx, dy, out=self._len_px[start:end])
+        # Угол: 0° — вверх, 90° — вправо, 180° — вниз (как _bearing_deg)
+        bearing = self._bearing[start:end]
+        np.degrees(np.arctan2(dx, -dy), out=bearing)
+        np.mod(bearing, 360.0, out=bearing)
+        self._computed = end
+
+    def metrics(self, scale=None):
+        """
+        Длины и азимуты всех отрезков по строкам: (длины, азимуты в градусах).
+        Длины в метрах при заданном масштабе (м/px), иначе в пикселях.
+        """
+        self._compute()
+        lengths = self._len_px[:self._count]
+        if scale:
+            lengths = lengths * scale
+        return lengths, self._bearing[:self._count]
+
+
+class Route:
+    """
+    Маршрут (ломаная) из отрезков хранилища: каждая новая протяжка ПКМ
+    продолжается от конца предыдущей. Для каждого колена хранятся итоги
+    на момент его добавления (длина и суммарный поворот), поэтому и новое
+    колено, и отмена последнего — O(1) без пересчёта всего пути, а итоги
+    после отмены точно равны прежним (без накопления ошибки вычитания).
+
+    Длины — в пикселях: метры получаются умножением на текущий масштаб.
+    """
+
+    def __init__(self):
+        # (seg_id, конец (x, y), длина px, азимут, поворот, длина всего px, поворот всего)
+        self._legs = []
+        self._index = {}  # seg_id -> номер колена
+
+    def __len__(self):
+        return len(self._legs)
+
+    def __contains__(self, seg_id):
+        return seg_id in self._index
+
+    @property
+    def end(self):
+        """Конец последнего колена — начало следующей протяжки."""
+        return self._legs[-1][1]
+
+    @property
+    def totals(self):
+        """(длина всего маршрута в px, суммарный поворот в градусах)."""
+        if not self._legs:
+            return 0.0, 0.0
+        leg = self._legs[-1]
+        return leg[5], leg[6]
+
+    def add(self, seg_id, x2, y2, length_px, bearing):
+        """Добавляет колено; возвращает поворот относительно предыдущего (−180..180°)."""
+        total_px, total_turn = self.totals
+        turn = 0.0
+        if self._legs:
+            turn = (bearing - self._legs[-1][3] + 180.0) % 360.0 - 180.0
+        self._index[seg_id] = len(self._legs)
+        self._legs.append((seg_id, (x2, y2), length_px, bearing, turn,
+                           total_px + length_px, total_turn + abs(turn)))
+        return turn
+
+    def pop(self):
+        """Снимает последнее колено; возвращает его seg_id или None."""
+        if not self._legs:
+            return None
+        seg_id = self._legs.pop()[0]
+        del self._index[seg_id]
+        return seg_id
+
+    def forget(self, seg_id):
+        """
+        Отрезок маршрута удалён или изменён не через маршрут: последнее колено
+        просто снимается, а любое другое рвёт цепочку — маршрут заканчивается
+        (отрезки остаются на экране обычными отрезками).
+        """
+        if seg_id not in self._index:
+            return
+        if self._index[seg_id] == len(self._legs) - 1:
+            self.pop()
+        else:
+            self.clear()
+
+    def clear(self):
+        self._legs.clear()
+        self._index.clear()
+
+
+class RangeFan:
+    """
+    Веер дальностей: одно начало и много целей. Дальности и азимуты всех
+    целей считаются одним пакетом numpy и сортируются по дальности; таблица
+    пересчитывается целиком, только когда сдвинулось начало, добавилась
+    цель или сменился масштаб (ключ кэша), а не на каждый запрос.
+    """
+
+    def __init__(self, capacity=16):
+        self.origin = None
+        self._targets = np.empty((capacity, 2), dtype=np.float64)
+        self._count = 0
+        self._table_key = None
+        self._table = None
+
+    def __len__(self):
+        return self._count
+
+    def set_origin(self, x, y):
+        self.origin = (x, y)
+
+    def add(self, x, y):
+        """Добавляет цель; возвращает её номер (с 1, в порядке добавления)."""
+        if self._count == len(self._targets):
+            grown = np.empty((len(self._targets) * 2, 2), dtype=np.float64)
+            grown[:self._count] = self._targets[:self._count]
+            self._targets = grown
+        self._targets[self._count] = (x, y)
+        self._count += 1
+        return self._count
+
+    def targets(self):
+        """Цели (x, y) в порядке добавления (view, не изменять)."""
+        return self._targets[:self._count]
+
+    def clear(self):
+        self.origin = None
+        self._count = 0
+        self._table_key = None
+        self._table = None
+
+    def table(self, scale=None):
+        """
+        (номера, дальности, азимуты) по возрастанию дальности. Дальности в
+        метрах при заданном масштабе (м/px), иначе в пикселях.
+        """
+        key = (self.origin, self._count, scale)
+        if key == self._table_key:
+            return self._table
+        if self.origin is None or not self._count:
+            empty = np.empty(0)
+            self._table = (empty.astype(np.int64), empty, empty)
+        else:
+            t = self._targets[:self._count]
+            dx = t[:, 0] - self.origin[0]
+            dy = t[:, 1] - self.origin[1]
+            lengths = np.hypot(dx, dy)
+            if scale:
+                lengths *= scale
+            # Тот же азимут, что у _bearing_deg: 0° — вверх, 90° — вправо
+            bearings = np.degrees(np.arctan2(dx, -dy)) % 360
+            order = np.argsort(lengths, kind="stable")
+            self._table = (order + 1, lengths[order], bearings[order])
+        self._table_key = key
+        return self._table
+
+###############################################################################
+# СОХРАНЁННЫЕ КАЛИБРОВКИ
+###############################################################################
+class BackgroundJsonWriter:
+    """
+    Пишет JSON-снимки на диск из своего потока: GUI-поток только кладёт
+    последний снимок и не ждёт диска. Несколько снимков подряд сливаются в
+    одну запись; файл заменяется атомарно (временный файл + os.replace).
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._cond = threading.Condition()
+        self._snapshot = None
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name="json-writer", daemon=True)
+        self._thread.start()
+
+    def submit(self, snapshot):
+        with self._cond:
+            self._snapshot = snapshot
+            self._cond.notify()
+
+    def close(self, timeout=2.0):
+        """Дописывает последний снимок и останавливает поток."""
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        self._thread.join(timeout)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while self._snapshot is None and not self._closed:
+                    self._cond.wait()
+                snapshot, self._snapshot = self._snapshot, None
+                closed = self._closed
+            if snapshot is not None:
+                self._write(snapshot)
+            if closed and snapshot is None:
+                return
+
+    def _write(self, snapshot):
+        try:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(snapshot, f, ensure_ascii=False, indent=2)
+            os.replace(tmp_path, self.path)
+        except Exception:
+            logging.exception(f"Не удалось сохранить {self.path}:")
+
+
+def screen_key(screen):
+    """Ключ экрана: разрешение в физических пикселях и геометрия основного экрана."""
+    geometry = screen.geometry()
+    dpr = screen.devicePixelRatio()
+    return (
+        f"{round(geometry.width() * dpr)}x{round(geometry.height() * dpr)}"
+        f"@{geometry.x()},{geometry.y()},{geometry.width()},{geometry.height()}"
+    )
+
+
+class CalibrationStore:
+    """
+    Масштаб (м/px) по ключу «экран + профиль миникарты». Читается один раз
+    при старте (файл маленький), записывается асинхронно через
+    BackgroundJsonWriter — GUI-поток диск не ждёт.
+    """
+
+    def __init__(self, path, screen_id):
+        self.path = path
+        self.screen_id = screen_id
+        self.profiles = list(CALIBRATION_PROFILES)
+        self.active_profile = self.profiles[0]
+        self._scales = {}
+        self._writer = None
+        self._load()
+
+    def _load(self):
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            logging.warning(f"Не удалось прочитать {self.path}: {e}")
+            return
+        # Файл правят руками — любая чужая структура даёт значения по умолчанию
+        if not isinstance(data, dict):
+            logging.warning(f"{self.path}: ожидался объект JSON, калибровки не загружены")
+            return
+        scales = data.get("scales", {})
+        if not isinstance(scales, dict):
+            logging.warning(f"{self.path}: поле scales не объект, масштабы не загружены")
+            scales = {}
+        for key, value in scales.items():
+            if (isinstance(value, (int, float)) and not isinstance(value, bool)
+                    and math.isfinite(value) and value > 0):
+                self._scales[key] = float(value)
+            else:
+                logging.warning(f"{self.path}: пропущен неверный масштаб {key!r}: {value!r}")
+        profiles = data.get("profiles", [])
+        if not isinstance(profiles, list):
+            logging.warning(f"{self.path}: поле profiles не список, профили не загружены")
+            profiles = []
+        for profile in profiles:
+            if isinstance(profile, str) and profile and profile not in self.profiles:
+                self.profiles.append(profile)
+        if data.get("active_profile") in self.profiles:
+            self.active_profile = data["active_profile"]
+
+    def _key(self, profile=None):
+        return f"{self.screen_id}|{profile or self.active_profile}"
+
+    @property
+    def scale(self):
+        """Сохранённый масштаб для текущего экрана и профиля (или None)."""
+        return self._scales.get(self._key())
+
+    def set_scale(self, scale):
+        self._scales[self._key()] = scale
+        self._save()
+
+    def set_profile(self, profile):
+        if profile not in self.profiles:
+            self.profiles.append(profile)
+        self.active_profile = profile
+        self._save()
+
+    def next_profile(self):
+        i = self.profiles.index(self.active_profile)
+        self.set_profile(self.profiles[(i + 1) % len(self.profiles)])
+        return self.active_profile
+
+    def _save(self):
+        if self._writer is None:
+            self._writer = BackgroundJsonWriter(self.path)
+        self._writer.submit({
+            "version": 1,
+            "active_profile": self.active_profile,
+            "profiles": list(self.profiles),
+            "scales": dict(self._scales),
+        })
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.close()
+
+###############################################################################
+# ЖУРНАЛ СЕССИИ (JSONL)
+###############################################################################
+class SessionLog:
+    """
+    Журнал сессии: по JSON-объекту на строку ({"t", "kind", ...}) на каждый
+    отрезок, калибровку и смену режима. GUI-поток только кладёт кортеж в
+    очередь (без форматирования и диска); поток записи раз в flush_interval
+    или по набору batch записей сериализует пачку и дописывает её в файл.
+    Очередь ограничена max_pending: если диск не успевает, отбрасываются
+    самые старые записи (счётчик dropped). Выключенный журнал стоит одной
+    проверки `enabled`.
+    """
+
+    def __init__(self, max_pending=SESSION_LOG_MAX_PENDING, batch=SESSION_LOG_BATCH,
+                 flush_interval=SESSION_LOG_FLUSH_INTERVAL):
+        self.enabled = False
+        self.path = None
+        self.max_pending = max_pending
+        self.batch = batch
+        self.flush_interval = flush_interval
+        self.written = 0
+        self.dropped = 0
+        self._pending = deque()
+        self._cond = threading.Condition()
+        self._closed = False
+        self._thread = None
+        self._t0 = None
+
+    def open(self, path, **header):
+        """Начинает журнал в path; первая запись — "session" с полями header."""
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.path = path
+        self._t0 = time.perf_counter()
+        self._closed = False
+        self.enabled = True
+        self._thread = threading.Thread(target=self._run, name="session-log", daemon=True)
+        self._thread.start()
+        self.log("session", version=1, started=time.strftime("%Y-%m-%dT%H:%M:%S"), **header)
+        logging.info(f"Session log: {path}")
+
+    def log(self, kind, **fields):
+        if not self.enabled:
+            return
+        record = (time.perf_counter() - self._t0, kind, fields)
+        with self._cond:
+            if len(self._pending) >= self.max_pending:
+                self._pending.popleft()
+                self.dropped += 1
+            self._pending.append(record)
+            if len(self._pending) >= self.batch:
+                self._cond.notify()
+
+    def close(self, timeout=2.0):
+        """Дописывает очередь и останавливает поток записи."""
+        if not self.enabled:
+            return
+        self.enabled = False
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        self._thread.join(timeout)
+        logging.info(f"Session log: {self.written} records written, {self.dropped} dropped -> {self.path}")
+
+    def _run(self):
+        try:
+            with open(self.path, "a", encoding="utf-8") as f:
+                while True:
+                    with self._cond:
+                        if not self._closed and len(self._pending) < self.batch:
+                            self._cond.wait(self.flush_interval)
+                        records, self._pending = self._pending, deque()
+                        closed = self._closed
+                    if records:
+                        f.write("".join(
+                            json.dumps({"t": round(t, 6), "kind": kind, **fields}, ensure_ascii=False) + "\n"
+                            for t, kind, fields in records
+                        ))
+                        f.flush()
+                        self.written += len(records)
+                    if closed:
+                        return
+        except Exception:
+            logging.exception(f"Ошибка записи журнала сессии {self.path}:")
+
+
+session_log = SessionLog()
+
+
+def prune_session_logs(directory, keep):
+    """Оставляет в directory keep самых новых журналов session-*.jsonl (имя = время старта)."""
+    try:
+        names = sorted(
+            name for name in os.listdir(directory)
+            if name.startswith("session-") and name.endswith(".jsonl")
+        )
+    except FileNotFoundError:
+        return
+    for name in names[:max(0, len(names) - keep)]:
+        try:
+            os.remove(os.path.join(directory, name))
+        except OSError as e:
+            logging.warning(f"Не удалось удалить старый журнал {name}: {e}")
+
+
+def load_session_log(path):
+    """Читает журнал сессии: список записей по порядку."""
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def replay_session(overlay, records):
+    """
+    Восстанавливает в overlay состояние по записям журнала: масштаб,
+    отрезки (с переносами концов, удалениями и очистками), пересчёты при
+    смене зума миникарты и веер. Ввод и таймеры не участвуют — результат
+    детерминирован. Возвращает число применённых записей по видам.
+    """
+    ids = {}  # id отрезка в журнале -> id в overlay.segments
+    counts = {}
+    segments = overlay.segments
+    for record in records:
+        kind = record["kind"]
+        if kind in ("session", "scale", "zoom") and "scale" in record:
+            overlay.scale_factor = record["scale"]
+            overlay.is_calibrating = overlay.scale_factor is None
+        if kind == "calibration_start":
+            overlay.scale_factor = None
+            overlay.is_calibrating = True
+        elif kind == "segment":
+            ids[record["id"]] = segments.add(record["x1"], record["y1"], record["x2"], record["y2"])
+        elif kind == "segment_moved":
+            seg_id = ids.get(record["id"])
+            if seg_id in segments:
+                segments.move_endpoint(seg_id, record["which"], record["x"], record["y"])
+        elif kind == "segment_deleted":
+            seg_id = ids.pop(record["id"], None)
+            if seg_id in segments:
+                segments.remove(seg_id)
+        elif kind == "clear":
+            segments.clear()
+            ids.clear()
+            overlay.fan.clear()
+        elif kind == "zoom" and record.get("region"):
+            x, y, w, h = record["region"]
+            segments.scale_within(x, y, x + w, y + h, record["factor"], record.get("center"))
+        elif kind == "fan":
+            overlay.fan_mode = record["on"]
+            overlay.fan.clear()
+        elif kind == "fan_origin":
+            overlay.fan.set_origin(record["x"], record["y"])
+        elif kind == "fan_target":
+            overlay.fan.add(record["x"], record["y"])
+        counts[kind] = counts.get(kind, 0) + 1
+    overlay.labels.clear()
+    overlay.hovered_id = None
+    overlay._setFanGeometry()
+    overlay._refreshFanTable(show=True)
+    overlay.dropLinesCache()
+    return counts
+
+
+def render_overlay(overlay, background=QtCore.Qt.transparent):
+    """Рисует оверлей (с панелью) в QImage — без показа окна."""
+    overlay._ensurePanel()
+    image = QtGui.QImage(overlay.size(), QtGui.QImage.Format_ARGB32_Premultiplied)
+    image.fill(background)
+    flags = QtWidgets.QWidget.RenderFlags(
+        QtWidgets.QWidget.DrawWindowBackground | QtWidgets.QWidget.DrawChildren
+    )
+    overlay.render(image, QtCore.QPoint(), QtGui.QRegion(overlay.rect()), flags)
+    return image
+
+###############################################################################
+# АВТОКАЛИБРОВКА ПО СЕТКЕ МИНИКАРТЫ
+###############################################################################
+class ScreenGrabber:
+    """Источник снимков области экрана: grab(region) -> массив HxWx3 uint8 (RGB)."""
+
+    def grab(self, region):
+        raise NotImplementedError
+
+    def grab_screen(self, region):
+        """Снимок именно этой области экрана (лупа); у GDI совпадает с grab()."""
+        return self.grab(region)
+
+
+class GdiScreenGrabber(ScreenGrabber):
+    """
+    BitBlt с рабочего стола без CAPTUREBLT: слоистые окна (в том числе сам
+    оверлей) в снимок не попадают, а копируется только область миникарты.
+    """
+
+    def grab(self, region):
+        if win32gui is None and not import_windows_modules():
+            raise RuntimeError("Снимок экрана через GDI требует pywin32.")
+        x, y, w, h = region
+        desktop = win32gui.GetDesktopWindow()
+        desktop_dc = win32gui.GetWindowDC(desktop)
+        src_dc = win32ui.CreateDCFromHandle(desktop_dc)
+        mem_dc = src_dc.CreateCompatibleDC()
+        bitmap = win32ui.CreateBitmap()
+        try:
+            bitmap.CreateCompatibleBitmap(src_dc, w, h)
+            mem_dc.SelectObject(bitmap)
+            mem_dc.BitBlt((0, 0), (w, h), src_dc, (x, y), win32con.SRCCOPY)
+            bgra = np.frombuffer(bitmap.GetBitmapBits(True), dtype=np.uint8).reshape(h, w, 4)
+            return bgra[:, :, 2::-1]
+        finally:
+            mem_dc.DeleteDC()
+            src_dc.DeleteDC()
+            win32gui.ReleaseDC(desktop, desktop_dc)
+            win32gui.DeleteObject(bitmap.GetHandle())
+
+
+class ImageFileGrabber(ScreenGrabber):
+    """
+    Снимок миникарты из файла (Linux, проверка на корпусе скриншотов).
+    Файл — уже вырезанная миникарта, region не используется; файл
+    перечитывается, только если изменился. Для лупы файл считается
+    лежащим на экране в точке origin (левый верхний угол).
+    """
+
+    def __init__(self, path, origin=(0, 0)):
+        self.path = path
+        self.origin = origin
+        self._mtime = None
+        self._pixels = None
+
+    def grab(self, region):
+        mtime = os.path.getmtime(self.path)
+        if mtime != self._mtime:
+            image = QtGui.QImage(self.path)
+            if image.isNull():
+                raise OSError(f"не удалось прочитать изображение {self.path}")
+            self._pixels = qimage_to_array(image)
+            self._mtime = mtime
+        return self._pixels
+
+    def grab_screen(self, region):
+        """Вырез region из файла, положенного в origin; за краями файла — чёрное."""
+        pixels = self.grab(region)
+        x, y, w, h = region
+        ox, oy = self.origin
+        ih, iw = pixels.shape[:2]
+        out = np.zeros((h, w, 3), dtype=np.uint8)
+        x0, y0 = max(x, ox), max(y, oy)
+        x1, y1 = min(x + w, ox + iw), min(y + h, oy + ih)
+        if x0 < x1 and y0 < y1:
+            out[y0 - y:y1 - y, x0 - x:x1 - x] = pixels[y0 - oy:y1 - oy, x0 - ox:x1 - ox]
+        return out
+
+
+def qimage_to_array(image):
+    """QImage -> массив HxWx3 uint8 (RGB). Данные копируются: буфер QImage живёт не дольше него."""
+    image = image.convertToFormat(QtGui.QImage.Format_RGB888)
+    w, h = image.width(), image.height()
+    bits = image.constBits()
+    bits.setsize(image.bytesPerLine() * h)
+    rows = np.frombuffer(bits, dtype=np.uint8).reshape(h, image.bytesPerLine())
+    return rows[:, :w * 3].reshape(h, w, 3).copy()
+
+
+def create_screen_grabber(args):
+    """Источник снимков: файл из --minimap-image, иначе GDI (Windows) или None."""
+    if args.minimap_image:
+        region = minimap_region(QtWidgets.QApplication.primaryScreen())
+        return ImageFileGrabber(args.minimap_image, origin=region[:2])
+    if sys.platform == "win32":
+        return GdiScreenGrabber()
+    return None
+
+
+def minimap_region(screen):
+    """Область миникарты (x, y, w, h) в физических пикселях экрана."""
+    if MINIMAP_REGION:
+        return MINIMAP_REGION
+    geometry = screen.geometry()
+    dpr = screen.devicePixelRatio()
+    right = round((geometry.x() + geometry.width()) * dpr)
+    bottom = round((geometry.y() + geometry.height()) * dpr)
+    side = int(geometry.height() * dpr * MINIMAP_FRACTION)
+    return (right - side, bottom - side, side, side)
+
+
+def _grid_profiles(pixels):
+    """
+    Профили линий сетки по столбцам и строкам: модуль второй разности
+    яркости (тонкая линия даёт сильный отклик, плавный рельеф — слабый),
+    просуммированный вдоль линии. Всё — векторно по всему снимку.
+    """
+    gray = pixels[..., :3].astype(np.float32) @ np.array((0.299, 0.587, 0.114), dtype=np.float32)
+    lines_x = np.abs(2.0 * gray[:, 1:-1] - gray[:, :-2] - gray[:, 2:])
+    lines_y = np.abs(2.0 * gray[1:-1, :] - gray[:-2, :] - gray[2:, :])
+    return lines_x.sum(axis=0), lines_y.sum(axis=1)
+
+
+def _parabolic_peak(values, i):
+    """Уточнение положения пика values[i] по параболе через соседей (±0.5 отсчёта)."""
+    a, b, c = values[i - 1], values[i], values[i + 1]
+    denom = a - 2.0 * b + c
+    return i + (0.5 * (a - c) / denom if denom else 0.0)
+
+
+def _profile_period(profile, min_lag, max_lag):
+    """
+    Период профиля по автокорреляции (через FFT). Берётся наименьший лаг,
+    чей пик не слабее 70% самого сильного (кратные шагу сетки лаги дают
+    почти такие же пики), затем период уточняется по самому дальнему
+    кратному пику. Возвращает (период в px или None, нормированный пик).
+    """
+    n = len(profile)
+    max_lag = min(max_lag, n // 2)
+    if max_lag <= min_lag + 2:
+        return None, 0.0
+    centered = profile - profile.mean()
+    spectrum = np.fft.rfft(centered, 2 * n)
+    ac = np.fft.irfft(spectrum * np.conj(spectrum), 2 * n)[:n]
+    if ac[0] <= 0:
+        return None, 0.0
+    # Несмещённая оценка: на лаге k перекрываются только n - k отсчётов
+    ac = ac / ac[0] * (n / (n - np.arange(n)))
+
+    window = ac[min_lag - 1:max_lag + 1]
+    is_peak = (window[1:-1] > window[:-2]) & (window[1:-1] >= window[2:])
+    peaks = np.arange(min_lag, max_lag)[is_peak]
+    if not len(peaks):
+        return None, 0.0
+    strongest = ac[peaks].max()
+    if strongest <= 0:
+        return None, 0.0
+    lag = int(peaks[ac[peaks] >= 0.7 * strongest][0])
+    period = _parabolic_peak(ac, lag)
+
+    multiple = int(max_lag // period)
+    if multiple >= 2:
+        center = int(round(multiple * period))
+        lo, hi = max(center - 2, 1), min(center + 3, n - 1)
+        far = lo + int(np.argmax(ac[lo:hi]))
+        if 0 < far < n - 1:
+            period = _parabolic_peak(ac, far) / multiple
+    return float(period), float(min(ac[lag], 1.0))
+
+
+def detect_grid_spacing(pixels, min_spacing=MIN_GRID_SPACING):
+    """
+    Шаг сетки миникарты в пикселях по снимку (HxWx3 uint8).
+    Возвращает (шаг или None, уверенность 0..1): по столбцам и по строкам
+    период ищется отдельно; если оба найдены и согласуются (±3%), берётся
+    взвешенное среднее, иначе — более уверенный. Профили сглаживаются окном
+    в 3 px: при дробном масштабе экрана (125%, 150%) одни линии попадают в
+    пиксель, другие размыты на два, и без сглаживания период через линию
+    выглядел сильнее настоящего.
+    """
+    box = np.ones(3, dtype=np.float32)
+    found = []
+    for profile in _grid_profiles(pixels):
+        profile = np.convolve(profile, box, "same")
+        period, confidence = _profile_period(profile, min_spacing, len(profile))
+        if period is not None:
+            found.append((confidence, period))
+    if not found:
+        return None, 0.0
+    found.sort(reverse=True)
+    confidence, spacing = found[0]
+    if len(found) == 2 and abs(found[0][1] - found[1][1]) <= 0.03 * spacing:
+        (c1, s1), (c2, s2) = found
+        spacing = (c1 * s1 + c2 * s2) / (c1 + c2)
+        confidence = (c1 + c2) / 2
+    if confidence < MIN_GRID_CONFIDENCE:
+        return None, confidence
+    return spacing, confidence
+
+
+class AutoCalibrator(QtCore.QObject):
+    """
+    Снимок миникарты и поиск шага сетки в рабочем потоке — GUI-поток не
+    ждёт ни снимка, ни анализа. Результат приходит в GUI-поток сигналом
+    finished(шаг в px или None, уверенность).
+    """
+
+    finished = QtCore.pyqtSignal(object, float)
+
+    def __init__(self, grabber, parent=None):
+        super().__init__(parent)
+        self.grabber = grabber
+        self._thread = None
+
+    @property
+    def busy(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self, region):
+        """Запускает поиск сетки; False — предыдущий ещё не закончился."""
+        if self.busy:
+            return False
+        self._thread = threading.Thread(
+            target=self._run, args=(region,), name="auto-calibration", daemon=True
+        )
+        self._thread.start()
+        return True
+
+    def _run(self, region):
+        start = time.perf_counter()
+        try:
+            spacing, confidence = detect_grid_spacing(self.grabber.grab(region))
+        except Exception:
+            logging.exception("Автокалибровка: ошибка снимка или анализа миникарты:")
+            spacing, confidence = None, 0.0
+        logging.debug(
+            f"Auto-calibration: region={region}, spacing={spacing}, confidence={confidence:.2f},"
+            f" {(time.perf_counter() - start) * 1000:.1f} ms"
+        )
+        # Сигнал из чужого потока доставляется в GUI-поток очередью
+        self.finished.emit(spacing, confidence)
+
+
+class MinimapWatcher(QtCore.QObject):
+    """
+    Фоновая перекалибровка при смене масштаба миникарты. Раз в 1/rate_hz с
+    снимает только область миникарты и проверяет её по нарастающей цене:
+      1) миниатюра (каждый 8-й пиксель) почти не изменилась — дальше не идём;
+      2) спектры профилей линий по прореженному снимку коррелируют с
+         опорными — изменилось содержимое (значки, сдвиг карты), а не сетка;
+      3) только иначе — полный detect_grid_spacing.
+    Новый шаг сетки засчитывается, если подтвердился на двух снимках подряд
+    (кадры анимации зума пропускаются); тогда сигнал spacingChanged(старый
+    шаг, новый шаг, уверенность) уходит в GUI-поток.
+    Паузы растягиваются так, чтобы CPU потока в среднем не превышал budget
+    доли ядра (разовый дорогой снимок отрабатывается последующими паузами).
+    """
+
+    spacingChanged = QtCore.pyqtSignal(float, float, float)
+
+    def __init__(self, grabber, region, rate_hz=MINIMAP_WATCH_HZ, budget=MINIMAP_WATCH_BUDGET, parent=None):
+        super().__init__(parent)
+        self.grabber = grabber
+        self.region = region
+        self.interval = 1.0 / rate_hz
+        self.budget = budget
+        self.stats = {"samples": 0, "same_frame": 0, "same_grid": 0, "analyses": 0, "changes": 0}
+        self._cpu = 0.0
+        self._started = None
+        self._rebase = True
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="minimap-watcher", daemon=True)
+
+    def start(self):
+        self._started = time.perf_counter()
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join(2.0)
+        wall = time.perf_counter() - self._started if self._started else 0.0
+        logging.info(
+            "Minimap watcher: " + ", ".join(f"{k}={v}" for k, v in self.stats.items())
+            + f", cpu={100.0 * self._cpu / wall if wall else 0.0:.3f}% of a core"
+        )
+
+    def rebase(self):
+        """Текущий масштаб привязан к тому, что сейчас на миникарте: шаг мерить заново."""
+        self._rebase = True
+
+    @staticmethod
+    def _thumbnail(pixels):
+        return pixels[::8, ::8, 1].astype(np.int16)
+
+    @staticmethod
+    def _grid_signature(pixels):
+        """
+        Дешёвая подпись сетки: амплитудные спектры профилей линий по
+        зелёному каналу каждой 8-й строки (для столбцов) и каждого 8-го
+        столбца (для строк). От сдвига карты (зум следует за игроком)
+        амплитудный спектр не зависит, от шага сетки — зависит.
+        """
+        rows = pixels[::8, :, 1].astype(np.float32)
+        cols = pixels[:, ::8, 1].astype(np.float32)
+        profile_x = np.abs(2.0 * rows[:, 1:-1] - rows[:, :-2] - rows[:, 2:]).sum(axis=0)
+        profile_y = np.abs(2.0 * cols[1:-1] - cols[:-2] - cols[2:]).sum(axis=1)
+        return tuple(np.abs(np.fft.rfft(p - p.mean()))[1:] for p in (profile_x, profile_y))
+
+    @staticmethod
+    def _same_grid(a, b):
+        for sa, sb in zip(a, b):
+            if sa.shape != sb.shape or np.corrcoef(sa, sb)[0, 1] < MINIMAP_PROFILE_CORRELATION:
+                return False
+        return True
+
+    def _run(self):
+        base = pending = None
+        ref_thumb = ref_profiles = None
+        delay = 0.0
+        while not self._stop.wait(delay):
+            start = time.thread_time()
+            if self._rebase:
+                self._rebase = False
+                base = pending = ref_thumb = ref_profiles = None
+            try:
+                pixels = self.grabber.grab(self.region)
+                self.stats["samples"] += 1
+                thumb = self._thumbnail(pixels)
+                if (ref_thumb is not None and thumb.shape == ref_thumb.shape
+                        and np.abs(thumb - ref_thumb).mean() < MINIMAP_THUMB_DIFF):
+                    self.stats["same_frame"] += 1
+                else:
+                    profiles = self._grid_signature(pixels)
+                    if ref_profiles is not None and self._same_grid(profiles, ref_profiles):
+                        self.stats["same_grid"] += 1
+                        ref_thumb = thumb
+                    else:
+                        self.stats["analyses"] += 1
+                        spacing, confidence = detect_grid_spacing(pixels)
+                        if spacing is not None:
+                            if base is None or abs(spacing - base) <= MINIMAP_SPACING_TOLERANCE * base:
+                                base, pending = base or spacing, None
+                                ref_thumb, ref_profiles = thumb, profiles
+                            elif pending is not None and abs(spacing - pending) <= MINIMAP_SPACING_TOLERANCE * pending:
+                                self.stats["changes"] += 1
+                                logging.debug(f"Minimap grid spacing {base:.2f} -> {spacing:.2f} px")
+                                self.spacingChanged.emit(base, spacing, confidence)
+                                base, pending = spacing, None
+                                ref_thumb, ref_profiles = thumb, profiles
+                            else:
+                                pending = spacing
+            except Exception:
+                logging.exception("Слежение за миникартой: ошибка снимка или анализа:")
+            self._cpu += time.thread_time() - start
+            # Пауза не короче интервала и такая, чтобы за всё время работы
+            # CPU потока / прошедшее время не превышало budget
+            delay = max(self.interval, self._cpu / self.budget - (time.perf_counter() - self._started))
+
+###############################################################################
+# СЛЕЖЕНИЕ ЗА МЕТКАМИ НА МИНИКАРТЕ
+###############################################################################
+def array_to_qimage(pixels):
+    """Массив HxWx3 uint8 (RGB) -> QImage (с копией данных)."""
+    h, w, _ = pixels.shape
+    data = np.ascontiguousarray(pixels)
+    return QtGui.QImage(data.data, w, h, 3 * w, QtGui.QImage.Format_RGB888).copy()
+
+
+def _marker_luts():
+    """
+    Таблицы канал -> битовая маска классов: бит k в lut[c][v] стоит, если
+    значение v канала c в допуске класса k из MARKER_COLORS (до 8 классов).
+    """
+    luts = np.zeros((3, 256), dtype=np.uint8)
+    values = np.arange(256)
+    for bit, (color, tolerance) in enumerate(MARKER_COLORS.values()):
+        for channel, value in enumerate(color):
+            luts[channel, np.abs(values - value) <= tolerance] |= 1 << bit
+    return luts
+
+
+def marker_masks(pixels, luts=None):
+    """
+    Маски всех классов цвета за один проход: три выборки по таблицам и два
+    AND дают байт с битом на класс (вместо сравнений канала с диапазоном
+    для каждого класса отдельно). Возвращает {класс: маска}.
+    """
+    if luts is None:
+        luts = _marker_luts()
+    bits = np.take(luts[0], pixels[..., 0])
+    bits &= np.take(luts[1], pixels[..., 1])
+    bits &= np.take(luts[2], pixels[..., 2])
+    return {kind: (bits & (1 << bit)) != 0 for bit, kind in enumerate(MARKER_COLORS)}
+
+
+def find_components(mask, min_pixels=MARKER_MIN_PIXELS, max_pixels=MARKER_MAX_PIXELS):
+    """
+    Связные области маски (4-связность): список (x, y, пикселей) по центроидам.
+    Работаем только с отмеченными пикселями: соседей справа и снизу находим
+    через searchsorted по линейным индексам, метки сводим подвешиванием
+    корней к меньшей метке и сжатием путей (labels = labels[labels]) — за
+    O(log n) векторных проходов, а не проход на каждый пиксель диаметра.
+    """
+    h, w = mask.shape
+    idx = np.flatnonzero(mask)
+    n = len(idx)
+    if not n:
+        return []
+    edges_a, edges_b = [], []
+    for offset, allowed in ((1, idx % w != w - 1), (w, idx < (h - 1) * w)):
+        pos = np.minimum(np.searchsorted(idx, idx + offset), n - 1)
+        hit = allowed & (idx[pos] == idx + offset)
+        edges_a.append(np.flatnonzero(hit))
+        edges_b.append(pos[hit])
+    a = np.concatenate(edges_a)
+    b = np.concatenate(edges_b)
+
+    labels = np.arange(n)
+    while True:
+        root_a, root_b = labels[a], labels[b]
+        low = np.minimum(root_a, root_b)
+        hooked = labels.copy()
+        np.minimum.at(hooked, root_a, low)
+        np.minimum.at(hooked, root_b, low)
+        while True:
+            jumped = hooked[hooked]
+            if np.array_equal(jumped, hooked):
+                break
+            hooked = jumped
+        if np.array_equal(hooked, labels):
+            break
+        labels = hooked
+
+    _, component, counts = np.unique(labels, return_inverse=True, return_counts=True)
+    ys, xs = np.divmod(idx, w)
+    cx = np.bincount(component, weights=xs) / counts
+    cy = np.bincount(component, weights=ys) / counts
+    keep = (counts >= min_pixels) & (counts <= max_pixels)
+    return list(zip(cx[keep].tolist(), cy[keep].tolist(), counts[keep].tolist()))
+
+
+class MarkerFrame:
+    """Метки одного снимка миникарты; координаты — в пикселях экрана."""
+
+    __slots__ = ("seq", "player", "targets", "process_ms")
+
+    def __init__(self, seq, player, targets, process_ms):
+        self.seq = seq
+        self.player = player      # (x, y) или None
+        self.targets = targets    # [(класс, x, y), ...]
+        self.process_ms = process_ms
+
+
+class MarkerTracker(QtCore.QObject):
+    """
+    Слежение за метками миникарты с фиксированной частотой rate_hz.
+    Поток захвата снимает только область миникарты и пропускает кадр,
+    если он побайтно совпал с прошлым. У изменившегося кадра маски всех
+    классов цвета строятся одним проходом (marker_masks); класс, чья маска
+    не изменилась, берёт прошлые области, а связные области остальных
+    ищет пул потоков — по классу на задачу (numpy отпускает GIL). Новый
+    результат уходит в GUI-поток сигналом markersFound, только если метки
+    сдвинулись.
+    """
+
+    markersFound = QtCore.pyqtSignal(object)
+
+    def __init__(self, grabber, region, rate_hz=MARKER_TRACK_HZ, workers=MARKER_WORKERS,
+                 record_dir=None, parent=None):
+        super().__init__(parent)
+        self.grabber = grabber
+        self.region = region
+        self.interval = 1.0 / rate_hz
+        self.record_dir = record_dir
+        self.stats = {"frames": 0, "same_frame": 0, "same_masks": 0, "processed": 0}
+        self.process_ms = []
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="marker-worker")
+        self._luts = _marker_luts()
+        self._masks = {}       # класс -> маска прошлого кадра
+        self._components = {}  # класс -> области прошлого кадра
+        self._previous = None  # прошлый снимок
+        self._seq = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="marker-tracker", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join(2.0)
+        self._pool.shutdown(wait=True)
+        timing = ""
+        if self.process_ms:
+            ordered = sorted(self.process_ms)
+            timing = f", process p50={ordered[len(ordered) // 2]:.2f} ms, max={ordered[-1]:.2f} ms"
+        logging.info("Marker tracker: " + ", ".join(f"{k}={v}" for k, v in self.stats.items()) + timing)
+
+    def _label(self, kind, mask):
+        self._components[kind] = find_components(mask)
+
+    def feed(self, pixels):
+        """
+        Очередной снимок: MarkerFrame или None, если кадр побайтно тот же
+        или все маски совпали с прошлыми. Вызывается из потока захвата (и
+        из bench.py на записанных последовательностях).
+        """
+        self.stats["frames"] += 1
+        previous = self._previous
+        if previous is not None and (pixels is previous or np.array_equal(pixels, previous)):
+            self.stats["same_frame"] += 1
+            return None
+        self._previous = pixels
+        self._seq += 1
+        if self.record_dir:
+            array_to_qimage(pixels).save(os.path.join(self.record_dir, f"frame_{self._seq:06d}.png"))
+        return self.process(pixels, self._seq)
+
+    def process(self, pixels, seq=0):
+        """Разбирает один снимок: MarkerFrame или None, если все маски совпали с прошлым кадром."""
+        start = time.perf_counter()
+        changed = []
+        for kind, mask in marker_masks(pixels, self._luts).items():
+            previous = self._masks.get(kind)
+            if previous is None or not np.array_equal(mask, previous):
+                self._masks[kind] = mask
+                changed.append((kind, mask))
+        if not changed:
+            self.stats["same_masks"] += 1
+            return None
+        for future in [self._pool.submit(self._label, kind, mask) for kind, mask in changed]:
+            future.result()
+        self.stats["processed"] += 1
+
+        ox, oy = self.region[0], self.region[1]
+        player = None
+        players = self._components.get("player") or []
+        if players:
+            x, y, _ = max(players, key=lambda c: c[2])
+            player = (ox + x, oy + y)
+        targets = [
+            (kind, ox + x, oy + y)
+            for kind in MARKER_COLORS if kind != "player"
+            for x, y, _ in self._components.get(kind, ())
+        ]
+        process_ms = (time.perf_counter() - start) * 1000
+        self.process_ms.append(process_ms)
+        return MarkerFrame(seq, player, targets, process_ms)
+
+    def _run(self):
+        next_time = time.perf_counter()
+        while not self._stop.wait(max(0.0, next_time - time.perf_counter())):
+            next_time += self.interval
+            try:
+                frame = self.feed(self.grabber.grab(self.region))
+                if frame is not None:
+                    self.markersFound.emit(frame)
+            except Exception:
+                logging.exception("Слежение за метками: ошибка снимка или анализа:")
+            # Не догоняем пропущенные такты, если обработка не уложилась в период
+            next_time = max(next_time, time.perf_counter())
+
+###############################################################################
+# ЛУПА И ПРИВЯЗКА КОНЦОВ
+###############################################################################
+def grid_crossing(pixels, cx, cy, radius=LOUPE_SNAP_RADIUS):
+    """
+    Пересечение линий сетки у точки (cx, cy) малого снимка: в профилях
+    _grid_profiles берётся самый сильный столбец и строка не дальше radius,
+    если они выделяются над медианой профиля (LOUPE_LINE_CONTRAST), и
+    уточняется по параболе. Возвращает (x, y) или None.
+    """
+    crossing = []
+    for profile, center in zip(_grid_profiles(pixels), (cx, cy)):
+        # Отсчёт i профиля — столбец/строка i + 1 снимка (вторая разность)
+        lo = max(1, int(center - radius) - 1)
+        hi = min(len(profile) - 1, int(center + radius))
+        if hi <= lo:
+            return None
+        i = lo + int(np.argmax(profile[lo:hi]))
+        if profile[i] <= LOUPE_LINE_CONTRAST * max(float(np.median(profile)), 1.0):
+            return None
+        crossing.append(float(_parabolic_peak(profile, i)) + 1.0)
+    return tuple(crossing)
+
+
+def snap_point(pixels, cx, cy, radius=LOUPE_SNAP_RADIUS, luts=None):
+    """
+    Куда привязать точку (cx, cy) малого снимка: к ближайшему центроиду метки
+    (marker_masks + find_components) или пересечению сетки (grid_crossing) —
+    с долями пикселя. None — в радиусе radius ничего нет.
+    """
+    candidates = [
+        (x, y)
+        for mask in marker_masks(pixels, luts).values()
+        for x, y, _ in find_components(mask)
+    ]
+    crossing = grid_crossing(pixels, cx, cy, radius)
+    if crossing is not None:
+        candidates.append(crossing)
+    best, best_d2 = None, radius * radius
+    for x, y in candidates:
+        d2 = (x - cx) ** 2 + (y - cy) ** 2
+        if d2 <= best_d2:
+            best, best_d2 = (x, y), d2
+    return best
+
+
+class LoupeFrame:
+    """Кадр лупы: позиция курсора, снимок вокруг неё и точка привязки (в пикселях экрана)."""
+
+    __slots__ = ("pos", "image", "snap", "time")
+
+    def __init__(self, pos, image, snap, time_s):
+        self.pos = pos        # (x, y) курсора, вокруг которого снят кадр
+        self.image = image    # QImage (2r+1)x(2r+1)
+        self.snap = snap      # (x, y) или None
+        self.time = time_s    # time.perf_counter() снимка
+
+
+class LoupeGrabber(QtCore.QObject):
+    """
+    Снимки для лупы в рабочем потоке, не чаще rate_hz: только квадрат
+    (2 * radius + 1) px вокруг последней позиции курсора из хука
+    (_latest_move), никогда не весь экран. Там же ищется точка привязки
+    (snap_point). Пока курсор стоит, кадр снимается с полной частотой только
+    во время протяжки (live), иначе — раз в LOUPE_IDLE_INTERVAL: миникарта
+    под курсором может сдвинуться. Побайтно тот же кадр дальше не
+    отправляется — у уже отправленного лишь обновляется time (подтверждён).
+    Готовый кадр уходит в GUI-поток сигналом frameReady.
+    """
+
+    frameReady = QtCore.pyqtSignal(object)
+
+    def __init__(self, grabber, radius=LOUPE_RADIUS, rate_hz=LOUPE_HZ, parent=None):
+        super().__init__(parent)
+        self.grabber = grabber
+        self.radius = radius
+        self.interval = 1.0 / rate_hz
+        self.stats = {"grabs": 0, "same_frame": 0, "snapped": 0}
+        self.grab_ms = deque(maxlen=1000)  # последние замеры, для p50/max в stop()
+        self._luts = _marker_luts()
+        self._live = False
+        self._previous = None  # (позиция, снимок, LoupeFrame) прошлого кадра
+        self._active = threading.Event()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="loupe-grabber", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._active.set()
+        self._thread.join(2.0)
+        timing = ""
+        if self.grab_ms:
+            ordered = sorted(self.grab_ms)
+            timing = f", grab+snap p50={ordered[len(ordered) // 2]:.2f} ms, max={ordered[-1]:.2f} ms"
+        logging.info("Loupe: " + ", ".join(f"{k}={v}" for k, v in self.stats.items()) + timing)
+
+    def set_active(self, active, live=False):
+        """Снимать ли кадры (окно следит за курсором) и обновлять ли их при неподвижном курсоре."""
+        self._live = live
+        if active:
+            self._active.set()
+        else:
+            self._active.clear()
+
+    def feed(self, pos):
+        """
+        Кадр вокруг pos: LoupeFrame или None, если он побайтно тот же, что
+        прошлый (тогда у прошлого обновляется time).
+        """
+        start = time.perf_counter()
+        r = self.radius
+        x, y = int(round(pos[0])), int(round(pos[1]))
+        pixels = self.grabber.grab_screen((x - r, y - r, 2 * r + 1, 2 * r + 1))
+        self.stats["grabs"] += 1
+        previous = self._previous
+        if previous is not None and previous[0] == (x, y) and np.array_equal(previous[1], pixels):
+            self.stats["same_frame"] += 1
+            previous[2].time = start  # одно присваивание: GUI-поток видит старое или новое
+            return None
+        snap = snap_point(pixels, r + (pos[0] - x), r + (pos[1] - y), luts=self._luts)
+        if snap is not None:
+            self.stats["snapped"] += 1
+            snap = (x - r + snap[0], y - r + snap[1])
+        self.grab_ms.append((time.perf_counter() - start) * 1000)
+        frame = LoupeFrame((x, y), array_to_qimage(pixels), snap, start)
+        self._previous = ((x, y), pixels, frame)
+        return frame
+
+    def _run(self):
+        next_time = time.perf_counter()
+        last_pos = None
+        last_grab = 0.0
+        while not self._stop.is_set():
+            self._active.wait()
+            if self._stop.wait(max(0.0, next_time - time.perf_counter())):
+                break
+            # Не догоняем пропущенные такты (в том числе время простоя)
+            now = time.perf_counter()
+            next_time = max(next_time + self.interval, now)
+            pos = _latest_move
+            if pos is None:
+                continue
+            if pos == last_pos and not self._live and now - last_grab < LOUPE_IDLE_INTERVAL:
+                continue
+            last_pos = pos
+            last_grab = now
+            try:
+                frame = self.feed(pos)
+                if frame is not None:
+                    self.frameReady.emit(frame)
+            except Exception:
+                logging.exception("Лупа: ошибка снимка или привязки:")
+
+
+class LoupeWidget(QtWidgets.QWidget):
+    """
+    Лупа на оверлее: кадр LoupeFrame, увеличенный без сглаживания (видны
+    отдельные пиксели), перекрестие курсора и кружок на точке привязки.
+    Дочерний виджет: setFrame() перерисовывает только его прямоугольник.
+    """
+
+    def __init__(self, parent, radius=LOUPE_RADIUS, zoom=LOUPE_ZOOM):
+        super().__init__(parent)
+        self.setAttribute(QtCore.Qt.WA_TransparentForMouseEvents, True)
+        # Кадр закрывает виджет целиком: оверлей под ним не перерисовывается
+        self.setAttribute(QtCore.Qt.WA_OpaquePaintEvent, True)
+        self.radius = radius
+        self.zoom = zoom
+        side = (2 * radius + 1) * zoom
+        self.setFixedSize(side, side)
+        self.frame = None
+        self._border_pen = QtGui.QPen(QtGui.QColor(255, 255, 255, 220), 2)
+        self._cross_pen = QtGui.QPen(QtGui.QColor(255, 200, 0, 220), 1)
+        self._snap_pen = QtGui.QPen(QtGui.QColor(0, 255, 120, 240), 2)
+        self.hide()
+
+    def setFrame(self, frame):
+        self.frame = frame
+        self.update()
+
+    def paintEvent(self, event):
+        painter = QtGui.QPainter(self)
+        frame = self.frame
+        if frame is not None:
+            painter.drawImage(self.rect(), frame.image)
+        zoom = self.zoom
+        center = (self.radius + 0.5) * zoom
+        painter.setPen(self._cross_pen)
+        painter.drawLine(QtCore.QLineF(center, 0, center, center - zoom))
+        painter.drawLine(QtCore.QLineF(center, center + zoom, center, self.height()))
+        painter.drawLine(QtCore.QLineF(0, center, center - zoom, center))
+        painter.drawLine(QtCore.QLineF(center + zoom, center, self.width(), center))
+        if frame is not None and frame.snap is not None:
+            painter.setRenderHint(QtGui.QPainter.Antialiasing)
+            painter.setPen(self._snap_pen)
+            sx = center + (frame.snap[0] - frame.pos[0]) * zoom
+            sy = center + (frame.snap[1] - frame.pos[1]) * zoom
+            painter.drawEllipse(QtCore.QPointF(sx, sy), 2 * zoom, 2 * zoom)
+        painter.setRenderHint(QtGui.QPainter.Antialiasing, False)
+        painter.setPen(self._border_pen)
+        painter.drawRect(self.rect().adjusted(1, 1, -1, -1))
+        painter.end()
+
+###############################################################################
+# ПОДПИСИ И ТЕКСТЫ ПАНЕЛИ
+###############################################################################
+# Постоянные тексты панели: QLabel под каждый строится один раз и дальше
+# только показывается (OverlayWindow.showState), без повторной раскладки.
+INFO_TEXTS = {
+    "latency_on": (
+        "Замер задержек ВКЛ.\n"
+        "Рисуйте отрезки ПКМ; Ctrl+Shift+L — остановить и сохранить отчёт."
+    ),
+    "not_calibrated": "Сначала нужно откалиброваться (нажмите 'c').",
+    "lines_cleared": (
+        "Все линии очищены.\n"
+        "Продолжайте измерения (ПКМ) или нажмите '=' для настроек."
+    ),
+    "measuring_on": (
+        "Режим измерений (ПКМ) ВКЛ.\n"
+        "Первый отрезок — калибровка (если не сделано) или 'c' для перекалибровки.\n"
+        "ЛКМ идёт в игру.\n"
+        "Нажмите '=': выключить измерения.\n"
+        "Нажмите '-,=': очистить линии.\n"
+        "Ctrl+Shift+Q: закрыть."
+    ),
+    "measuring_off": (
+        "Режим измерений ВЫКЛ.\n"
+        "Клики (в т.ч. ПКМ) идут в игру.\n"
+        "Нажмите '=': снова включить.\n"
+        "Ctrl+Shift+Q: закрыть.\n"
+        "'-,=': очистить линии в любой момент."
+    ),
+    "calibration_mode": (
+        "Режим калибровки ВКЛ (ПКМ).\n"
+        "Протяните новую линию и введите реальную длину.\n"
+        "Нажмите '=': отключить измерения.\n"
+        "Ctrl+Shift+Q: закрыть."
+    ),
+    "calibration_bad_number": "Не удалось распознать число. Введите длину в метрах.",
+    "calibration_bad_length": "Некорректная длина. Введите положительное число.",
+    "calibration_canceled": (
+        "Калибровка отменена.\n"
+        "Протяните новую линию ПКМ, чтобы откалибровать, или '=' — выключить измерения."
+    ),
+    "autocal_unavailable": "Автокалибровка недоступна: нет источника снимков экрана.",
+    "autocal_searching": "Автокалибровка: ищу сетку на миникарте...",
+    "tracking_off": "Слежение за метками ВЫКЛ.",
+    "tracking_unavailable": "Слежение за метками недоступно: нет источника снимков экрана.",
+    "tracking_searching": "Слежение за метками ВКЛ: ищу свою стрелку и метки на миникарте...",
+    "tracking_no_player": "Слежение: своя стрелка на миникарте не найдена.",
+    "route_on": (
+        "Режим маршрута ВКЛ.\n"
+        "Первая протяжка ПКМ задаёт начало, каждая следующая продолжает от конца предыдущей.\n"
+        "Ctrl+Shift+Z: отменить последнее колено; Ctrl+Shift+R: закончить маршрут."
+    ),
+    "route_off": "Режим маршрута ВЫКЛ. Отрезки маршрута остаются на экране.",
+    "route_empty": "Маршрут пуст: отменять нечего.",
+    "fan_on": (
+        "Веер дальностей ВКЛ.\n"
+        "Клик ПКМ: сначала начало, затем цели. Протяжка ПКМ переносит начало.\n"
+        "Ctrl+Shift+F: выключить."
+    ),
+    "fan_off": "Веер дальностей ВЫКЛ.",
+    "loupe_on": (
+        "Лупа ВКЛ.\n"
+        "Во время протяжки ПКМ у курсора — увеличенный снимок; концы отрезков\n"
+        "привязываются к центру метки или пересечению сетки рядом с курсором.\n"
+        "Ctrl+Shift+M: выключить."
+    ),
+    "loupe_off": "Лупа ВЫКЛ.",
+    "loupe_unavailable": "Лупа недоступна: нет источника снимков экрана.",
+    "segment_deleted": (
+        "Отрезок удалён.\n"
+        "Наведите курсор на отрезок и нажмите Delete, чтобы удалить ещё."
+    ),
+}
+
+
+def format_length_label(length, angle_deg, digits, unit):
+    """Подпись «длина, азимут»: digits знаков после запятой у длины."""
+    return f"{length:.{digits}f} {unit}, {angle_deg:.1f}°"
+
+
+class LabelCache:
+    """
+    Подписи как подготовленный QStaticText: ключ -> (округлённые значения,
+    QStaticText). Строка форматируется и раскладывается заново, только если
+    изменились длина/азимут в точности подписи или единицы (то есть масштаб);
+    в установившемся кадре отрисовка — один drawStaticText без форматирования
+    и раскладки текста.
+    """
+
+    def __init__(self, font):
+        self.font = font
+        self._entries = {}
+        self.builds = 0
+
+    def get(self, key, length, angle_deg, digits, unit):
+        values = (round(length, digits), round(angle_deg, 1), unit)
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] == values:
+            return entry[1]
+        static = QtGui.QStaticText(format_length_label(length, angle_deg, digits, unit))
+        static.setTextFormat(QtCore.Qt.PlainText)
+        static.setPerformanceHint(QtGui.QStaticText.AggressiveCaching)
+        static.prepare(QtGui.QTransform(), self.font)
+        self._entries[key] = (values, static)
+        self.builds += 1
+        return static
+
+    def discard(self, key):
+        self._entries.pop(key, None)
+
+    def clear(self):
+        self._entries.clear()
 
 ###############################################################################
 # PYQT-КЛАСС: Оверлей на весь экран
@@ -192,6 +2823,73 @@ class OverlayWindow(QtWidgets.QMainWindow):
     ЛКМ идёт в игру, калибровка — при нажатии 'c', очистка линий — '-,='.
     """
 
+    @property
+    def is_measuring(self):
+        return self._is_measuring
+
+    @is_measuring.setter
+    def is_measuring(self, value):
+        self._is_measuring = value
+        self._publishHookState()
+
+    def _publishHookState(self):
+        """Обновляет снимок состояния, который читают хук и хоткеи."""
+        global _overlay_visible, _hook_armed, _hover_tracking, _overlay_starting
+        global _text_entry_open
+        visible = self.isVisible()
+        _overlay_visible = visible
+        _text_entry_open = visible and self._calibrationRowVisible()
+        if visible:
+            _overlay_starting = False
+        _hook_armed = visible and self._is_measuring
+        _hover_tracking = HOVER_SELECT and _hook_armed
+        if not _hover_tracking and self.hovered_id is not None:
+            self._setHovered(None)
+        self._syncMoveTimer()
+
+    def showEvent(self, event):
+        super().showEvent(event)
+        self._publishHookState()
+
+    def hideEvent(self, event):
+        super().hideEvent(event)
+        self._publishHookState()
+
+    @QtCore.pyqtSlot()
+    def drainInput(self):
+        """Разбирает за один проход все события, накопленные в кольце ввода."""
+        input_ring.drain(self._handleInput)
+
+    def _handleInput(self, kind, x, y, t_ns):
+        handler = self._input_handlers.get(kind)
+        if handler is None:
+            return
+        if kind == EV_RMB_UP and latency_probe.enabled:
+            latency_probe.begin(t_ns)
+            handler(x, y)
+            latency_probe.end_input()
+        elif kind in (EV_RMB_DOWN, EV_RMB_UP):
+            handler(x, y)
+        else:
+            handler()
+
+    @QtCore.pyqtSlot()
+    def toggleLatencyProbe(self):
+        """Вкл/выкл замера задержек; при выключении — отчёт в панель и в файлы."""
+        latency_probe.set_enabled(not latency_probe.enabled)
+        if latency_probe.enabled:
+            self.showState("latency_on")
+            return
+        summary = latency_probe.summary()
+        lines = [
+            f"{stage}: p50 {v['p50_us']:.0f} / p95 {v['p95_us']:.0f} / p99 {v['p99_us']:.0f} мкс"
+            for stage, v in summary.items() if v["count"]
+        ]
+        self.text_info = "Замер задержек ВЫКЛ.\n" + ("\n".join(lines) or "Нет замеров.")
+        if summary["total"]["count"]:
+            latency_probe.export(LATENCY_EXPORT_PREFIX)
+        self.showInfo()
+
     @QtCore.pyqtSlot(int, int)
     def onMouseRightDown(self, x, y):
         """Обработчик клика ПКМ (Down) — вызывается из глобального хука."""
@@ -199,12 +2897,34 @@ class OverlayWindow(QtWidgets.QMainWindow):
 
         if not self.is_measuring:
             return
+        x, y = self._snapPoint(x, y)
+
+        # ПКМ у конца существующего отрезка — перетаскиваем этот конец;
+        # в режиме маршрута концы не хватаются: протяжка идёт от конца
+        # маршрута, а первое колено — от точки нажатия
+        self.drag_endpoint = None
+        if self.route_mode and not self.is_calibrating:
+            if self.route:
+                x, y = self.route.end
+        elif HOVER_SELECT and not self.is_calibrating and not self.fan_mode:
+            hit = self.segments.nearest_endpoint(x, y, ENDPOINT_GRAB_RADIUS)
+            if hit is not None:
+                seg_id, which = hit
+                x1, y1, x2, y2 = self.segments.segment(seg_id)
+                self.drag_endpoint = hit
+                # Протяжка идёт от неподвижного конца
+                x, y = (x2, y2) if which == 0 else (x1, y1)
+                logging.debug(f"Dragging endpoint {which} of segment {seg_id}")
 
         # Начинаем рисовать линию
         self.is_drawing = True
         self.first_point = (x, y)
         logging.debug(f"First point set to {self.first_point}")
 
+        if LIVE_PREVIEW:
+            self.preview_point = None
+            self._syncMoveTimer()
+
     @QtCore.pyqtSlot(int, int)
     def onMouseRightUp(self, x, y):
         """Обработчик клика ПКМ (Up) — вызывается из глобального хука."""
@@ -214,6 +2934,8 @@ class OverlayWindow(QtWidgets.QMainWindow):
                 f"is_measuring={self.is_measuring}, first_point={self.first_point}"
             )
 
+            self._stopPreview()
+
             if not self.is_measuring:
                 return
 
@@ -221,9 +2943,18 @@ class OverlayWindow(QtWidgets.QMainWindow):
                 return
 
             x1, y1 = self.first_point
-            x2, y2 = x, y
+            x2, y2 = self._snapPoint(x, y)
             self.first_point = None
             self.is_drawing = False
+            self._syncMoveTimer()
+
+            if self.drag_endpoint is not None:
+                self._finishEndpointDrag(x1, y1, x2, y2)
+                return
+
+            if self.fan_mode and not self.is_calibrating:
+                self._fanClick(x1, y1, x2, y2)
+                return
 
             # Рассчитываем расстояние между точками
             dist_px = self._distance_in_pixels(x1, y1, x2, y2)
@@ -237,88 +2968,53 @@ class OverlayWindow(QtWidgets.QMainWindow):
 
             logging.debug(f"Distance in pixels: {dist_px:.2f}")
 
-            # Если калибруемся
+            # Если калибруемся — длину в метрах вводят в панели, GUI-цикл не блокируется;
+            # новая протяжка до ввода просто заменяет замер
             if self.is_calibrating:
-                if self.is_calibration_dialog_open:
-                    self.text_info = "Окно калибровки уже открыто, введите число или закройте диалог."
-                    self.update()
-                    return
-
-                self.is_calibration_dialog_open = True
-                old_meas = self.is_measuring
-                self.is_measuring = False  # чтобы не ловить клики в диалоге
-
-                text, ok = QtWidgets.QInputDialog.getText(
-                    self,
-                    "Калибровка",
-                    f"Вы протянули {dist_px:.1f} px.\nСколько это в метрах?"
+                self.pending_calibration_px = dist_px
+                self.text_info = (
+                    f"Вы протянули {dist_px:.1f} px.\n"
+                    "Сколько это в метрах? Введите число и нажмите Enter\n"
+                    "или выберите размер квадрата. Новая протяжка ПКМ заменит замер."
                 )
-                logging.debug(f"Calibration dialog: text='{text}', ok={ok}")
-
-                if ok and text.strip():
-                    try:
-                        real_length = float(text.replace(',', '.'))
-                        logging.debug(f"Parsed real_length={real_length}")
-                        if real_length > 0:
-                            self.scale_factor = real_length / dist_px
-                            self.is_calibrating = False
-                            # Снова включаем измерения
-                            self.is_measuring = True
-                            self.text_info = (
-                                f"Калибровка завершена:\n"
-                                f"1 px = {self.scale_factor:.4f} м.\n"
-                                "Теперь рисуйте новые отрезки (ПКМ) или "
-                                "нажмите '-,=' чтобы очистить."
-                            )
-                            logging.debug(
-                                f"Calibration success. scale_factor={self.scale_factor}"
-                            )
-                        else:
-                            self.text_info = "Некорректная длина. Калибровка не выполнена."
-                            logging.debug("Calibration failed: non-positive real_length.")
-                    except ValueError:
-                        self.text_info = "Не удалось распознать число. Калибровка не выполнена."
-                        logging.debug("Calibration failed: ValueError on input.")
-                else:
-                    self.text_info = "Калибровка отменена или не введено число."
-                    logging.debug("Calibration canceled or empty input.")
-
-                # Если калибровка провалилась, оставим is_calibrating = True
-                if not hasattr(self, 'scale_factor') or self.scale_factor is None:
-                    self.is_calibrating = True
-
-                self.is_measuring = old_meas
-                self.is_calibration_dialog_open = False
-                self.update()
+                self.showInfo()
+                self._showCalibrationEntry(True)
 
             else:
                 # Мы уже откалиброваны — сохраняем отрезок
                 if self.scale_factor is not None and self.scale_factor > 0:
                     dist_m = dist_px * self.scale_factor
-                    dx = x2 - x1
-                    dy = y2 - y1
-                    # Угол: 0° — вверх, 90° — вправо, 180° — вниз
-                    angle_deg = math.degrees(math.atan2(dx, (y1 - y2)))
-                    angle_deg %= 360
-
-                    self.lines.append((x1, y1, x2, y2, dist_m, angle_deg))
-                    self.text_info = (
-                        f"Новый отрезок: {dist_m:.2f} м, {angle_deg:.2f}°\n"
-                        f"(в пикселях: {dist_px:.1f})\n"
-                        "Продолжайте рисовать ПКМ или нажмите '-,=' для очистки.\n"
-                        "Нажмите 'c' для повторной калибровки."
-                    )
+                    angle_deg = self._bearing_deg(x1, y1, x2, y2)
+
+                    seg_id = self.segments.add(x1, y1, x2, y2)
+                    # Перерисовываем только область нового отрезка
+                    rect = self._segment_rect(x1, y1, x2, y2, self._label_for(seg_id, dist_m, angle_deg))
+                    self._addToMask(rect)
+                    self.update(rect)
+                    if latency_probe.enabled:
+                        latency_probe.mark_update()
+                    if self.route_mode:
+                        turn = self.route.add(seg_id, x2, y2, dist_px, angle_deg)
+                        self._showRouteInfo(dist_m, angle_deg, turn)
+                    else:
+                        self.text_info = (
+                            f"Новый отрезок: {dist_m:.2f} м, {angle_deg:.2f}°\n"
+                            f"(в пикселях: {dist_px:.1f})\n"
+                            "Продолжайте рисовать ПКМ или нажмите '-,=' для очистки.\n"
+                            "Нажмите 'c' для повторной калибровки."
+                        )
                     logging.debug(
                         f"New segment: {dist_m:.2f} m, {angle_deg:.2f} deg. "
-                        f"Lines total={len(self.lines)}"
+                        f"Lines total={len(self.segments)}"
                     )
-                    print("Ваш отрезок:", dist_m, "м, угол:", angle_deg, "° (px:", dist_px, ")")
+                    session_log.log("segment", id=seg_id, x1=x1, y1=y1, x2=x2, y2=y2,
+                                    px=round(dist_px, 2), m=round(dist_m, 2), bearing=round(angle_deg, 2))
+                    if not self.route_mode:
+                        self.showInfo()
                 else:
-                    self.text_info = "Сначала нужно откалиброваться (нажмите 'c')."
+                    self.showState("not_calibrated")
                     logging.debug("Attempted to measure without valid calibration.")
 
-                self.update()
-
         except Exception as e:
             logging.exception("Ошибка в onMouseRightUp:")
 
@@ -342,20 +3038,111 @@ class OverlayWindow(QtWidgets.QMainWindow):
         self.setGeometry(0, 0, screen.width(), screen.height())
 
         # Переменные для логики измерения
-        self.is_measuring = False
+        self._is_measuring = False
         self.is_calibrating = True
-        self.is_calibration_dialog_open = False
+        self.pending_calibration_px = None  # протянутая при калибровке длина, ждёт ввода метров
+        self._focus_return_hwnd = None  # окно, которому вернуть фокус после ввода длины
         self.scale_factor = None
 
+        # Сохранённые калибровки: если для этого экрана и профиля масштаб
+        # уже известен, калибровка при старте не нужна
+        self.calibrations = CalibrationStore(
+            CALIBRATION_STORE_PATH, screen_key(QtWidgets.QApplication.primaryScreen())
+        )
+        if self.calibrations.scale:
+            self.scale_factor = self.calibrations.scale
+            self.is_calibrating = False
+        self.auto_calibrator = None  # создаётся при первой автокалибровке
+        self.minimap_watcher = None  # фоновое слежение за зумом миникарты
+        self.marker_tracker = None   # слежение за метками на миникарте
+        self._player_pos = None      # своя стрелка по последнему кадру слежения — опора зума
+        self.tracking_lines = []     # [(x1, y1, x2, y2, QStaticText)] от своей метки к целям
+        self._tracking_rect = QtCore.QRect()
+
         self.is_drawing = False
-        self.lines = []
+        self.segments = SegmentStore()
+        self.hovered_id = None     # отрезок под курсором (HOVER_SELECT)
+        self.drag_endpoint = None  # (id, which), если ПКМ тащит конец отрезка
+        self.route_mode = False    # протяжки ПКМ продолжают маршрут (хоткей 'ctrl+shift+r')
+        self.route = Route()
+        self.fan_mode = False      # клики ПКМ ставят цели веера (хоткей 'ctrl+shift+f')
+        self.fan = RangeFan()
+        self._fan_rect = QtCore.QRect()
+        self._fan_page = None      # таблица веера в стеке панели, строится при первом показе
+        self._fan_cells = []       # [[QLabel номера, дальности, азимута]] по строкам таблицы
+        self._fan_texts = []       # текущий текст ячеек: setText только на изменившихся
+        self.loupe_grabber = None  # снимки и привязка для лупы (хоткей 'ctrl+shift+m')
+        self.loupe = None          # LoupeWidget, создаётся при первом включении
+        self.loupe_frame = None    # последний кадр лупы (для привязки концов)
+        self._loupe_mask_rect = QtCore.QRect()  # область лупы в маске, растёт до конца протяжки
         self.first_point = None
 
+        # Обработчики записей кольца ввода (см. drainInput)
+        self._input_handlers = {
+            EV_RMB_DOWN: self.onMouseRightDown,
+            EV_RMB_UP: self.onMouseRightUp,
+            EV_TOGGLE: self.toggleMeasurement,
+            EV_CALIBRATE: self.startCalibration,
+            EV_CLOSE: self.close,
+            EV_CLEAR: self.clearLines,
+            EV_DELETE: self.deleteHoveredSegment,
+            EV_LATENCY: self.toggleLatencyProbe,
+            EV_PROFILE: self.nextCalibrationProfile,
+            EV_AUTOCAL: self.startAutoCalibration,
+            EV_TRACK: self.toggleTracking,
+            EV_ROUTE: self.toggleRoute,
+            EV_UNDO: self.undoRouteLeg,
+            EV_FAN: self.toggleFan,
+            EV_LOUPE: self.toggleLoupe,
+        }
+
+        # Кэш-слой с уже растеризованными отрезками (RETAINED_RENDERING)
+        self._lines_layer = None
+        self._layer_count = 0  # сколько строк self.segments уже в слое
+
+        # Маска окна (REGION_MASK): объединение прямоугольников отрезков
+        # растёт по одному при добавлении и собирается заново при удалении
+        self._segments_region = QtGui.QRegion()
+        self._drag_mask_rect = QtCore.QRect()  # область предпросмотра, только растёт до отпускания ПКМ
+        self._mask_region = QtGui.QRegion()
+        self.mask_stats = {"updates": 0, "rebuilds": 0, "update_us": 0.0}
+
+        # Перо, кисть и шрифт для отрезков создаём один раз
+        self._line_pen = QtGui.QPen(QtGui.QColor(255, 0, 0, 200), 3)
+        self._arrow_brush = QtGui.QBrush(QtGui.QColor(255, 0, 0, 200))
+        self._label_pen = QtGui.QPen(QtGui.QColor(255, 255, 255, 220))
+        self._label_font = QtGui.QFont("Arial", 12, QtGui.QFont.Bold)
+        self._label_metrics = QtGui.QFontMetrics(self._label_font)
+        # Насколько подпись отрезка (от середины вправо) может выйти за ячейки
+        # индекса, через которые проходит сам отрезок
+        self._label_reach = self._label_metrics.horizontalAdvance("000000.00 м, 000.00°") + 20
+        # Подписи отрезков, предпросмотра и слежения: id/ключ -> QStaticText
+        self.labels = LabelCache(self._label_font)
+
+        # Предпросмотр протяжки ПКМ и подсветка отрезка под курсором: таймер
+        # с периодом кадра дисплея забирает последнюю позицию курсора из хука
+        # (_latest_move)
+        self.preview_point = None
+        self._preview_pen = QtGui.QPen(QtGui.QColor(255, 200, 0, 220), 2, QtCore.Qt.DashLine)
+        self._hover_pen = QtGui.QPen(QtGui.QColor(255, 220, 0, 230), 5)
+        self._tracking_pen = QtGui.QPen(QtGui.QColor(0, 220, 255, 220), 2, QtCore.Qt.DashLine)
+        self._fan_pen = QtGui.QPen(QtGui.QColor(120, 255, 120, 220), 1, QtCore.Qt.DashLine)
+        self._fan_brush = QtGui.QBrush(QtGui.QColor(120, 255, 120, 220))
+        self._fan_numbers = {}  # номер цели -> QStaticText
+        self._last_move = None
+        self._move_timer = QtCore.QTimer(self)
+        self._move_timer.setTimerType(QtCore.Qt.PreciseTimer)
+        refresh_hz = QtWidgets.QApplication.primaryScreen().refreshRate() or 60.0
+        self._move_timer.setInterval(max(1, int(1000 / refresh_hz)))
+        self._move_timer.timeout.connect(self._onMoveTick)
+
         self.text_info = (
             "Оверлей запущен.\n"
             "Нажмите '=' для включения измерений (ПКМ).\n"
-            "Первый отрезок — калибровка (или 'c' для перекалибровки).\n"
-            "ЛКМ при этом проходит в игру.\n"
+            + ("Первый отрезок — калибровка (или 'c' для перекалибровки).\n"
+               if self.is_calibrating else
+               f"Калибровка профиля '{self.calibrations.active_profile}' загружена ('c' — заново).\n")
+            + "ЛКМ при этом проходит в игру.\n"
             "Ctrl+Shift+Q — закрыть.\n"
             "Чтобы очистить все линии, нажмите '-' а затем '='."
         )
@@ -365,9 +3152,31 @@ class OverlayWindow(QtWidgets.QMainWindow):
         central_widget.setAttribute(QtCore.Qt.WA_TransparentForMouseEvents, True)
         self.setCentralWidget(central_widget)
 
-        # Создаём панель информации
+        # Панель информации (стили, кнопки, строка калибровки): при FAST_START
+        # строится после первого кадра окна (_ensurePanel), до того текст
+        # только запоминается в self.text_info
+        self.info_panel = None
+        self._first_frame = False
+        if not FAST_START:
+            self._ensurePanel()
+
+        self._rebuildMask()
+        self.show()
+        logging.debug("OverlayWindow shown.")
+
+    def _ensurePanel(self):
+        """Строит панель, если её ещё нет; вызывается и там, где она нужна раньше срока."""
+        if self.info_panel is not None:
+            return
+        started = startup_profile.begin()
+        self._buildPanel()
+        startup_profile.end("panel", started)
+        startup_profile.reach("panel")
+
+    def _buildPanel(self):
+        """Панель информации: текст, кнопки очистки и закрытия, строка калибровки."""
         self.info_panel = QtWidgets.QFrame(self)
-        self.info_panel.setGeometry(20, 20, 350, 160)
+        self.info_panel.setGeometry(20, 20, INFO_PANEL_WIDTH, INFO_PANEL_HEIGHT)
         self.info_panel.setStyleSheet("""
             QFrame {
                 background-color: rgba(30, 30, 30, 200);
@@ -377,10 +3186,17 @@ class OverlayWindow(QtWidgets.QMainWindow):
         self.info_layout = QtWidgets.QVBoxLayout(self.info_panel)
         self.info_layout.setContentsMargins(10, 10, 10, 10)
 
-        self.info_label = QtWidgets.QLabel(self.text_info, self.info_panel)
-        self.info_label.setStyleSheet("color: white; font-size: 14px;")
-        self.info_label.setWordWrap(True)
-        self.info_layout.addWidget(self.info_label)
+        # Стек текстов панели: info_label — для меняющихся сообщений, а
+        # постоянные состояния (INFO_TEXTS) строятся здесь по QLabel на каждое
+        # и дальше только переключаются (showState) — без раскладки текста
+        self.info_stack = QtWidgets.QStackedWidget(self.info_panel)
+        self.info_label = self._makeInfoLabel(self.text_info)
+        self.info_stack.addWidget(self.info_label)
+        self._state_labels = {}
+        for key, text in INFO_TEXTS.items():
+            label = self._state_labels[key] = self._makeInfoLabel(text)
+            self.info_stack.addWidget(label)
+        self.info_layout.addWidget(self.info_stack)
 
         # Кнопка очистки линий (дублирует хоткей '-,=')
         self.clear_button = QtWidgets.QPushButton("Очистить все линии", self.info_panel)
@@ -403,6 +3219,51 @@ class OverlayWindow(QtWidgets.QMainWindow):
         self.clear_button.clicked.connect(self.clearLines)
         self.info_layout.addWidget(self.clear_button)
 
+        # Строка калибровки: ввод длины в метрах и пресеты (скрыта до протяжки)
+        self.calibration_row = QtWidgets.QWidget(self.info_panel)
+        self.calibration_row.setStyleSheet("""
+            QLineEdit {
+                background-color: #222222;
+                color: white;
+                border: 1px solid #777777;
+                border-radius: 5px;
+                font-size: 14px;
+                padding: 2px 4px;
+            }
+            QPushButton {
+                background-color: #555555;
+                color: white;
+                border: none;
+                border-radius: 5px;
+                font-size: 13px;
+                padding: 4px 6px;
+            }
+            QPushButton:hover {
+                background-color: #777777;
+            }
+        """)
+        calibration_layout = QtWidgets.QGridLayout(self.calibration_row)
+        calibration_layout.setContentsMargins(0, 0, 0, 0)
+        self.calibration_edit = QtWidgets.QLineEdit(self.calibration_row)
+        self.calibration_edit.setPlaceholderText("метры")
+        self.calibration_edit.setValidator(QtGui.QRegularExpressionValidator(
+            QtCore.QRegularExpression(r"\d{1,6}([.,]\d{0,3})?"), self.calibration_edit
+        ))
+        self.calibration_edit.returnPressed.connect(self._applyTypedCalibration)
+        calibration_layout.addWidget(self.calibration_edit, 0, 0, 1, 3)
+        ok_button = QtWidgets.QPushButton("OK", self.calibration_row)
+        ok_button.clicked.connect(self._applyTypedCalibration)
+        calibration_layout.addWidget(ok_button, 0, 3)
+        cancel_button = QtWidgets.QPushButton("Отмена", self.calibration_row)
+        cancel_button.clicked.connect(self.cancelCalibrationEntry)
+        calibration_layout.addWidget(cancel_button, 0, 4)
+        for i, meters in enumerate(CALIBRATION_PRESETS):
+            preset = QtWidgets.QPushButton(f"{meters} м", self.calibration_row)
+            preset.clicked.connect(lambda checked=False, m=meters: self.applyCalibration(m))
+            calibration_layout.addWidget(preset, 1, i)
+        self.calibration_row.hide()
+        self.info_layout.addWidget(self.calibration_row)
+
         # Кнопка закрытия (крестик)
         self.close_button = QtWidgets.QPushButton("✕", self.info_panel)
         self.close_button.setFixedSize(30, 30)
@@ -420,19 +3281,23 @@ class OverlayWindow(QtWidgets.QMainWindow):
         self.close_button.clicked.connect(self.close)
         self.close_button.move(self.info_panel.width() - 40, 10)
 
-        self.show()
-        logging.debug("OverlayWindow shown.")
+        self.info_panel.show()
+        self._resizeInfoPanel()
 
     def clearLines(self):
         """Очищает все нарисованные линии."""
         logging.debug("Clearing all lines.")
-        self.lines.clear()
-        self.text_info = (
-            "Все линии очищены.\n"
-            "Продолжайте измерения (ПКМ) или нажмите '=' для настроек."
-        )
-        self.info_label.setText(self.text_info)
-        self.update()
+        session_log.log("clear")
+        self.segments.clear()
+        self.labels.clear()
+        self.route.clear()
+        if self.fan.origin is not None:
+            self.fan.clear()
+            self._setFanGeometry()
+            self._refreshFanTable()
+        self.hovered_id = None
+        self.showState("lines_cleared")
+        self.dropLinesCache()
 
     @QtCore.pyqtSlot()
     def toggleMeasurement(self):
@@ -443,28 +3308,21 @@ class OverlayWindow(QtWidgets.QMainWindow):
         """
         self.is_measuring = not self.is_measuring
         logging.debug(f"Measurement toggled: is_measuring={self.is_measuring}")
+        session_log.log("measuring", on=self.is_measuring)
 
         if self.is_measuring:
             self.setAttribute(QtCore.Qt.WA_TransparentForMouseEvents, False)
-            self.text_info = (
-                "Режим измерений (ПКМ) ВКЛ.\n"
-                "Первый отрезок — калибровка (если не сделано) или 'c' для перекалибровки.\n"
-                "ЛКМ идёт в игру.\n"
-                "Нажмите '=': выключить измерения.\n"
-                "Нажмите '-,=': очистить линии.\n"
-                "Ctrl+Shift+Q: закрыть."
-            )
+            self.showState("measuring_on")
         else:
             self.setAttribute(QtCore.Qt.WA_TransparentForMouseEvents, True)
-            self.text_info = (
-                "Режим измерений ВЫКЛ.\n"
-                "Клики (в т.ч. ПКМ) идут в игру.\n"
-                "Нажмите '=': снова включить.\n"
-                "Ctrl+Shift+Q: закрыть.\n"
-                "'-,=': очистить линии в любой момент."
-            )
-        self.info_label.setText(self.text_info)
-        self.update()
+            # Незавершённая протяжка больше не получит ПКМ up — убираем её
+            self.is_drawing = False
+            self._stopPreview()
+            self._syncMoveTimer()
+            self.first_point = None
+            self.pending_calibration_px = None
+            self._showCalibrationEntry(False)
+            self.showState("measuring_off")
 
     def startCalibration(self):
         """Перезапуск калибровки при хоткее 'c'."""
@@ -472,45 +3330,1032 @@ class OverlayWindow(QtWidgets.QMainWindow):
         self.is_measuring = True
         self.setAttribute(QtCore.Qt.WA_TransparentForMouseEvents, False)
         self.scale_factor = None
+        self.pending_calibration_px = None
+        self._syncMinimapWatcher()
+        self._showCalibrationEntry(False)
+        session_log.log("calibration_start")
+        self.showState("calibration_mode")
+        self.dropLinesCache()
+
+    def _resizeInfoPanel(self):
+        """Высота панели: базовая плюс строка калибровки и таблица веера, если они видны."""
+        if self.info_panel is None:
+            return
+        extra = 0
+        if self.calibration_row.isVisible():
+            extra += self.calibration_row.sizeHint().height() + self.info_layout.spacing()
+        if self.fan_mode:
+            extra += FAN_TABLE_ROWS * FAN_ROW_HEIGHT
+        self.info_panel.resize(INFO_PANEL_WIDTH, INFO_PANEL_HEIGHT + extra)
+        self._updateMask()
+
+    def _calibrationRowVisible(self):
+        return self.info_panel is not None and self.calibration_row.isVisible()
+
+    def _showCalibrationEntry(self, visible):
+        """
+        Показывает/прячет строку ввода калибровки. Пока она видна, окно
+        принимает фокус клавиатуры (иначе ввод уходил бы в игру), а хоткеи
+        без модификаторов молчат; после — фокус возвращается игре.
+        """
+        self._ensurePanel()
+        if self.calibration_row.isVisible() == visible:
+            if visible:
+                self.calibration_edit.selectAll()
+            return
+        self.calibration_row.setVisible(visible)
+        self._resizeInfoPanel()
+        self._publishHookState()
+        if visible:
+            self.calibration_edit.clear()
+        self._setKeyboardFocusable(visible)
+        if visible:
+            self.calibration_edit.setFocus()
+
+    def _setKeyboardFocusable(self, focusable):
+        """
+        Фокус клавиатуры для строки ввода. Забирается у игры намеренно — набрать
+        длину иначе нельзя — и только пока строка видна. На Windows флаг
+        WS_EX_NOACTIVATE меняется у уже созданного HWND: setWindowFlag
+        пересоздал бы полноэкранное окно и показал его заново. При закрытии
+        строки фокус отдаётся окну, у которого он был.
+        """
+        if sys.platform == "win32" and import_windows_modules():
+            hwnd = int(self.winId())
+            style = win32gui.GetWindowLong(hwnd, win32con.GWL_EXSTYLE)
+            if focusable:
+                style &= ~win32con.WS_EX_NOACTIVATE
+            else:
+                style |= win32con.WS_EX_NOACTIVATE
+            win32gui.SetWindowLong(hwnd, win32con.GWL_EXSTYLE, style)
+            if focusable:
+                self._focus_return_hwnd = win32gui.GetForegroundWindow()
+                target = hwnd
+            else:
+                target, self._focus_return_hwnd = self._focus_return_hwnd, None
+            if target:
+                try:
+                    win32gui.SetForegroundWindow(target)
+                except Exception:
+                    # Windows может отказать (foreground lock) — не критично
+                    logging.debug("SetForegroundWindow refused")
+            return
+        # Другие платформы (отладка без игры): пересоздание окна не страшно.
+        # Смена флагов прячет окно — показываем снова
+        self.setWindowFlag(QtCore.Qt.WindowDoesNotAcceptFocus, not focusable)
+        self.show()
+        if focusable:
+            self.activateWindow()
+
+    def _applyTypedCalibration(self):
+        text = self.calibration_edit.text().strip()
+        if not text:
+            return
+        try:
+            real_length = float(text.replace(',', '.'))
+        except ValueError:
+            self.showState("calibration_bad_number")
+            logging.debug("Calibration failed: ValueError on input.")
+            return
+        self.applyCalibration(real_length)
+
+    def applyCalibration(self, real_length):
+        """Завершает калибровку: протянутая длина соответствует real_length метрам."""
+        dist_px = self.pending_calibration_px
+        logging.debug(f"Calibration input: real_length={real_length}, dist_px={dist_px}")
+        if dist_px is None:
+            return
+        if real_length <= 0:
+            self.showState("calibration_bad_length")
+            logging.debug("Calibration failed: non-positive real_length.")
+            return
+
+        self.scale_factor = real_length / dist_px
+        self.is_calibrating = False
+        self.pending_calibration_px = None
+        self.calibrations.set_scale(self.scale_factor)
+        self._syncMinimapWatcher(rebase=True)
+        self._showCalibrationEntry(False)
+        # Подписи всех отрезков и таблица веера — по новому масштабу
+        self.dropLinesCache()
+        self._refreshFanTable()
+        self.text_info = (
+            f"Калибровка завершена:\n"
+            f"1 px = {self.scale_factor:.4f} м.\n"
+            "Теперь рисуйте новые отрезки (ПКМ) или "
+            "нажмите '-,=' чтобы очистить."
+        )
+        logging.debug(f"Calibration success. scale_factor={self.scale_factor}")
+        session_log.log("scale", scale=self.scale_factor, source="calibration",
+                        px=round(dist_px, 2), m=real_length, profile=self.calibrations.active_profile)
+        self.showInfo()
+
+    @QtCore.pyqtSlot()
+    def nextCalibrationProfile(self):
+        """Переключает профиль калибровки и подставляет его сохранённый масштаб."""
+        profile = self.calibrations.next_profile()
+        self.pending_calibration_px = None
+        self._showCalibrationEntry(False)
+        self.scale_factor = self.calibrations.scale
+        self.is_calibrating = self.scale_factor is None
+        self._syncMinimapWatcher(rebase=True)
+        # Подписи отрезков и таблица веера — по масштабу нового профиля
+        self.dropLinesCache()
+        self._refreshFanTable()
+        if self.scale_factor:
+            self.text_info = (
+                f"Профиль калибровки: {profile}\n"
+                f"1 px = {self.scale_factor:.4f} м.\n"
+                "Ctrl+Shift+P: следующий профиль, 'c': перекалибровать."
+            )
+        else:
+            self.text_info = (
+                f"Профиль калибровки: {profile} (не откалиброван).\n"
+                "Протяните ПКМ отрезок известной длины.\n"
+                "Ctrl+Shift+P: следующий профиль."
+            )
+        logging.debug(f"Calibration profile -> {profile}, scale_factor={self.scale_factor}")
+        if self.scale_factor:
+            session_log.log("scale", scale=self.scale_factor, source="profile", profile=profile)
+        else:
+            session_log.log("calibration_start", profile=profile)
+        self.showInfo()
+
+    def startAutoCalibration(self):
+        """Автокалибровка: шаг сетки на снимке миникарты = GRID_SQUARE_METERS."""
+        if screen_grabber is None:
+            self.showState("autocal_unavailable")
+            return
+        if self.auto_calibrator is None:
+            self.auto_calibrator = AutoCalibrator(screen_grabber, self)
+            self.auto_calibrator.finished.connect(self._onGridDetected)
+        if not self.auto_calibrator.start(minimap_region(QtWidgets.QApplication.primaryScreen())):
+            return
+        self.showState("autocal_searching")
+
+    @QtCore.pyqtSlot(object, float)
+    def _onGridDetected(self, spacing, confidence):
+        if spacing is None:
+            self.text_info = (
+                f"Сетка на миникарте не найдена (уверенность {confidence:.0%}).\n"
+                "Проверьте область миникарты или откалибруйтесь вручную ('c')."
+            )
+            self.showInfo()
+            return
+        # Дальше — как ручная калибровка: квадрат сетки известного размера
+        self.pending_calibration_px = spacing
+        self.applyCalibration(GRID_SQUARE_METERS)
+        self.text_info = (
+            f"Автокалибровка: квадрат {GRID_SQUARE_METERS} м = {spacing:.1f} px\n"
+            f"(уверенность {confidence:.0%}).\n"
+            f"1 px = {self.scale_factor:.4f} м."
+        )
+        self.showInfo()
+
+    def _syncMinimapWatcher(self, rebase=False):
+        """Слежение за миникартой нужно, пока есть масштаб и источник снимков."""
+        wanted = MINIMAP_WATCH and screen_grabber is not None and self.scale_factor is not None
+        if not wanted:
+            if self.minimap_watcher is not None:
+                self.minimap_watcher.stop()
+                self.minimap_watcher = None
+            return
+        if self.minimap_watcher is None:
+            self.minimap_watcher = MinimapWatcher(
+                screen_grabber, minimap_region(QtWidgets.QApplication.primaryScreen()),
+                rate_hz=MINIMAP_WATCH_HZ, budget=MINIMAP_WATCH_BUDGET, parent=self,
+            )
+            self.minimap_watcher.spacingChanged.connect(self._onGridSpacingChanged)
+            self.minimap_watcher.start()
+        elif rebase:
+            self.minimap_watcher.rebase()
+
+    @QtCore.pyqtSlot(float, float, float)
+    def _onGridSpacingChanged(self, old_spacing, new_spacing, confidence):
+        """Зум миникарты сменился: пересчёт масштаба и отрезков, нарисованных по миникарте."""
+        if self.scale_factor is None or self.minimap_watcher is None:
+            return
+        factor = new_spacing / old_spacing
+        self.scale_factor /= factor
+        self.calibrations.set_scale(self.scale_factor)
+        x, y, w, h = self.minimap_watcher.region
+        center = self._zoomAnchor(x, y, w, h)
+        if self.drag_endpoint is None:
+            moved = self.segments.scale_within(x, y, x + w, y + h, factor, center)
+        else:
+            moved = []  # не двигаем отрезки под рукой пользователя
+        if any(seg_id in self.route for seg_id in moved):
+            # Колена на миникарте сдвинулись, и цепочка разорвана
+            self.route.clear()
+        self.hovered_id = None
+        # Подписи всех отрезков и таблица веера — по новому масштабу
+        self.dropLinesCache()
+        self._refreshFanTable()
+        self.text_info = (
+            f"Зум миникарты изменился: x{factor:.2f} (уверенность {confidence:.0%}).\n"
+            f"1 px = {self.scale_factor:.4f} м.\n"
+            f"Отрезков на миникарте пересчитано: {len(moved)}."
+        )
+        logging.debug(f"Minimap zoom x{factor:.3f}: scale_factor={self.scale_factor}, moved={len(moved)}")
+        session_log.log("zoom", factor=factor, region=[x, y, w, h] if moved else None,
+                        center=list(center) if moved and center else None,
+                        scale=self.scale_factor, confidence=round(confidence, 3))
+        self.showInfo()
+
+    def _zoomAnchor(self, x, y, w, h):
+        """
+        Точка, вокруг которой игра зумирует миникарту: своя стрелка, если её
+        видит слежение за метками (кадр приходит только при изменении, так что
+        последний — актуален) и она внутри миникарты. Иначе None — центр
+        миникарты: приближение, верное для карты, которая следует за игроком.
+        """
+        if self._player_pos is None:
+            return None
+        px, py = self._player_pos
+        if not (x <= px <= x + w and y <= py <= y + h):
+            return None
+        return (px, py)
+
+    def toggleRoute(self):
+        """Вкл/выкл режим маршрута (хоткей 'ctrl+shift+r'); выключение заканчивает маршрут."""
+        self.route_mode = not self.route_mode
+        self.route.clear()
+        logging.debug(f"Route mode -> {self.route_mode}")
+        session_log.log("route", on=self.route_mode)
+        self.showState("route_on" if self.route_mode else "route_off")
+
+    def undoRouteLeg(self):
+        """Снимает последнее колено маршрута (хоткей 'ctrl+shift+z')."""
+        seg_id = self.route.pop()
+        if seg_id is None:
+            self.showState("route_empty")
+            return
+        if seg_id in self.segments:
+            if self.hovered_id == seg_id:
+                self.hovered_id = None
+            self._removeSegmentFromLayer(seg_id)
+        logging.debug(f"Route leg {seg_id} undone. Legs left={len(self.route)}")
+        self._showRouteInfo()
+
+    def _showRouteInfo(self, leg_m=None, leg_deg=None, turn=None):
+        """Сводка маршрута в панели: последнее колено и итоги (O(1), из Route.totals)."""
+        total_px, total_turn = self.route.totals
+        scale = self.scale_factor or 0.0
+        lines = []
+        if leg_m is not None:
+            lines.append(f"Колено {len(self.route)}: {leg_m:.2f} м, {leg_deg:.1f}° (поворот {turn:+.1f}°)")
+        lines.append(
+            f"Маршрут: {len(self.route)} кол., {total_px * scale:.2f} м, "
+            f"суммарный поворот {total_turn:.1f}°"
+        )
+        lines.append("ПКМ — следующее колено, Ctrl+Shift+Z — отменить, Ctrl+Shift+R — закончить.")
+        self.text_info = "\n".join(lines)
+        self.showInfo()
+
+    def toggleFan(self):
+        """Вкл/выкл веер дальностей (хоткей 'ctrl+shift+f'); выключение стирает его."""
+        self.fan_mode = not self.fan_mode
+        self.fan.clear()
+        self._setFanGeometry()
+        self._resizeInfoPanel()
+        logging.debug(f"Range fan mode -> {self.fan_mode}")
+        session_log.log("fan", on=self.fan_mode)
+        self.showState("fan_on" if self.fan_mode else "fan_off")
+
+    def _fanClick(self, x1, y1, x2, y2):
+        """Клик ПКМ в режиме веера: начало, затем цели; протяжка переносит начало."""
+        if self._distance_in_pixels(x1, y1, x2, y2) >= MIN_DRAG_DISTANCE or self.fan.origin is None:
+            self.fan.set_origin(x2, y2)
+            session_log.log("fan_origin", x=x2, y=y2)
+        else:
+            number = self.fan.add(x2, y2)
+            session_log.log("fan_target", n=number, x=x2, y=y2)
+        self._setFanGeometry()
+        self._refreshFanTable(show=True)
+
+    def _setFanGeometry(self):
+        """Перерисовывает старую и новую область веера на экране."""
+        old_rect = self._fan_rect
+        rect = QtCore.QRect()
+        if self.fan.origin is not None:
+            points = np.vstack((self.fan.targets(), self.fan.origin))
+            x0, y0 = np.floor(points.min(axis=0)).astype(int).tolist()
+            x1, y1 = np.ceil(points.max(axis=0)).astype(int).tolist()
+            # Запас на кружки и номера целей справа сверху
+            rect = QtCore.QRect(QtCore.QPoint(x0, y0), QtCore.QPoint(x1, y1)).adjusted(
+                -8, -8 - self._label_metrics.height(), 8 + self._label_metrics.horizontalAdvance("#000"), 8
+            )
+        self._fan_rect = rect
+        self._updateMask()
+        self.update(old_rect.united(rect))
+
+    def _buildFanPage(self):
+        """Страница таблицы веера: заголовок и FAN_TABLE_ROWS строк, создаются один раз."""
+        page = QtWidgets.QWidget(self.info_stack)
+        grid = QtWidgets.QGridLayout(page)
+        grid.setContentsMargins(0, 0, 0, 0)
+        grid.setVerticalSpacing(0)
+        self._fan_header = self._makeInfoLabel("")
+        self._fan_header.setParent(page)
+        grid.addWidget(self._fan_header, 0, 0, 1, 3)
+        widths = (40, 150, 80)
+        for row in range(FAN_TABLE_ROWS):
+            cells = []
+            for column, width in enumerate(widths):
+                cell = QtWidgets.QLabel("", page)
+                cell.setStyleSheet("color: white; font-size: 14px;")
+                cell.setFixedSize(width, FAN_ROW_HEIGHT)
+                cell.setAlignment(QtCore.Qt.AlignRight | QtCore.Qt.AlignVCenter)
+                grid.addWidget(cell, row + 1, column)
+                cells.append(cell)
+            self._fan_cells.append(cells)
+            self._fan_texts.append(["", "", ""])
+        self.info_stack.addWidget(page)
+        return page
+
+    def _refreshFanTable(self, show=False):
+        """
+        Пересчитывает таблицу веера одним пакетом (RangeFan.table) и меняет
+        текст только в изменившихся ячейках заранее созданных строк.
+        """
+        if not self.fan_mode:
+            return
+        self._ensurePanel()
+        if self._fan_page is None:
+            self._fan_page = self._buildFanPage()
+        numbers, lengths, bearings = self.fan.table(self.scale_factor)
+        unit = "м" if self.scale_factor else "px"
+        shown = min(len(numbers), FAN_TABLE_ROWS)
+        header = f"Веер: целей {len(numbers)}" + (f" (ближние {shown})" if len(numbers) > shown else "")
+        if self.fan.origin is None:
+            header = "Веер: клик ПКМ — начало."
+        self._fan_header.setText(header)
+        rows = zip(numbers[:shown].tolist(), lengths[:shown].tolist(), bearings[:shown].tolist())
+        for row, (number, length, bearing) in enumerate(rows):
+            self._setFanRow(row, (f"#{number}", f"{length:.0f} {unit}", f"{bearing:.1f}°"))
+        for row in range(shown, FAN_TABLE_ROWS):
+            self._setFanRow(row, ("", "", ""))
+        if show:
+            self.text_info = header
+            self.info_stack.setCurrentWidget(self._fan_page)
+
+    def _setFanRow(self, row, texts):
+        current = self._fan_texts[row]
+        for column, text in enumerate(texts):
+            if current[column] != text:
+                current[column] = text
+                self._fan_cells[row][column].setText(text)
+
+    def _paint_fan(self, painter):
+        """Веер: пунктир от начала к каждой цели, кружки и номера целей."""
+        painter.setRenderHint(QtGui.QPainter.Antialiasing)
+        ox, oy = self.fan.origin
+        painter.setPen(self._fan_pen)
+        painter.setBrush(QtCore.Qt.NoBrush)
+        targets = self.fan.targets().tolist()
+        for tx, ty in targets:
+            painter.drawLine(QtCore.QLineF(ox, oy, tx, ty))
+        painter.setBrush(self._fan_brush)
+        painter.drawEllipse(QtCore.QPointF(ox, oy), 5, 5)
+        painter.setFont(self._label_font)
+        for number, (tx, ty) in enumerate(targets, 1):
+            painter.setPen(self._fan_pen)
+            painter.drawEllipse(QtCore.QPointF(tx, ty), 3, 3)
+            static = self._fan_numbers.get(number)
+            if static is None:
+                static = self._fan_numbers[number] = QtGui.QStaticText(f"#{number}")
+                static.prepare(QtGui.QTransform(), self._label_font)
+            painter.setPen(self._label_pen)
+            painter.drawStaticText(self._label_origin(tx + 6, ty - 6), static)
+        painter.setBrush(QtCore.Qt.NoBrush)
+
+    def toggleTracking(self):
+        """Вкл/выкл слежение за метками миникарты (хоткей 'ctrl+shift+t')."""
+        if self.marker_tracker is not None:
+            self.marker_tracker.stop()
+            self.marker_tracker = None
+            self._setTrackingLines([])
+            self._player_pos = None
+            session_log.log("tracking", on=False)
+            self.showState("tracking_off")
+            return
+        if screen_grabber is None:
+            self.showState("tracking_unavailable")
+            return
+        self.marker_tracker = MarkerTracker(
+            screen_grabber, minimap_region(QtWidgets.QApplication.primaryScreen()),
+            rate_hz=MARKER_TRACK_HZ, workers=MARKER_WORKERS, record_dir=MARKER_RECORD_DIR, parent=self,
+        )
+        self.marker_tracker.markersFound.connect(self._onMarkersFound)
+        self.marker_tracker.start()
+        session_log.log("tracking", on=True)
+        self.showState("tracking_searching")
+
+    @QtCore.pyqtSlot(object)
+    def _onMarkersFound(self, frame):
+        """Новые положения меток: линии от своей стрелки до целей и сводка в панели."""
+        if self.marker_tracker is None:
+            return
+        if frame.player is None:
+            self._player_pos = None
+            self._setTrackingLines([])
+            self.showState("tracking_no_player")
+            return
+        px, py = frame.player
+        self._player_pos = (px, py)
+        lines, summary = [], []
+        for kind, tx, ty in frame.targets:
+            length = self._distance_in_pixels(px, py, tx, ty)
+            if self.scale_factor:
+                length *= self.scale_factor
+            angle_deg = self._bearing_deg(px, py, tx, ty)
+            lines.append((px, py, tx, ty, self._label_for(("track", len(lines)), length, angle_deg)))
+            summary.append(f"{kind}: {self._segment_label(length, angle_deg)}")
+        self._setTrackingLines(lines)
+        self.text_info = "Слежение за метками:\n" + ("\n".join(summary[:5]) or "Целей не видно.")
+        self.showInfo()
+
+    def _setTrackingLines(self, lines):
+        """Заменяет линии слежения; перерисовывается только старая и новая их область."""
+        old_rect = self._tracking_rect
+        self.tracking_lines = lines
+        rect = QtCore.QRect()
+        for x1, y1, x2, y2, label in lines:
+            rect = rect.united(self._segment_rect(x1, y1, x2, y2, label))
+        self._tracking_rect = rect
+        self._updateMask()
+        self.update(old_rect.united(rect))
+
+    def toggleLoupe(self):
+        """Вкл/выкл лупу с привязкой концов (хоткей 'ctrl+shift+m')."""
+        if self.loupe_grabber is not None:
+            self.loupe_grabber.stop()
+            self.loupe_grabber = None
+            self.loupe_frame = None
+            self._hideLoupe()
+            session_log.log("loupe", on=False)
+            self.showState("loupe_off")
+            return
+        if screen_grabber is None:
+            self.showState("loupe_unavailable")
+            return
+        if self.loupe is None:
+            self.loupe = LoupeWidget(self)
+        self.loupe_grabber = LoupeGrabber(screen_grabber, parent=self)
+        self.loupe_grabber.frameReady.connect(self._onLoupeFrame)
+        self.loupe_grabber.start()
+        self._syncMoveTimer()
+        session_log.log("loupe", on=True)
+        self.showState("loupe_on")
+
+    @QtCore.pyqtSlot(object)
+    def _onLoupeFrame(self, frame):
+        """Новый кадр лупы: запоминаем для привязки, во время протяжки — показываем."""
+        if self.loupe_grabber is None:
+            return
+        self.loupe_frame = frame
+        if not self.is_drawing:
+            return
+        x, y = frame.pos
+        size = self.loupe.size()
+        # Справа снизу от курсора; у края экрана — с другой стороны
+        lx = x + LOUPE_OFFSET if x + LOUPE_OFFSET + size.width() <= self.width() else x - LOUPE_OFFSET - size.width()
+        ly = y + LOUPE_OFFSET if y + LOUPE_OFFSET + size.height() <= self.height() else y - LOUPE_OFFSET - size.height()
+        rect = QtCore.QRect(QtCore.QPoint(lx, ly), size)
+        if REGION_MASK and not self._loupe_mask_rect.contains(rect):
+            # Маска растёт с запасом, как под предпросмотр протяжки
+            slack = MASK_DRAG_SLACK
+            self._loupe_mask_rect = self._loupe_mask_rect.united(rect.adjusted(-slack, -slack, slack, slack))
+            self._updateMask()
+        if self.loupe.geometry() != rect:
+            self.loupe.setGeometry(rect)
+        self.loupe.setFrame(frame)
+        if not self.loupe.isVisible():
+            self.loupe.show()
+            self.loupe.raise_()
+
+    def _hideLoupe(self):
+        if self.loupe is not None and self.loupe.isVisible():
+            self.loupe.hide()
+        if not self._loupe_mask_rect.isEmpty():
+            self._loupe_mask_rect = QtCore.QRect()
+            self._updateMask()
+
+    def _snapPoint(self, x, y):
+        """
+        Точка протяжки ПКМ с привязкой лупы: к метке или пересечению сетки из
+        свежего кадра (не старше LOUPE_SNAP_MAX_AGE; у неподвижного курсора
+        кадр переснимается раз в LOUPE_IDLE_INTERVAL), если до них не дальше
+        LOUPE_SNAP_RADIUS. Сама привязка посчитана в потоке лупы.
+        """
+        frame = self.loupe_frame
+        if self.loupe_grabber is None or frame is None or frame.snap is None:
+            return x, y
+        if time.perf_counter() - frame.time > LOUPE_SNAP_MAX_AGE:
+            return x, y
+        sx, sy = frame.snap
+        if (sx - x) ** 2 + (sy - y) ** 2 > LOUPE_SNAP_RADIUS ** 2:
+            return x, y
+        if HOOK_TRACE:
+            logging.debug(f"Snapped ({x}, {y}) -> ({sx:.2f}, {sy:.2f})")
+        return sx, sy
+
+    def cancelCalibrationEntry(self):
+        """Закрывает ввод калибровки; режим калибровки остаётся включённым."""
+        if self.pending_calibration_px is None and not self._calibrationRowVisible():
+            return
+        self.pending_calibration_px = None
+        self._showCalibrationEntry(False)
+        logging.debug("Calibration canceled.")
+        self.showState("calibration_canceled")
+
+    def _syncMoveTimer(self):
+        """Таймер движений нужен во время протяжки или пока включена подсветка."""
+        needed = (LIVE_PREVIEW and self.is_drawing) or _hover_tracking
+        if needed and not self._move_timer.isActive():
+            self._move_timer.start()
+        elif not needed and self._move_timer.isActive():
+            self._move_timer.stop()
+        if self.loupe_grabber is not None:
+            # Вне протяжки кадры нужны только для привязки первой точки
+            self.loupe_grabber.set_active(_hover_tracking or self.is_drawing, live=self.is_drawing)
+            if not self.is_drawing:
+                self._hideLoupe()
+
+    def _onMoveTick(self):
+        """Раз в кадр: обработать последнюю позицию курсора, если она изменилась."""
+        pos = _latest_move
+        if pos is None or pos == self._last_move:
+            return
+        self._last_move = pos
+        if self.is_drawing:
+            self._movePreview(pos)
+        elif _hover_tracking:
+            hit = self.segments.nearest(pos[0], pos[1], HOVER_RADIUS)
+            self._setHovered(None if hit is None else hit[0])
+
+    def _movePreview(self, pos):
+        """Переносит предпросмотр к позиции курсора."""
+        if pos == self.preview_point or self.first_point is None:
+            return
+        old_rect = self._preview_rect()
+        self.preview_point = pos
+        new_rect = self._preview_rect()
+        if REGION_MASK and not self._drag_mask_rect.contains(new_rect):
+            # Маска растёт с запасом, чтобы не ставить её на каждый кадр протяжки
+            slack = MASK_DRAG_SLACK
+            self._drag_mask_rect = self._drag_mask_rect.united(new_rect.adjusted(-slack, -slack, slack, slack))
+            self._updateMask()
+        # Перерисовываем только старую и новую области предпросмотра
+        self.update(new_rect if old_rect is None else old_rect.united(new_rect))
+
+    def _stopPreview(self):
+        """Останавливает предпросмотр и стирает его с экрана."""
+        if self.preview_point is None:
+            return
+        old_rect = self._preview_rect()
+        self.preview_point = None
+        if old_rect is not None:
+            self.update(old_rect)
+        if not self._drag_mask_rect.isEmpty():
+            self._drag_mask_rect = QtCore.QRect()
+            self._updateMask()
+
+    def _preview_label(self):
+        """
+        Подпись протягиваемого отрезка. Пока курсор не сместил длину/азимут
+        на единицу последнего знака, возвращается тот же QStaticText.
+        """
+        x1, y1 = self.first_point
+        x2, y2 = self.preview_point
+        dist_px = self._distance_in_pixels(x1, y1, x2, y2)
+        angle_deg = self._bearing_deg(x1, y1, x2, y2)
+        if self.scale_factor and not self.is_calibrating:
+            return self.labels.get("preview", dist_px * self.scale_factor, angle_deg, 1, "м")
+        return self.labels.get("preview", dist_px, angle_deg, 0, "px")
+
+    def _preview_rect(self):
+        if self.first_point is None or self.preview_point is None:
+            return None
+        x1, y1 = self.first_point
+        x2, y2 = self.preview_point
+        margin = self._preview_pen.width() + 2
+        rect = QtCore.QRectF(
+            QtCore.QPointF(min(x1, x2), min(y1, y2)),
+            QtCore.QPointF(max(x1, x2), max(y1, y2)),
+        ).toAlignedRect().adjusted(-margin, -margin, margin, margin)
+        label = self._label_rect(x2 + 12, y2 - 12, self._preview_label())
+        return rect.united(label)
+
+    def _paint_preview(self, painter):
+        x1, y1 = self.first_point
+        x2, y2 = self.preview_point
+        painter.setRenderHint(QtGui.QPainter.Antialiasing)
+        painter.setPen(self._preview_pen)
+        painter.drawLine(QtCore.QLineF(x1, y1, x2, y2))
+        painter.setPen(self._label_pen)
+        painter.setFont(self._label_font)
+        painter.drawStaticText(self._label_origin(x2 + 12, y2 - 12), self._preview_label())
+
+    def _paint_tracking(self, painter):
+        """Линии слежения: от своей стрелки к каждой метке, с дальностью и азимутом."""
+        painter.setRenderHint(QtGui.QPainter.Antialiasing)
+        painter.setFont(self._label_font)
+        for x1, y1, x2, y2, label in self.tracking_lines:
+            painter.setPen(self._tracking_pen)
+            painter.drawLine(QtCore.QLineF(x1, y1, x2, y2))
+            painter.setPen(self._label_pen)
+            painter.drawStaticText(self._label_origin((x1 + x2) / 2 + 10, (y1 + y2) / 2 - 10), label)
+
+    def _setHovered(self, seg_id):
+        """Меняет подсвеченный отрезок, перерисовывая только старый и новый."""
+        if seg_id == self.hovered_id:
+            return
+        for old_or_new in (self.hovered_id, seg_id):
+            if old_or_new is not None and old_or_new in self.segments:
+                self.update(self._segment_rect_by_id(old_or_new))
+        self.hovered_id = seg_id
+
+    def _segment_rect_by_id(self, seg_id):
+        lengths, bearings = self.segments.metrics(self.scale_factor)
+        row = self.segments.row(seg_id)
+        return self._segment_rect(*self.segments.segment(seg_id),
+                                  self._label_for(seg_id, float(lengths[row]), float(bearings[row])))
+
+    def _removeSegmentFromLayer(self, seg_id):
+        """
+        Удаляет отрезок: в кэш-слое и маске заново собирается только его
+        область (_repairLayer), остальные отрезки не перерисовываются.
+        """
+        rect = self._segment_rect_by_id(seg_id)
+        self._syncLayerRows()
+        self.segments.remove(seg_id)
+        self._layer_count = len(self.segments) if self._lines_layer is not None else 0
+        self.labels.discard(seg_id)
+        self.route.forget(seg_id)
+        session_log.log("segment_deleted", id=seg_id)
+        self._repairLayer([rect])
+
+    def _syncLayerRows(self):
+        """
+        Дорисовывает в слой отложенные строки перед удалением или переносом:
+        удаление переставляет последнюю строку, и счётчик _layer_count
+        верен, только если в слое уже все строки.
+        """
+        if self._lines_layer is not None and self._layer_count < len(self.segments):
+            self._sync_lines_layer()
+
+    def _repairLayer(self, rects):
+        """
+        Собирает заново кэш-слой и маску только в областях rects (удалённый
+        или перенесённый отрезок). Отрезки, которые могут туда заходить,
+        находит индекс SegmentGrid (с запасом на подпись); область слоя
+        очищается, и они рисуются заново с клипом по ней, а в маске область
+        вычитается и добавляются их прямоугольники. Цена — по отрезкам
+        рядом, а не по всем N.
+        """
+        # Запас 2 px: в маске после _rebuildMask подписи на столько шире (_segment_rects)
+        rects = [rect.adjusted(-2, -2, 2, 2) for rect in rects]
+        area = QtGui.QRegion()
+        for rect in rects:
+            area = area.united(rect)
+        # Подпись лежит справа-сверху от середины отрезка: запас слева — на её
+        # ширину, снизу — на высоту, с остальных сторон — на стрелку и отступы
+        reach = self._label_reach
+        near = ARROW_SIZE + self._line_pen.width() + 16
+        below = self._label_metrics.height() + near
+        ids = set()
+        for rect in rects:
+            ids |= self.segments.grid.query(rect.left() - reach, rect.top() - near,
+                                            rect.right() + near, rect.bottom() + below)
+        lengths, bearings = self.segments.metrics(self.scale_factor)
+        nearby = []
+        for seg_id in sorted(ids, key=self.segments.row):
+            row = self.segments.row(seg_id)
+            label = self._label_for(seg_id, float(lengths[row]), float(bearings[row]))
+            points = self.segments.segment(seg_id)
+            seg_rect = self._segment_rect(*points, label)
+            if area.intersects(seg_rect):
+                nearby.append((points, label, seg_rect))
+
+        if REGION_MASK:
+            region = self._segments_region.subtracted(area)
+            for _, _, seg_rect in nearby:
+                region = region.united(seg_rect)
+            self._segments_region = region
+            self._updateMask()
+
+        if self._lines_layer is not None:
+            painter = QtGui.QPainter(self._lines_layer)
+            painter.setClipRegion(area)
+            painter.setCompositionMode(QtGui.QPainter.CompositionMode_Source)
+            painter.fillRect(area.boundingRect(), QtCore.Qt.transparent)
+            painter.setCompositionMode(QtGui.QPainter.CompositionMode_SourceOver)
+            painter.setRenderHint(QtGui.QPainter.Antialiasing)
+            for points, label, _ in nearby:
+                self._paint_segment(painter, *points, label)
+            painter.end()
+        self.update(area)
+
+    @QtCore.pyqtSlot()
+    def deleteHoveredSegment(self):
+        """Удаляет отрезок под курсором (хоткей 'delete')."""
+        seg_id = self.hovered_id
+        if seg_id is None or seg_id not in self.segments:
+            return
+        self.hovered_id = None
+        self._removeSegmentFromLayer(seg_id)
+        self.showState("segment_deleted")
+        logging.debug(f"Segment {seg_id} deleted. Lines total={len(self.segments)}")
+
+    def _finishEndpointDrag(self, x1, y1, x2, y2):
+        """ПКМ отпущена при перетаскивании конца отрезка: (x1, y1) — неподвижный конец."""
+        seg_id, which = self.drag_endpoint
+        self.drag_endpoint = None
+        if seg_id not in self.segments:
+            return
+        old = self.segments.segment(seg_id)
+        moved_px = self._distance_in_pixels(old[2 * which], old[2 * which + 1], x2, y2)
+        if moved_px < MIN_DRAG_DISTANCE or self._distance_in_pixels(x1, y1, x2, y2) < MIN_DRAG_DISTANCE:
+            logging.debug("Endpoint drag too short -> no change.")
+            return
+
+        old_rect = self._segment_rect_by_id(seg_id)
+        self._syncLayerRows()
+        self.segments.move_endpoint(seg_id, which, x2, y2)
+        self.route.forget(seg_id)
+        session_log.log("segment_moved", id=seg_id, which=which, x=x2, y=y2)
+        self._repairLayer([old_rect, self._segment_rect_by_id(seg_id)])
+
+        lengths, bearings = self.segments.metrics(self.scale_factor)
+        row = self.segments.row(seg_id)
         self.text_info = (
-            "Режим калибровки ВКЛ (ПКМ).\n"
-            "Протяните новую линию и введите реальную длину.\n"
-            "Нажмите '=': отключить измерения.\n"
-            "Ctrl+Shift+Q: закрыть."
+            f"Отрезок изменён: {self._segment_label(float(lengths[row]), float(bearings[row]))}\n"
+            "Продолжайте рисовать ПКМ или нажмите '-,=' для очистки."
         )
-        self.info_label.setText(self.text_info)
+        self.showInfo()
+
+    def _makeInfoLabel(self, text):
+        label = QtWidgets.QLabel(text, self.info_stack)
+        label.setStyleSheet("color: white; font-size: 14px;")
+        label.setWordWrap(True)
+        return label
+
+    def showInfo(self):
+        """
+        Показывает self.text_info в панели. Перерисовывается только QLabel,
+        а не весь полноэкранный оверлей; тот же текст не раскладывается повторно.
+        """
+        if self.info_panel is None:
+            return
+        if self.info_label.text() != self.text_info:
+            self.info_label.setText(self.text_info)
+        self.info_stack.setCurrentWidget(self.info_label)
+
+    def showState(self, key):
+        """Показывает постоянный текст INFO_TEXTS[key] его заранее разложенным QLabel."""
+        self.text_info = INFO_TEXTS[key]
+        if self.info_panel is None:
+            return
+        self.info_stack.setCurrentWidget(self._state_labels[key])
+
+    def dropLinesCache(self):
+        """Сбрасывает кэш-слой отрезков (и маску) и перерисовывает окно целиком."""
+        self._lines_layer = None
+        self._layer_count = 0
+        self._rebuildMask()
         self.update()
 
+    def _addToMask(self, rect):
+        """Новый отрезок: маска расширяется на его прямоугольник, без пересборки."""
+        if REGION_MASK:
+            self._segments_region = self._segments_region.united(rect)
+            self._updateMask()
+
+    def _rebuildMask(self):
+        """
+        Собирает объединение прямоугольников всех отрезков заново (удаление,
+        очистка, перекалибровка — подписи могли стать шире или уже).
+        Объединяем попарно, деревом: так дешевле, чем по одному в растущую область.
+        """
+        if not REGION_MASK:
+            return
+        regions = [QtGui.QRegion(x0, y0, x1 - x0, y1 - y0) for x0, y0, x1, y1 in self._segment_rects().tolist()]
+        while len(regions) > 1:
+            regions = [
+                regions[i].united(regions[i + 1]) if i + 1 < len(regions) else regions[i]
+                for i in range(0, len(regions), 2)
+            ]
+        self._segments_region = regions[0] if regions else QtGui.QRegion()
+        self.mask_stats["rebuilds"] += 1
+        self._updateMask()
+
+    def _segment_rects(self):
+        """
+        Прямоугольники всех отрезков с подписями (как _segment_rect) одним
+        пакетом: массив N x 4 (x0, y0, x1, y1). Ширины подписей — из кэша
+        QStaticText, с запасом в 4 px.
+        """
+        lengths, bearings = self.segments.metrics(self.scale_factor)
+        p = self.segments.endpoints()
+        margin = ARROW_SIZE + self._line_pen.width()
+        pad = 4
+        widths = np.fromiter(
+            (self._label_for(seg_id, length, angle).size().width()
+             for seg_id, length, angle in zip(self.segments.ids().tolist(), lengths.tolist(),
+                                              bearings.tolist())),
+            dtype=np.float64, count=len(p),
+        )
+        mx = ((p[:, 0] + p[:, 2]) / 2).astype(np.int64) + 10
+        my = ((p[:, 1] + p[:, 3]) / 2).astype(np.int64) - 10
+        rects = np.empty((len(p), 4), dtype=np.int64)
+        rects[:, 0] = np.minimum(np.floor(np.minimum(p[:, 0], p[:, 2])) - margin, mx - pad)
+        rects[:, 1] = np.minimum(np.floor(np.minimum(p[:, 1], p[:, 3])) - margin,
+                                 my - self._label_metrics.ascent() - pad)
+        rects[:, 2] = np.maximum(np.ceil(np.maximum(p[:, 0], p[:, 2])) + margin, mx + widths + pad)
+        rects[:, 3] = np.maximum(np.ceil(np.maximum(p[:, 1], p[:, 3])) + margin,
+                                 my + self._label_metrics.descent() + pad)
+        return rects
+
+    def _updateMask(self):
+        """Ставит маску окна: панель, отрезки, линии слежения, область предпросмотра и лупы."""
+        if not REGION_MASK:
+            return
+        start = time.perf_counter()
+        panel = (self.info_panel.geometry() if self.info_panel is not None
+                 else QtCore.QRect(20, 20, INFO_PANEL_WIDTH, INFO_PANEL_HEIGHT))
+        region = self._segments_region.united(panel)
+        if not self._tracking_rect.isEmpty():
+            region = region.united(self._tracking_rect)
+        if not self._fan_rect.isEmpty():
+            region = region.united(self._fan_rect)
+        if not self._drag_mask_rect.isEmpty():
+            region = region.united(self._drag_mask_rect)
+        if not self._loupe_mask_rect.isEmpty():
+            region = region.united(self._loupe_mask_rect)
+        region = region.intersected(self.rect())
+        if region != self._mask_region:
+            self._mask_region = region
+            if QtGui.QGuiApplication.platformName() not in MASKLESS_PLATFORMS:
+                self.setMask(region)
+            self.mask_stats["updates"] += 1
+        self.mask_stats["update_us"] += (time.perf_counter() - start) * 1e6
+
+    def maskSummary(self):
+        """Площадь маски (компонуемая область) и цена её обновлений."""
+        if not REGION_MASK:
+            return {"area_pct": 100.0}
+        area = sum(r.width() * r.height() for r in self._mask_region.rects())
+        screen_area = max(1, self.width() * self.height())
+        updates = self.mask_stats["updates"]
+        return {
+            "area_px": area,
+            "area_pct": round(100.0 * area / screen_area, 2),
+            "rects": self._mask_region.rectCount(),
+            "updates": updates,
+            "rebuilds": self.mask_stats["rebuilds"],
+            "update_us_avg": round(self.mask_stats["update_us"] / updates, 1) if updates else 0.0,
+        }
+
+    def resizeEvent(self, event):
+        self.dropLinesCache()
+        super().resizeEvent(event)
+
     def paintEvent(self, event):
-        """Рисуем все линии + текстовую подсказку (self.text_info)."""
+        """Рисуем все линии (текстовая подсказка — в info_label)."""
+        if latency_probe.enabled:
+            latency_probe.paint_started()
         painter = QtGui.QPainter(self)
+        self._paint(painter, event)
+        painter.end()
+        if latency_probe.enabled:
+            latency_probe.paint_finished()
+        if not self._first_frame:
+            # Первый кадр есть — панель строится следующим проходом цикла событий
+            self._first_frame = True
+            startup_profile.reach("first_frame")
+            if self.info_panel is None:
+                QtCore.QTimer.singleShot(0, self._ensurePanel)
+
+    def _paint(self, painter, event):
+        if not RETAINED_RENDERING:
+            painter.setRenderHint(QtGui.QPainter.Antialiasing)
+            self._paint_segments(painter, 0)
+            if self.hovered_id is not None:
+                self._paint_hover(painter)
+            if self.tracking_lines:
+                self._paint_tracking(painter)
+            if self.fan.origin is not None:
+                self._paint_fan(painter)
+            if self.preview_point is not None and self.first_point is not None:
+                self._paint_preview(painter)
+            return
+
+        # Дорисовываем в слой новые отрезки и копируем только грязную область
+        layer = self._sync_lines_layer()
+        rect = QtCore.QRectF(event.rect())
+        dpr = layer.devicePixelRatioF()
+        source = QtCore.QRectF(rect.x() * dpr, rect.y() * dpr, rect.width() * dpr, rect.height() * dpr)
+        painter.drawPixmap(rect, layer, source)
+
+        if self.hovered_id is not None:
+            self._paint_hover(painter)
+        if self.tracking_lines:
+            self._paint_tracking(painter)
+        if self.fan.origin is not None:
+            self._paint_fan(painter)
+        if self.preview_point is not None and self.first_point is not None:
+            self._paint_preview(painter)
+
+    def _paint_hover(self, painter):
+        """Подсветка отрезка под курсором поверх слоя."""
+        if self.hovered_id not in self.segments:
+            return
         painter.setRenderHint(QtGui.QPainter.Antialiasing)
+        painter.setPen(self._hover_pen)
+        painter.drawLine(QtCore.QLineF(*self.segments.segment(self.hovered_id)))
+
+    def _sync_lines_layer(self):
+        """Создаёт кэш-слой при необходимости и растеризует в него ещё не нарисованные отрезки."""
+        dpr = self.devicePixelRatioF()
+        if self._lines_layer is None:
+            self._lines_layer = QtGui.QPixmap(self.size() * dpr)
+            self._lines_layer.setDevicePixelRatio(dpr)
+            self._lines_layer.fill(QtCore.Qt.transparent)
+            self._layer_count = 0
 
-        # Полупрозрачный слой для линий
+        if self._layer_count < len(self.segments):
+            painter = QtGui.QPainter(self._lines_layer)
+            painter.setRenderHint(QtGui.QPainter.Antialiasing)
+            self._paint_segments(painter, self._layer_count)
+            painter.end()
+            self._layer_count = len(self.segments)
+
+        return self._lines_layer
+
+    def _paint_segments(self, painter, start):
+        """Рисует отрезки хранилища, начиная со строки start."""
+        lengths, bearings = self.segments.metrics(self.scale_factor)
+        points = self.segments.endpoints()[start:].tolist()
+        ids = self.segments.ids()[start:].tolist()
+        for seg_id, (x1, y1, x2, y2), length, angle in zip(
+            ids, points, lengths[start:].tolist(), bearings[start:].tolist()
+        ):
+            self._paint_segment(painter, x1, y1, x2, y2, self._label_for(seg_id, length, angle))
+
+    def _segment_label(self, length, angle_deg):
+        """Подпись отрезка строкой (для панели): метры при известном масштабе, иначе пиксели."""
+        if self.scale_factor:
+            return format_length_label(length, angle_deg, 2, "м")
+        return format_length_label(length, angle_deg, 0, "px")
+
+    def _label_for(self, key, length, angle_deg):
+        """То же, что _segment_label, но подготовленным QStaticText из кэша."""
+        if self.scale_factor:
+            return self.labels.get(key, length, angle_deg, 2, "м")
+        return self.labels.get(key, length, angle_deg, 0, "px")
+
+    def _label_origin(self, x, y):
+        """QStaticText рисуется от левого верхнего угла, а (x, y) — базовая линия."""
+        return QtCore.QPointF(x, y - self._label_metrics.ascent())
+
+    def _label_rect(self, x, y, label):
+        """Прямоугольник подписи с базовой линией в (x, y), с запасом 2 px."""
+        return QtCore.QRectF(self._label_origin(x, y), label.size()).toAlignedRect().adjusted(-2, -2, 2, 2)
+
+    def _paint_segment(self, painter, x1, y1, x2, y2, label):
+        """Рисует один отрезок: линия, стрелка и подпись."""
+        painter.setPen(self._line_pen)
         painter.setBrush(QtCore.Qt.NoBrush)
+        painter.drawLine(QtCore.QLineF(x1, y1, x2, y2))
+        # Рисуем стрелки на концах линии
+        self.draw_arrow(painter, x1, y1, x2, y2)
+
+        # Текст с информацией о линии
+        mx = (x1 + x2) / 2
+        my = (y1 + y2) / 2
+        painter.setPen(self._label_pen)
+        painter.setFont(self._label_font)
+        painter.drawStaticText(self._label_origin(mx + 10, my - 10), label)
 
-        # Все нарисованные линии
-        pen = QtGui.QPen(QtGui.QColor(255, 0, 0, 200), 3)
-        painter.setPen(pen)
-        for (x1, y1, x2, y2, dist_m, angle_deg) in self.lines:
-            painter.drawLine(x1, y1, x2, y2)
-            # Рисуем стрелки на концах линии
-            self.draw_arrow(painter, x1, y1, x2, y2)
-
-            # Текст с информацией о линии
-            mx = (x1 + x2) / 2
-            my = (y1 + y2) / 2
-            text = f"{dist_m:.2f} м, {angle_deg:.1f}°"
-            painter.setPen(QtGui.QColor(255, 255, 255, 220))
-            painter.setFont(QtGui.QFont("Arial", 12, QtGui.QFont.Bold))
-            painter.drawText(QtCore.QPointF(mx + 10, my - 10), text)
+    def _segment_rect(self, x1, y1, x2, y2, label):
+        """Прямоугольник, который занимает отрезок на экране (линия, стрелка, подпись)."""
+        margin = ARROW_SIZE + self._line_pen.width()
+        rect = QtCore.QRectF(
+            QtCore.QPointF(min(x1, x2), min(y1, y2)),
+            QtCore.QPointF(max(x1, x2), max(y1, y2)),
+        ).toAlignedRect().adjusted(-margin, -margin, margin, margin)
+
+        mx = int((x1 + x2) / 2)
+        my = int((y1 + y2) / 2)
+        return rect.united(self._label_rect(mx + 10, my - 10, label))
 
     def draw_arrow(self, painter, x1, y1, x2, y2):
         """Рисует стрелку между двумя точками."""
         line = QtCore.QLineF(x1, y1, x2, y2)
         angle = math.atan2(-line.dy(), line.dx())
 
-        arrow_size = 10
+        arrow_size = ARROW_SIZE
         p1 = line.p2() - QtCore.QPointF(
             math.cos(angle + math.pi / 6) * arrow_size,
             math.sin(angle + math.pi / 6) * arrow_size
@@ -521,33 +4366,33 @@ class OverlayWindow(QtWidgets.QMainWindow):
         )
 
         arrow_head = QtGui.QPolygonF([line.p2(), p1, p2])
-        painter.setBrush(QtGui.QColor(255, 0, 0, 200))
+        painter.setBrush(self._arrow_brush)
         painter.drawPolygon(arrow_head)
 
     def keyPressEvent(self, event: QtGui.QKeyEvent):
-        """Отключаем выход по Esc, чтобы не мешало."""
-        pass
+        """Отключаем выход по Esc, чтобы не мешало; Esc лишь закрывает ввод калибровки."""
+        if event.key() == QtCore.Qt.Key_Escape and self._calibrationRowVisible():
+            self.cancelCalibrationEntry()
 
     def closeEvent(self, event):
         """Закрытие окна: снимаем хук, удаляем хоткеи и завершаем приложение."""
-        logging.debug("closeEvent triggered. Removing hotkeys и unhooking mouse.")
-        try:
-            if TOGGLE_HOTKEY_ID is not None:
-                keyboard.remove_hotkey(TOGGLE_HOTKEY_ID)
-            if CALIBRATE_HOTKEY_ID is not None:
-                keyboard.remove_hotkey(CALIBRATE_HOTKEY_ID)
-            if EXIT_HOTKEY_ID is not None:
-                keyboard.remove_hotkey(EXIT_HOTKEY_ID)
-            if CLEAR_LINES_HOTKEY_ID is not None:
-                keyboard.remove_hotkey(CLEAR_LINES_HOTKEY_ID)
-        except Exception as e:
-            logging.exception("Ошибка при удалении горячих клавиш:")
-
-        uninstall_mouse_hook()
-
-        global hook_mouse_thread
-        if hook_mouse_thread is not None and hook_mouse_thread.is_alive():
-            hook_mouse_thread.join()
+        logging.debug("closeEvent triggered. Removing hotkeys and unhooking input.")
+        global input_backend
+        wait_input_startup()
+        if input_backend is not None:
+            input_backend.uninstall()
+            input_backend = None
+        if self.minimap_watcher is not None:
+            self.minimap_watcher.stop()
+            self.minimap_watcher = None
+        if self.marker_tracker is not None:
+            self.marker_tracker.stop()
+            self.marker_tracker = None
+        if self.loupe_grabber is not None:
+            self.loupe_grabber.stop()
+            self.loupe_grabber = None
+        self.calibrations.close()
+        session_log.close()
 
         super().close()
         QtWidgets.QApplication.quit()
@@ -558,27 +4403,224 @@ class OverlayWindow(QtWidgets.QMainWindow):
         dy = y2 - y1
         return math.sqrt(dx * dx + dy * dy)
 
+    @staticmethod
+    def _bearing_deg(x1, y1, x2, y2):
+        """Угол: 0° — вверх, 90° — вправо, 180° — вниз."""
+        return math.degrees(math.atan2(x2 - x1, y1 - y2)) % 360
+
 ###############################################################################
 # MAIN
 ###############################################################################
+def parse_args(argv):
+    """Разбираем свои аргументы; остальное (например, -platform) отдаём Qt."""
+    parser = argparse.ArgumentParser(description="War Thunder ruler overlay")
+    parser.add_argument(
+        "--input-backend", choices=("windows", "synthetic"),
+        default="windows" if sys.platform == "win32" else "synthetic",
+        help="источник ввода: глобальные хуки Windows или синтетический replay",
+    )
+    parser.add_argument("--record-input", metavar="PATH",
+                        help="(windows) записать RMB-события и хоткеи в JSONL для replay")
+    parser.add_argument("--replay-input", metavar="PATH",
+                        help="(synthetic) проиграть запись JSONL вместо сгенерированного потока")
+    parser.add_argument("--synthetic-drags", type=int, default=100,
+                        help="(synthetic) сколько протяжек ПКМ сгенерировать")
+    parser.add_argument("--synthetic-seed", type=int, default=0)
+    parser.add_argument("--synthetic-moves", type=int, default=0,
+                        help="(synthetic) движений мыши внутри каждой протяжки")
+    parser.add_argument("--synthetic-rate", type=float, default=None, metavar="HZ",
+                        help="(synthetic) событий в секунду; 0 — без пауз; по умолчанию — метки из записи")
+    parser.add_argument("--synthetic-loops", type=int, default=1)
+    parser.add_argument("--exit-after-replay", action="store_true",
+                        help="(synthetic) закрыть приложение после проигрывания")
+    parser.add_argument("--trace-hook", action="store_true",
+                        help="логировать каждое событие в хуке мыши (медленно)")
+    parser.add_argument("--latency", action="store_true",
+                        help="включить замер задержек ввод -> экран с самого старта (Ctrl+Shift+L)")
+    parser.add_argument("--latency-export", metavar="PREFIX", default=LATENCY_EXPORT_PREFIX,
+                        help="куда писать отчёт: PREFIX.json и PREFIX.trace.json")
+    parser.add_argument("--calibration-file", metavar="PATH", default=CALIBRATION_STORE_PATH,
+                        help="где хранить калибровки по экранам и профилям")
+    parser.add_argument("--profile", metavar="NAME",
+                        help="профиль калибровки при старте (например, 'zoom 2')")
+    parser.add_argument("--grid-square", type=float, default=GRID_SQUARE_METERS, metavar="M",
+                        help="размер квадрата сетки миникарты для автокалибровки, м")
+    parser.add_argument("--minimap-region", metavar="X,Y,W,H",
+                        help="область миникарты в пикселях экрана (по умолчанию — правый нижний угол)")
+    parser.add_argument("--minimap-image", metavar="PATH",
+                        help="брать снимок миникарты из файла вместо экрана")
+    parser.add_argument("--auto-calibrate", action="store_true",
+                        help="автокалибровка по сетке миникарты сразу после старта (Ctrl+Shift+G)")
+    parser.add_argument("--watch-minimap", action="store_true",
+                        help="следить за зумом миникарты и пересчитывать масштаб на лету")
+    parser.add_argument("--watch-rate", type=float, default=MINIMAP_WATCH_HZ, metavar="HZ",
+                        help="снимков миникарты в секунду при --watch-minimap")
+    parser.add_argument("--track-markers", action="store_true",
+                        help="слежение за метками миникарты сразу после старта (Ctrl+Shift+T)")
+    parser.add_argument("--track-rate", type=float, default=MARKER_TRACK_HZ, metavar="HZ",
+                        help="снимков миникарты в секунду при слежении за метками")
+    parser.add_argument("--loupe", action="store_true",
+                        help="лупа с привязкой концов к меткам и сетке сразу после старта (Ctrl+Shift+M)")
+    parser.add_argument("--record-minimap", metavar="DIR",
+                        help="сохранять изменившиеся снимки миникарты (для bench.py markers)")
+    parser.add_argument("--scale-factor", type=float, default=None, metavar="M_PER_PX",
+                        help="сразу задать калибровку (метров на пиксель), без диалога")
+    parser.add_argument("--session-log", metavar="PATH",
+                        help=f"журнал сессии JSONL (по умолчанию — новый файл в {SESSION_LOG_DIR})")
+    parser.add_argument("--no-session-log", action="store_true", help="не вести журнал сессии")
+    parser.add_argument("--replay-session", metavar="PATH",
+                        help="без окна и ввода восстановить сессию из журнала и сохранить картинку")
+    parser.add_argument("--profile-startup", action="store_true",
+                        help="отчёт о времени фаз холодного старта в лог")
+    parser.add_argument("--exit-after-startup", action="store_true",
+                        help="закрыть приложение, как только старт закончен (для замеров)")
+    parser.add_argument("--no-fast-start", action="store_true",
+                        help="создавать окно, панель и ввод по очереди (без FAST_START)")
+    parser.add_argument("--replay-out", metavar="PNG",
+                        help="куда сохранить картинку --replay-session (по умолчанию PATH.png)")
+    return parser.parse_known_args(argv[1:])
+
+
+def run_replay_session(overlay, path, out_path=None):
+    """--replay-session: восстанавливает сессию из журнала и сохраняет картинку оверлея."""
+    records = load_session_log(path)
+    header = records[0] if records and records[0]["kind"] == "session" else {}
+    if header.get("screen"):
+        overlay.resize(*header["screen"])
+    start = time.perf_counter()
+    counts = replay_session(overlay, records)
+    applied = time.perf_counter() - start
+    # Тёмный фон вместо игры: белые подписи на прозрачном не разобрать
+    image = render_overlay(overlay, QtGui.QColor(40, 40, 40))
+    rendered = time.perf_counter() - start - applied
+    out_path = out_path or path + ".png"
+    image.save(out_path)
+    logging.info(
+        f"Replayed {len(records)} records ({', '.join(f'{k}={v}' for k, v in counts.items())}) "
+        f"in {applied * 1000:.1f} ms, rendered in {rendered * 1000:.1f} ms -> {out_path}"
+    )
+    overlay.calibrations.close()
+    return 0
+
+
+def start_input_backend(args):
+    """
+    Создаёт и ставит бэкенд ввода. Бэкенд Windows при FAST_START ставится в
+    фоновом потоке (импорт pywin32/pyWinhook, хоткеи, поток хука)
+    параллельно с созданием окна; хоткеи, нажатые до показа окна, ждут в
+    кольце ввода. Синтетическому бэкенду нужен готовый GUI — он ставится сразу.
+    """
+    global input_backend, _input_startup_thread
+    input_backend = create_input_backend(args)
+
+    def install():
+        started = startup_profile.begin()
+        try:
+            input_backend.install()
+        except Exception:
+            logging.exception("Не удалось установить бэкенд ввода:")
+        startup_profile.end(f"input ({input_backend.name})", started)
+        startup_profile.reach("input")
+
+    if FAST_START and args.input_backend == "windows":
+        _input_startup_thread = threading.Thread(target=install, name="input-startup", daemon=True)
+        _input_startup_thread.start()
+    else:
+        install()
+
+
+def wait_input_startup(timeout=5.0):
+    """Дождаться фоновой установки ввода (перед снятием хуков)."""
+    thread = _input_startup_thread
+    if thread is not None and thread is not threading.current_thread():
+        thread.join(timeout)
+
+
 def main():
     logging.debug("Starting application...")
-    app = QtWidgets.QApplication(sys.argv)
+    started = imported = startup_profile.begin()
+    args, qt_argv = parse_args(sys.argv)
+    global HOOK_TRACE, LATENCY_EXPORT_PREFIX, FAST_START, _overlay_starting
+    HOOK_TRACE = args.trace_hook or logging.getLogger().isEnabledFor(logging.DEBUG)
+    LATENCY_EXPORT_PREFIX = args.latency_export
+    latency_probe.set_enabled(args.latency)
+    FAST_START = not args.no_fast_start
+    startup_profile.enabled = args.profile_startup or args.exit_after_startup
+    startup_profile.quit_when_done = args.exit_after_startup
+    startup_profile.end("imports", _PROCESS_T0, imported)
+    startup_profile.end("args", started)
+    if args.replay_session:
+        # Проигрывание журнала не показывает окно и не трогает ввод
+        os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+    elif args.input_backend == "windows" and FAST_START:
+        # Ввод ставится параллельно с QApplication и окном
+        _overlay_starting = True
+        start_input_backend(args)
 
-    global overlay
-    overlay = OverlayWindow()
+    started = startup_profile.begin()
+    app = QtWidgets.QApplication(sys.argv[:1] + qt_argv)
+    startup_profile.end("QApplication", started)
 
-    # Глобальные хоткеи
-    install_keyboard_hotkey()
+    global overlay, screen_grabber, CALIBRATION_STORE_PATH, GRID_SQUARE_METERS, MINIMAP_REGION
+    global MINIMAP_WATCH, MINIMAP_WATCH_HZ, MARKER_TRACK_HZ, MARKER_RECORD_DIR
+    MINIMAP_WATCH = args.watch_minimap
+    MINIMAP_WATCH_HZ = args.watch_rate
+    MARKER_TRACK_HZ = args.track_rate
+    MARKER_RECORD_DIR = args.record_minimap
+    if MARKER_RECORD_DIR:
+        os.makedirs(MARKER_RECORD_DIR, exist_ok=True)
+    CALIBRATION_STORE_PATH = args.calibration_file
+    GRID_SQUARE_METERS = args.grid_square
+    if args.minimap_region:
+        MINIMAP_REGION = tuple(int(v) for v in args.minimap_region.split(","))
+    screen_grabber = create_screen_grabber(args)
+    started = startup_profile.begin()
+    overlay = OverlayWindow()
+    startup_profile.end("OverlayWindow", started)
+    started = startup_profile.begin()
+    if args.profile and args.profile != overlay.calibrations.active_profile:
+        overlay.calibrations.set_profile(args.profile)
+        overlay.scale_factor = overlay.calibrations.scale
+        overlay.is_calibrating = overlay.scale_factor is None
+    if args.scale_factor:
+        overlay.scale_factor = args.scale_factor
+        overlay.is_calibrating = False
+    if args.replay_session:
+        sys.exit(run_replay_session(overlay, args.replay_session, args.replay_out))
+    overlay._syncMinimapWatcher()
+    if not args.no_session_log:
+        screen = QtWidgets.QApplication.primaryScreen().size()
+        if not args.session_log:
+            # Новый файл на каждый запуск: старые сверх SESSION_LOG_KEEP удаляем
+            prune_session_logs(SESSION_LOG_DIR, SESSION_LOG_KEEP - 1)
+        session_log.open(
+            args.session_log or os.path.join(SESSION_LOG_DIR, time.strftime("session-%Y%m%d-%H%M%S.jsonl")),
+            screen=[screen.width(), screen.height()], profile=overlay.calibrations.active_profile,
+            scale=overlay.scale_factor,
+        )
+    startup_profile.end("setup", started)
 
-    # Запуск отдельного потока с хуком мыши
-    global hook_mouse_thread
-    hook_mouse_thread = threading.Thread(target=install_mouse_hook, daemon=True)
-    hook_mouse_thread.start()
-    logging.debug("Mouse hook thread started.")
+    # Глобальный ввод: хоткеи + хук мыши (или синтетический replay)
+    if input_backend is None:
+        start_input_backend(args)
+    else:
+        # Хоткеи, нажатые, пока окно создавалось
+        QtCore.QTimer.singleShot(0, overlay.drainInput)
+    if args.auto_calibrate:
+        overlay.startAutoCalibration()
+    if args.track_markers:
+        overlay.toggleTracking()
+    if args.loupe:
+        overlay.toggleLoupe()
 
     # Запуск GUI
     ret_code = app.exec_()
+    wait_input_startup()
+    logging.info("Input ring: " + ", ".join(f"{k}={v}" for k, v in input_ring.stats().items()))
+    logging.info("Overlay mask: " + ", ".join(f"{k}={v}" for k, v in overlay.maskSummary().items()))
+    if latency_probe.enabled and latency_probe.summary()["total"]["count"]:
+        latency_probe.export(LATENCY_EXPORT_PREFIX)
+    session_log.close()
     logging.debug(f"App exec returned {ret_code}. Exiting main().")
     sys.exit(ret_code)
 